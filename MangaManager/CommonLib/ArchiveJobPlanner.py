@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import zipfile
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import IO, Callable
+
+from CommonLib.BatchProcessor import DEFAULT_WORKERS, run_batch
+from CommonLib.ByteBudget import ByteBudget
+from CommonLib.ZipRewriter import DROP, KEEP, Add, EntryOperation, Rename, Replace, RewriteResult, Transform, \
+    TransformOutput, rewrite_archive
+
+logger = logging.getLogger(__name__)
+
+
+class TransformChain:
+    """
+    Applies several transforms in order. Picklable as long as every transform is, so it can run in a process pool.
+
+    A transform returns None to leave its input as it is. The chain returns None if the content ends up unchanged.
+    Stats of the transforms returning a TransformOutput are added up.
+    """
+
+    def __init__(self, transforms: list[Callable[[IO[bytes]], bytes | TransformOutput | None]]):
+        self.transforms = list(transforms)
+
+    def __call__(self, open_file) -> bytes | TransformOutput | None:
+        if len(self.transforms) == 1:
+            return self.transforms[0](open_file)
+        source = data = open_file.read()
+        stats = Counter()
+        for transform in self.transforms:
+            output = transform(BytesIO(data))
+            if isinstance(output, TransformOutput):
+                stats.update(output.stats)
+                output = output.data
+            if output is not None:
+                data = output
+        data = None if data is source else data
+        return TransformOutput(data, dict(stats)) if stats else data
+
+
+@dataclass
+class PlannedEntry:
+    """
+    An entry of the archive as it will be once every pending step is applied.
+
+    :param name: The name the entry will have
+    :param source: The entry of the current archive this one comes from. None for new entries
+    :param data: New content of the entry, replaces the source data
+    :param path: File on disk with the new content of the entry, replaces the source data
+    :param transforms: Functions applied in order to the content. Each one gets an open binary file and returns bytes,
+        a TransformOutput or None to leave the content as it is
+    :param compress_type: Compression of the written entry. Defaults to the one of the source entry
+    :param fallback_name: Name of the entry if the transforms leave the content as it was. Defaults to name
+    """
+    name: str
+    source: zipfile.ZipInfo = None
+    data: bytes = None
+    path: str = None
+    transforms: list[Callable[[IO[bytes]], bytes | TransformOutput | None]] = field(default_factory=list)
+    compress_type: int = None
+    fallback_name: str = None
+
+    @property
+    def is_untouched(self) -> bool:
+        return (self.source is not None and self.name == self.source.filename and self.data is None
+                and self.path is None and not self.transforms)
+
+    def get_data(self) -> tuple[bytes | TransformOutput | None, str]:
+        """
+        The content of a new entry with its transforms applied, and the name it is written under.
+        The content is None if it can be streamed from self.path as it is
+        """
+        if not self.transforms:
+            return self.data, self.name
+        if self.path is not None:
+            with open(self.path, 'rb') as open_file:
+                data = TransformChain(self.transforms)(open_file)
+        else:
+            data = TransformChain(self.transforms)(BytesIO(self.data))
+        if isinstance(data, TransformOutput) and data.data is None:
+            data = None
+        if data is None:
+            return self.data, self.fallback_name or self.name
+        return data, self.name
+
+    def to_operation(self) -> EntryOperation:
+        """
+        The operation that turns the source entry into this one. Renamed and untouched entries are copied raw
+        """
+        if self.data is not None or self.path is not None:
+            data, name = self.get_data()
+            return Replace(data, self.path if data is None else None, name, self.compress_type)
+        if self.transforms:
+            return Transform(TransformChain(self.transforms), self.name, self.compress_type,
+                             self.fallback_name or self.name)
+        if self.name != self.source.filename:
+            return Rename(self.name)
+        return KEEP
+
+    def to_addition(self) -> Add:
+        data, name = self.get_data()
+        compress_type = zipfile.ZIP_STORED if self.compress_type is None else self.compress_type
+        return Add(name, data, self.path if data is None else None, compress_type)
+
+
+PlanStep = Callable[[list[PlannedEntry]], list[PlannedEntry]]
+
+
+class ArchiveJob:
+    """
+    The operations pending for one archive. Steps are added by the different tools (cover, metadata, webp...)
+    and are all applied in a single rewrite.
+
+    A step gets the list of entries as left by the previous steps and returns the new list.
+    Entries can be renamed, removed, added or get their content transformed.
+    """
+
+    def __init__(self, path: str, steps: list[PlanStep] = None):
+        self.path = path
+        self.steps = list(steps or [])
+        self._callbacks = []
+
+    def add_step(self, step: PlanStep) -> ArchiveJob:
+        self.steps.append(step)
+        return self
+
+    def on_done(self, callback: Callable[[], None]) -> ArchiveJob:
+        """
+        Registers a function to call once the archive has been successfully rewritten
+        """
+        self._callbacks.append(callback)
+        return self
+
+    def plan(self) -> tuple[list[PlannedEntry], int]:
+        """
+        :return: The entries the archive will have once every step is applied and the number of entries it has now
+        """
+        with zipfile.ZipFile(self.path, 'r') as zin:
+            entries = [PlannedEntry(item.filename, item) for item in zin.infolist()]
+        total_files = len(entries)
+        for step in self.steps:
+            entries = step(entries)
+        return entries, total_files
+
+    def run(self, log_prefix: str = "[ArchiveJob]", executor: Executor = None,
+            budget: ByteBudget = None) -> RewriteResult | None:
+        """
+        Applies every step in one rewrite of the archive
+
+        :param executor: Optional process pool the content transforms (i.e. webp conversion) are spread across
+        :param budget: Optional cap on the bytes of the entries sent to the executor and not yet written
+
+        :return: The result of the rewrite. None if the steps left the archive as it was, so it was not rewritten
+        """
+        entries, total_files = self.plan()
+        operations = {}
+        additions = []
+        for entry in entries:
+            if entry.source is None:
+                additions.append(entry.to_addition())
+                continue
+            key = (entry.source.filename, entry.source.header_offset)
+            if key in operations:
+                raise ValueError(f"Entry '{entry.source.filename}' can't be written twice")
+            operations[key] = entry
+
+        def plan(item: zipfile.ZipInfo) -> EntryOperation:
+            entry = operations.get((item.filename, item.header_offset))
+            return DROP if entry is None else entry.to_operation()
+
+        result = None
+        if additions or len(operations) != total_files or not all(e.is_untouched for e in operations.values()):
+            logger.info(f"{log_prefix} Rewriting '{self.path}' ({len(self.steps)} steps)")
+            result = rewrite_archive(self.path, plan, additions, log_prefix=log_prefix, executor=executor,
+                                     budget=budget)
+        else:
+            logger.info(f"{log_prefix} Nothing to change in '{self.path}'")
+        for callback in self._callbacks:
+            callback()
+        return result
+
+
+class JobPlanner:
+    """
+    Groups the pending operations of several tools per archive, so each archive is rewritten only once
+    """
+
+    def __init__(self):
+        self.jobs: dict[str, ArchiveJob] = {}
+
+    def job(self, path: str) -> ArchiveJob:
+        """
+        Returns the job of the archive, creating it if needed
+        """
+        key = os.path.abspath(path)
+        if key not in self.jobs:
+            self.jobs[key] = ArchiveJob(path)
+        return self.jobs[key]
+
+    def add_step(self, path: str, step: PlanStep) -> ArchiveJob:
+        return self.job(path).add_step(step)
+
+    def run(self, max_workers: int = DEFAULT_WORKERS, progress_bar=None, executor: Executor = None,
+            budget: ByteBudget = None, log_prefix: str = "[ArchiveJob]") -> tuple[list, list]:
+        """
+        Runs every pending job and clears the queue
+
+        :param executor: Optional process pool shared by every job for the content transforms
+        :param budget: Optional cap on the bytes in flight in the executor, shared by every job
+
+        :return: ([(job, RewriteResult | None)], [(job, exception)])
+        """
+        jobs = list(self.jobs.values())
+        self.jobs = {}
+        process = functools.partial(ArchiveJob.run, log_prefix=log_prefix, executor=executor, budget=budget)
+        return run_batch(jobs, process, max_workers=max_workers, progress_bar=progress_bar)
@@ -0,0 +1,67 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+def run_batch(items: Iterable, process: Callable, max_workers: int = DEFAULT_WORKERS, progress_bar=None,
+              poll_interval: float = 0.1) -> tuple[list, list]:
+    """
+    Runs process(item) for every item in a bounded thread pool.
+
+    Meant for archive rewrites, which spend most of the time waiting for disk or network I/O.
+    At most max_workers * 2 items are submitted at once, so huge selections don't pile up in memory.
+    Worker threads never touch the UI: they report to the progress bar through its queue and the calling
+    (main) thread redraws it while it waits.
+
+    :param items: The items to process
+    :param process: Function called with each item in a worker thread
+    :param max_workers: Number of items processed at the same time
+    :param progress_bar: Optional CommonLib.ProgressBarWidget.ProgressBar
+    :param poll_interval: Seconds between progress bar redraws
+    :return: ([(item, result)], [(item, exception)]) in completion order
+    """
+    results = []
+    errors = []
+    items = iter(items)
+    max_workers = max(1, max_workers)
+
+    def _process(item):
+        try:
+            result = process(item)
+        except Exception as e:
+            if progress_bar is not None:
+                progress_bar.increaseError()
+            raise e
+        if progress_bar is not None:
+            progress_bar.increaseCount()
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def _submit_next() -> bool:
+            try:
+                item = next(items)
+            except StopIteration:
+                return False
+            pending[executor.submit(_process, item)] = item
+            return True
+
+        while len(pending) < max_workers * 2 and _submit_next():
+            pass
+        while pending:
+            done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    results.append((item, future.result()))
+                except Exception as e:
+                    errors.append((item, e))
+                _submit_next()
+            if progress_bar is not None:
+                progress_bar.updatePB()
+    return results, errors
@@ -0,0 +1,47 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class ByteBudget:
+    """
+    Caps the number of bytes held in memory at once by several threads.
+
+    A charge bigger than the whole budget is allowed once nothing else is in flight,
+    so a single huge page can't block the run forever.
+    Blocking acquires are served in arrival order, so a big charge can't be starved by a stream of small ones.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: Maximum number of bytes in flight at the same time
+        """
+        self.max_bytes = max(1, max_bytes)
+        self.in_use = 0
+        self._condition = threading.Condition()
+        self._waiting = deque()
+
+    def _charge(self, size: int) -> int:
+        return min(max(0, size), self.max_bytes)
+
+    def acquire(self, size: int):
+        """
+        Reserves size bytes, waiting until they fit in the budget
+        """
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                self._condition.wait_for(
+                    lambda: self._waiting[0] is ticket and self.in_use + self._charge(size) <= self.max_bytes)
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+            self.in_use += self._charge(size)
+
+    def release(self, size: int):
+        with self._condition:
+            self.in_use -= self._charge(size)
+            self._condition.notify_all()
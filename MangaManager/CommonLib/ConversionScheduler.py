@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from CommonLib.ArchiveJobPlanner import JobPlanner, PlanStep
+from CommonLib.BatchProcessor import DEFAULT_WORKERS
+from CommonLib.ByteBudget import ByteBudget
+from CommonLib.PageHashIndex import PageHashIndex, hash_step
+from CommonLib.RunJournal import RunJournal
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+DEFAULT_PAGE_WORKERS = os.cpu_count() or 1
+DEFAULT_MAX_INFLIGHT_BYTES = 256 * MB
+
+
+@dataclass
+class ConversionReport:
+    archives: int = 0
+    unchanged: int = 0
+    skipped: int = 0
+    errors: list = field(default_factory=list)
+    pages: int = 0
+    pages_kept: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    elapsed: float = 0.0
+    archive_sizes: list = field(default_factory=list)
+    stats: Counter = field(default_factory=Counter)
+    page_qualities: list = field(default_factory=list)
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_read - self.bytes_written
+
+    @property
+    def cache_hit_rate(self) -> float | None:
+        """
+        Fraction of the pages taken from the page cache. None if the cache was not used
+        """
+        lookups = self.stats["cache_hits"] + self.stats["cache_misses"]
+        return self.stats["cache_hits"] / lookups if lookups else None
+
+    @property
+    def average_quality(self) -> float | None:
+        """
+        Mean webp quality picked by the adaptive quality search. None if it was not used
+        """
+        searches = self.stats["quality_searches"]
+        return self.stats["quality_sum"] / searches if searches else None
+
+    @property
+    def metadata_bytes(self) -> int:
+        """
+        Bytes of metadata removed from the pages by the strip encoder
+        """
+        return self.stats["metadata_bytes"]
+
+    @property
+    def cropped_megapixels(self) -> float:
+        """
+        Pixels removed by cropping the borders of the pages, in millions
+        """
+        return self.stats["cropped_pixels"] / 1_000_000
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes_read / MB / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> str:
+        return (f"Processed {self.archives} archives ({self.unchanged} unchanged, {len(self.errors)} errors"
+                + (f", {self.skipped} already done" if self.skipped else "") + ") "
+                f"in {self.elapsed:.1f}s - {self.pages} pages, {self.pages_per_second:.1f} pages/s, "
+                f"{self.bytes_read / MB:.1f} MB read at {self.mb_per_second:.1f} MB/s - "
+                f"{self.pages_kept} pages kept as they were, {self.stats['grayscale']} converted to grayscale, "
+                f"{self.bytes_saved / MB:.2f} MB saved"
+                + (f" - page cache hit rate {self.cache_hit_rate:.1%}" if self.cache_hit_rate is not None else "")
+                + (f" - average webp quality {self.average_quality:.1f}" if self.average_quality is not None else "")
+                + (f" - {self.metadata_bytes / MB:.2f} MB of metadata removed" if self.metadata_bytes else "")
+                + (f" - {self.stats['cropped']} pages cropped ({self.cropped_megapixels:.1f} MP removed)"
+                   if self.stats["cropped"] else ""))
+
+    def savings_report(self) -> str:
+        """
+        One line per rewritten archive with its size before and after, the metadata removed from it
+        and the pages cropped
+        """
+        return "\n".join(f"{os.path.basename(path)}: {before / MB:.2f} MB -> {after / MB:.2f} MB "
+                         f"({(before - after) / MB:.2f} MB saved"
+                         + (f", {stats['metadata_bytes'] / 1024:.1f} KB of metadata" if stats["metadata_bytes"] else "")
+                         + (f", {stats['cropped']} pages cropped" if stats["cropped"] else "")
+                         + ")" for path, before, after, stats in self.archive_sizes)
+
+    def quality_report(self) -> str:
+        """
+        One line per page with the webp quality picked for it by the adaptive quality search
+        """
+        return "\n".join(f"{os.path.basename(path)}/{name}: quality {quality}"
+                         for path, name, quality in self.page_qualities)
+
+
+class ConversionScheduler:
+    """
+    Runs the same steps (i.e. webp conversion) over a whole library.
+
+    Several archives are read and written at the same time in threads while the pages of all of them are encoded
+    in a single process pool. The uncompressed bytes of the pages sent to the pool and not yet written are capped,
+    so many small chapters and one huge omnibus can share the CPU without running out of memory.
+    """
+
+    def __init__(self, page_workers: int = DEFAULT_PAGE_WORKERS, archive_workers: int = DEFAULT_WORKERS,
+                 max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES):
+        """
+        :param page_workers: Number of processes pages are encoded in
+        :param archive_workers: Number of archives read and written at the same time
+        :param max_inflight_bytes: Maximum uncompressed bytes of the pages being encoded at once
+        """
+        self.page_workers = max(1, page_workers)
+        self.archive_workers = max(1, archive_workers)
+        self.max_inflight_bytes = max_inflight_bytes
+
+    def run(self, paths: Iterable[str], steps: list[PlanStep], progress_bar=None, log_prefix: str = "[Scheduler]",
+            journal: RunJournal = None, page_index: PageHashIndex = None) -> ConversionReport:
+        """
+        :param paths: The archives to process
+        :param steps: Steps added to the job of every archive
+        :param progress_bar: Optional progress bar, see CommonLib.BatchProcessor.run_batch
+        :param journal: Archives it lists as finished are skipped (counted as processed in the progress bar).
+            Every archive is recorded in it as soon as it's done
+        :param page_index: The pages are hashed into it while they are processed, see CommonLib.PageHashIndex
+        :return: The statistics of the run. Failed archives are listed in errors as (ArchiveJob, exception)
+        """
+        paths = list(paths)
+        report = ConversionReport()
+        if journal is not None:
+            pending = journal.pending(paths)
+            report.skipped = len(paths) - len(pending)
+            paths = pending
+            if progress_bar is not None:
+                for _ in range(report.skipped):
+                    progress_bar.increaseCount()
+            logger.info(f"{log_prefix} Skipping {report.skipped} archives finished in a previous run")
+        planner = JobPlanner()
+        for path in paths:
+            for step in steps:
+                planner.add_step(path, step)
+            if page_index is not None:
+                planner.add_step(path, hash_step(page_index.index_path, path))
+                planner.job(path).on_done(functools.partial(page_index.sync_archive, path))
+            if journal is not None:
+                planner.job(path).on_done(functools.partial(journal.record, path))
+        report.archives = len(planner.jobs)
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=self.page_workers) as executor:
+            results, report.errors = planner.run(max_workers=self.archive_workers, progress_bar=progress_bar,
+                                                 executor=executor, budget=ByteBudget(self.max_inflight_bytes),
+                                                 log_prefix=log_prefix)
+        report.elapsed = time.time() - start_time
+        for job, result in results:
+            if result is None:
+                report.unchanged += 1
+                continue
+            report.pages += result.entries_written + result.entries_kept
+            report.pages_kept += result.entries_kept
+            report.bytes_read += result.size_before
+            report.bytes_written += result.size_after
+            report.stats.update(result.stats)
+            report.archive_sizes.append((job.path, result.size_before, result.size_after, Counter(result.stats)))
+            # The stats of a single page hold the quality searched for it
+            report.page_qualities.extend((job.path, name, stats["quality_sum"])
+                                         for name, stats in result.entry_stats.items() if stats.get("quality_searches"))
+            logger.info(f"{log_prefix} '{job.path}': {result.size_before - result.size_after} bytes saved")
+        for job, e in report.errors:
+            logger.error(f"{log_prefix} Error processing '{job.path}': {e}", exc_info=e)
+        logger.info(f"{log_prefix} {report.summary()}")
+        return report
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import logging
+import math
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Pages are analysed at this size at most. Reducing averages blocks of pixels, so colour areas keep their colour
+ANALYSIS_MAX_SIDE = 1024
+
+DEFAULT_GRAYSCALE_TOLERANCE = 8
+DEFAULT_MAX_COLOUR_RATIO = 0.001
+# Maximum difference between a border pixel and the border colour (0-255)
+DEFAULT_CROP_TOLERANCE = 24
+# Fraction of a row or column of the border that can differ from the border colour (dust, scanner noise)
+DEFAULT_CROP_NOISE_RATIO = 0.005
+# Pages are not cropped if they would lose more than this fraction of their width or height
+MAX_CROP_RATIO = 0.4
+# Space left around the content, as a fraction of the longest side of the page
+CROP_MARGIN_RATIO = 0.01
+# Maximum difference between a pixel of a blank page and its background (0-255)
+DEFAULT_BLANK_TOLERANCE = 24
+# Fraction of the pixels of a blank page that can differ from its background (dust, scanner noise)
+DEFAULT_BLANK_NOISE_RATIO = 0.001
+# Perceptual hashes are computed on a HASH_SIDE x HASH_SIDE thumbnail, so they have HASH_SIDE ** 2 bits
+HASH_SIDE = 8
+
+_GREY_MODES = ("1", "L", "LA", "I", "F", "I;16")
+
+
+def _reduced(image: Image.Image) -> Image.Image:
+    factor = math.ceil(max(image.size) / ANALYSIS_MAX_SIDE)
+    return image.reduce(factor) if factor > 1 else image
+
+
+def is_grayscale(image: Image.Image, tolerance: int = DEFAULT_GRAYSCALE_TOLERANCE,
+                 max_colour_ratio: float = DEFAULT_MAX_COLOUR_RATIO) -> bool:
+    """
+    Checks if an image only has shades of grey. Scans are rarely perfectly grey, so a pixel counts as grey
+    if its channels differ by tolerance at most, and a few coloured pixels (noise, dust) are allowed.
+
+    :param tolerance: Maximum difference between the R, G and B values of a grey pixel (0-255)
+    :param max_colour_ratio: Fraction of coloured pixels a grey image can have
+    """
+    if image.mode in _GREY_MODES:
+        return True
+    pixels = np.asarray(_reduced(image.convert("RGB")), dtype=np.int16)
+    spread = pixels.max(axis=2) - pixels.min(axis=2)
+    return np.count_nonzero(spread > tolerance) <= max_colour_ratio * spread.size
+
+
+def to_grayscale(image: Image.Image, tolerance: int = DEFAULT_GRAYSCALE_TOLERANCE) -> tuple[Image.Image, bool]:
+    """
+    Converts the image to a single channel (L, or LA if it has transparency) if it is grey
+
+    :return: The image, converted or not, and whether it was converted
+    """
+    if image.mode in _GREY_MODES or not is_grayscale(image, tolerance):
+        return image, False
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    return image.convert("LA" if has_alpha else "L"), True
+
+
+def content_box(image: Image.Image, tolerance: int = DEFAULT_CROP_TOLERANCE,
+                noise_ratio: float = DEFAULT_CROP_NOISE_RATIO) -> tuple[int, int, int, int] | None:
+    """
+    Finds the content of a page with uniform borders, i.e. the white or black margins of a scan.
+    The border colour is the median of the outermost pixels. Rows and columns where more than noise_ratio of the
+    pixels differ from it by more than tolerance hold content. A small margin is kept around it.
+
+    :return: The (left, upper, right, lower) box of the content. None if there are no borders to crop, the page is
+        blank or cropping would remove more than MAX_CROP_RATIO of its width or height
+    """
+    factor = max(1, math.ceil(max(image.size) / ANALYSIS_MAX_SIDE))
+    pixels = np.asarray(_reduced(image.convert("RGB")), dtype=np.int16)
+    ring = np.concatenate((pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]))
+    differs = np.abs(pixels - np.median(ring, axis=0)).max(axis=2) > tolerance
+    rows = np.flatnonzero(np.count_nonzero(differs, axis=1) > noise_ratio * differs.shape[1])
+    columns = np.flatnonzero(np.count_nonzero(differs, axis=0) > noise_ratio * differs.shape[0])
+    if not rows.size or not columns.size:
+        logger.debug("Page is blank. Not cropping")
+        return None
+    width, height = image.size
+    # Reduced pixels cover factor x factor pixels of the page. The box is rounded outwards
+    margin = round(CROP_MARGIN_RATIO * max(width, height))
+    box = (max(0, int(columns[0]) * factor - margin), max(0, int(rows[0]) * factor - margin),
+           min(width, (int(columns[-1]) + 1) * factor + margin), min(height, (int(rows[-1]) + 1) * factor + margin))
+    if box == (0, 0, width, height):
+        return None
+    if box[2] - box[0] < (1 - MAX_CROP_RATIO) * width or box[3] - box[1] < (1 - MAX_CROP_RATIO) * height:
+        logger.debug(f"Content box {box} of {width}x{height} page is too small. Not cropping")
+        return None
+    return box
+
+
+def crop_borders(image: Image.Image, tolerance: int = DEFAULT_CROP_TOLERANCE) -> tuple[Image.Image, int]:
+    """
+    Crops the uniform borders of the image, see content_box
+
+    :return: The image, cropped or not, and the number of pixels removed
+    """
+    box = content_box(image, tolerance)
+    if box is None:
+        return image, 0
+    cropped = image.crop(box)
+    return cropped, image.width * image.height - cropped.width * cropped.height
+
+
+def is_blank(image: Image.Image, tolerance: int = DEFAULT_BLANK_TOLERANCE,
+             noise_ratio: float = DEFAULT_BLANK_NOISE_RATIO) -> bool:
+    """
+    Checks if the page has a single colour (white, black or the paper of a scan), ignoring noise and dust
+    """
+    pixels = np.asarray(_reduced(image.convert("L")), dtype=np.int16)
+    differs = np.abs(pixels - np.median(pixels)) > tolerance
+    return bool(np.count_nonzero(differs) <= noise_ratio * differs.size)
+
+
+def _hash_bits(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Difference hash: whether each pixel of a small grey thumbnail is brighter than its right neighbour.
+    Resizing, re-encoding and small edits change few bits. Compare hashes by their Hamming distance
+    """
+    thumbnail = image.convert("L").resize((HASH_SIDE + 1, HASH_SIDE), Image.BOX)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    return _hash_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def ahash(image: Image.Image) -> int:
+    """
+    Average hash: whether each pixel of a small grey thumbnail is brighter than the mean of the thumbnail
+    """
+    pixels = np.asarray(image.convert("L").resize((HASH_SIDE, HASH_SIDE), Image.BOX), dtype=np.float64)
+    return _hash_bits(pixels > pixels.mean())
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+def luma_plane(image: Image.Image) -> np.ndarray:
+    """
+    The luma of the image, reduced to ANALYSIS_MAX_SIDE at most, as a float array. What image metrics compare
+    """
+    return np.asarray(_reduced(image.convert("L")), dtype=np.float64)
+
+
+def psnr(reference: np.ndarray, distorted: np.ndarray) -> float:
+    """
+    Peak signal to noise ratio in dB. inf if both planes are equal
+    """
+    mse = np.mean(np.square(reference - distorted))
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def _box_mean(plane: np.ndarray, size: int) -> np.ndarray:
+    """
+    Mean of every size x size window, computed from the integral image
+    """
+    integral = np.pad(plane, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    window_sum = (integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size]
+                  + integral[:-size, :-size])
+    return window_sum / (size * size)
+
+
+def ssim(reference: np.ndarray, distorted: np.ndarray, window: int = 7) -> float:
+    """
+    Mean structural similarity of two planes of the same size, over window x window uniform windows.
+    1 if both planes are equal
+    """
+    window = max(1, min(window, *reference.shape))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x, mean_y = _box_mean(reference, window), _box_mean(distorted, window)
+    var_x = _box_mean(reference * reference, window) - mean_x * mean_x
+    var_y = _box_mean(distorted * distorted, window) - mean_y * mean_y
+    covariance = _box_mean(reference * distorted, window) - mean_x * mean_y
+    ssim_map = (((2 * mean_x * mean_y + c1) * (2 * covariance + c2))
+                / ((mean_x * mean_x + mean_y * mean_y + c1) * (var_x + var_y + c2)))
+    return float(ssim_map.mean())
+
+
+QUALITY_METRICS = {"ssim": ssim, "psnr": psnr}
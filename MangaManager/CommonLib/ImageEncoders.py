@@ -0,0 +1,490 @@
+from __future__ import annotations
+
+import logging
+import math
+import re
+import zipfile
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Iterable
+
+import PIL
+from PIL import Image
+
+from CommonLib.ArchiveJobPlanner import PlannedEntry, PlanStep
+from CommonLib.ImageAnalysis import ANALYSIS_MAX_SIDE, QUALITY_METRICS, content_box, \
+    luma_plane, to_grayscale
+from CommonLib.ImageMetadata import UnsupportedImage, orientation_exif, strip_metadata
+from CommonLib.PageCache import DEFAULT_MAX_BYTES as DEFAULT_CACHE_BYTES, CachedTransform
+from CommonLib.ZipRewriter import TransformOutput
+
+logger = logging.getLogger(__name__)
+
+SOURCE_FORMATS = (".png", ".jpeg", ".jpg")
+
+# Pillow webp encoder settings. method goes from 0 (fast) to 6 (slow, smaller files).
+# With lossless, quality is the effort spent compressing instead of the image quality
+WEBP_PRESETS = {
+    "fast": {"quality": 75, "method": 0},
+    "balanced": {"quality": 80, "method": 4},  # Pillow defaults
+    "archival": {"quality": 90, "method": 6},
+    "lossless": {"lossless": True, "quality": 100, "method": 4},
+}
+DEFAULT_PRESET = "balanced"
+# Qualities the adaptive search picks from. Above the top one pages are kept at the top one
+ADAPTIVE_QUALITY_RANGE = (30, 95)
+# CPU seconds per megapixel of every preset, measured on one core of a desktop CPU
+_WEBP_COSTS = {"fast": 0.07, "balanced": 0.19, "archival": 0.63, "lossless": 1.2}
+# Encodes the adaptive quality search takes per page
+_QUALITY_SEARCH_PASSES = 7
+
+
+def fit_to_max_size(image: Image.Image, max_width: int = None, max_height: int = None) -> Image.Image:
+    """
+    Downscales the image so it fits in max_width x max_height, keeping the aspect ratio.
+
+    Must be called before the image is loaded: JPEGs are decoded straight at a reduced scale (draft mode)
+    and the rest is reduced by an integer factor before resampling, so big scans are never processed at full size.
+
+    :return: The image itself if it already fits
+    """
+    width, height = image.size
+    scale = min((max_width or width) / width, (max_height or height) / height)
+    if scale >= 1:
+        return image
+    target_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if image.format == "JPEG":
+        image.draft(image.mode, target_size)  # Decodes at 1/2, 1/4 or 1/8 scale, never below target_size
+    logger.debug(f"Downscaling image from {image.size} to {target_size}")
+    return image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def crop_to_content(data: bytes, image: Image.Image, tolerance: int, max_width: int = None,
+                    max_height: int = None) -> tuple[Image.Image, int]:
+    """
+    Crops the uniform borders of the image, see CommonLib.ImageAnalysis.content_box.
+
+    Like fit_to_max_size, must be called before the image is loaded. The borders are found on a preview of the image
+    decoded at a reduced scale, and JPEGs whose content is downscaled afterwards are decoded straight at the smallest
+    scale (draft mode) that still covers the content at the size it is downscaled to.
+
+    :param data: The encoded image, the preview is decoded from it
+    :return: The image, cropped or not, and the number of pixels of the full size image removed
+    """
+    with Image.open(BytesIO(data)) as preview:
+        full_width, full_height = preview.size
+        factor = math.ceil(max(preview.size) / ANALYSIS_MAX_SIDE)
+        preview.draft(preview.mode, (math.ceil(full_width / factor), math.ceil(full_height / factor)))
+        box = content_box(preview, tolerance)
+        preview_width, preview_height = preview.size
+    if box is None:
+        return image, 0
+
+    def scale_box(box, scale_x, scale_y, width, height):
+        # Rounded outwards
+        return (math.floor(box[0] * scale_x), math.floor(box[1] * scale_y),
+                min(width, math.ceil(box[2] * scale_x)), min(height, math.ceil(box[3] * scale_y)))
+
+    box = scale_box(box, full_width / preview_width, full_height / preview_height, full_width, full_height)
+    crop_width, crop_height = box[2] - box[0], box[3] - box[1]
+    scale = min((max_width or crop_width) / crop_width, (max_height or crop_height) / crop_height)
+    if scale < 1 and image.format == "JPEG":
+        image.draft(image.mode, (math.ceil(full_width * scale), math.ceil(full_height * scale)))
+        box = scale_box(box, image.width / full_width, image.height / full_height, image.width, image.height)
+    return image.crop(box), full_width * full_height - crop_width * crop_height
+
+
+def _save_webp(image: Image.Image, options: dict) -> bytes:
+    converted_image = BytesIO()
+    image.save(converted_image, format="webp", **options)
+    # getvalue hands over the buffer the encoder wrote to, it isn't copied while nothing else references it
+    return converted_image.getvalue()
+
+
+def search_quality(image: Image.Image, preset: str, target_metric: str, target_value: float) -> tuple[bytes, int]:
+    """
+    Binary searches the lowest webp quality, within ADAPTIVE_QUALITY_RANGE, whose output still scores target_value
+    or more in target_metric against the image. Scores are computed on the luma of both, downscaled.
+    Clean digital pages end up at low qualities, noisy scans at high ones.
+
+    Takes about 7 encodes per page. Pages are converted in parallel, so this costs throughput, not latency.
+
+    :param preset: Encoder settings other than the quality are taken from it
+    :return: The webp data and its quality. The top quality if none reaches the target
+    """
+    metric = QUALITY_METRICS[target_metric]
+    reference = luma_plane(image)
+    low, high = ADAPTIVE_QUALITY_RANGE
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _save_webp(image, {**WEBP_PRESETS[preset], "quality": quality})
+        with Image.open(BytesIO(data)) as converted_image:
+            score = metric(reference, luma_plane(converted_image))
+        if score >= target_value:
+            best = data, quality
+            high = quality - 1
+        else:
+            low = quality + 1
+    if best is None:
+        quality = ADAPTIVE_QUALITY_RANGE[1]
+        best = _save_webp(image, {**WEBP_PRESETS[preset], "quality": quality}), quality
+    logger.debug(f"Webp quality {best[1]} reaches {target_metric} {target_value}")
+    return best
+
+
+def _encode_webp(open_zipped_file, preset: str, max_width: int | None, max_height: int | None,
+                 grayscale_tolerance: int | None, target_metric: str = None, target_value: float = None,
+                 crop_tolerance: int = None) -> tuple[bytes, bool, int | None, int]:
+    """
+    :return: The webp data, whether the image was converted to grayscale, the quality found by search_quality
+        (None if it wasn't searched) and the pixels cropped
+    """
+    # TODO: Bulletproof image passed not image
+    cropped_pixels = 0
+    if crop_tolerance is not None:
+        data = open_zipped_file.read()
+        image = Image.open(BytesIO(data))
+        # Cropped first, so the content is what fits in the max size
+        image, cropped_pixels = crop_to_content(data, image, crop_tolerance, max_width, max_height)
+    else:
+        image = Image.open(open_zipped_file)
+    if max_width or max_height:
+        image = fit_to_max_size(image, max_width, max_height)
+    grayscale = False
+    if grayscale_tolerance is not None:
+        image, grayscale = to_grayscale(image, grayscale_tolerance)
+    quality = None
+    if target_metric is not None and not WEBP_PRESETS[preset].get("lossless"):
+        converted, quality = search_quality(image, preset, target_metric, target_value)
+    else:
+        converted = _save_webp(image, WEBP_PRESETS[preset])
+    image.close()
+    logger.debug(f"Successfully converted {'grayscale ' if grayscale else ''}image to webp")
+    return converted, grayscale, quality, cropped_pixels
+
+
+def convertToWebp(open_zipped_file, preset: str = DEFAULT_PRESET, max_width: int = None,
+                  max_height: int = None, grayscale_tolerance: int = None, target_metric: str = None,
+                  target_value: float = None, crop_tolerance: int = None) -> bytes:
+    """
+    :param grayscale_tolerance: If set, grey images are encoded from a single channel (L) image.
+        See CommonLib.ImageAnalysis.is_grayscale
+    :param target_metric: "ssim" or "psnr". If set, the quality is searched for the page, see search_quality
+    :param target_value: Lowest score of target_metric the webp can have
+    :param crop_tolerance: If set, uniform borders are cropped. See CommonLib.ImageAnalysis.content_box
+    """
+    return _encode_webp(open_zipped_file, preset, max_width, max_height, grayscale_tolerance, target_metric,
+                        target_value, crop_tolerance)[0]
+
+
+class ImageEncoder:
+    """
+    An encoder backend. Instances are transforms: they get a page as an open binary file and return the encoded page,
+    or None if it isn't smaller than the original. Picklable, so pages can be encoded in a process pool.
+
+    Subclasses set name, extension, source_formats and cost_per_megapixel and implement encode.
+    """
+    #: Name the encoder is registered under
+    name: str = None
+    #: Extension of the encoded pages. None if pages keep their name
+    extension: str | None = None
+    #: Extensions of the pages the encoder can process
+    source_formats: tuple[str, ...] = SOURCE_FORMATS
+    #: Approximate CPU seconds it takes to encode a megapixel
+    cost_per_megapixel: float = 0.0
+    #: Whether encoded pages are worth keeping in the page cache. Not for encoders faster than a cache lookup
+    cacheable: bool = True
+
+    def __init__(self, min_saving: float = 0.0):
+        """
+        :param min_saving: Pages whose output isn't at least this fraction smaller (0.1 = 10%) are kept as they are
+        """
+        self.min_saving = min_saving
+
+    @property
+    def settings(self) -> str:
+        """
+        Describes everything the output depends on, other than the source page. Pages are cached under it
+        """
+        options = ";".join(f"{key}={value}" for key, value in sorted(vars(self).items()))
+        return f"{self.name};{options};pillow={PIL.__version__}"
+
+    def output_name(self, name: str) -> str:
+        """
+        The name a page gets once encoded
+        """
+        if self.extension is None:
+            return name
+        return re.sub(r"(?i)\.[a-z]+$", self.extension, name)
+
+    def estimate_cost(self, pixels: int) -> float:
+        """
+        :return: Approximate CPU seconds it takes to encode pages adding up to this many pixels
+        """
+        return self.cost_per_megapixel * pixels / 1_000_000
+
+    def encode(self, data: bytes) -> bytes | TransformOutput | None:
+        """
+        :return: The encoded page. None to keep the original
+        """
+        raise NotImplementedError
+
+    def __call__(self, open_file) -> TransformOutput | None:
+        original = open_file.read()
+        output = self.encode(original)
+        if not isinstance(output, TransformOutput):
+            output = TransformOutput(output)
+        if output.data is None or len(output.data) >= len(original) \
+                or len(output.data) > len(original) * (1 - self.min_saving):
+            logger.debug(f"[{self.name}] Output is not smaller than the original ({len(original)} bytes). "
+                         f"Keeping original")
+            return None
+        return output
+
+
+ENCODERS: dict[str, type[ImageEncoder]] = {}
+
+
+def register_encoder(encoder_class: type[ImageEncoder]) -> type[ImageEncoder]:
+    """
+    Makes the encoder available by name. Can be used as a class decorator
+    """
+    ENCODERS[encoder_class.name] = encoder_class
+    return encoder_class
+
+
+def get_encoder(name: str, **options) -> ImageEncoder:
+    """
+    :param options: Passed to the encoder class
+    :raises ValueError: If no encoder is registered under that name
+    """
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder '{name}'. Available: {', '.join(ENCODERS)}")
+    return ENCODERS[name](**options)
+
+
+@register_encoder
+class WebpEncoder(ImageEncoder):
+    name = "webp"
+    extension = ".webp"
+
+    def __init__(self, min_saving: float = 0.0, preset: str = DEFAULT_PRESET, max_width: int = None,
+                 max_height: int = None, grayscale_tolerance: int = None,
+                 target_metric: str = None, target_value: float = None, crop_tolerance: int = None):
+        """
+        :param preset: One of WEBP_PRESETS
+        :param max_width: Bigger images are downscaled, keeping the aspect ratio. None for no limit
+        :param max_height: Bigger images are downscaled, keeping the aspect ratio. None for no limit
+        :param grayscale_tolerance: If set, grey pages are encoded from a single channel image, see
+            CommonLib.ImageAnalysis.is_grayscale. None to skip the detection
+        :param target_metric: "ssim" or "psnr". If set, the quality of every page is searched, see search_quality
+        :param target_value: Lowest score of target_metric a converted page can have
+        :param crop_tolerance: Uniform borders are cropped, see CommonLib.ImageAnalysis.content_box.
+            None to keep the whole page
+        """
+        super().__init__(min_saving)
+        if preset not in WEBP_PRESETS:
+            raise ValueError(f"Unknown webp preset '{preset}'. Available: {', '.join(WEBP_PRESETS)}")
+        if target_metric is not None and target_metric not in QUALITY_METRICS:
+            raise ValueError(f"Unknown quality metric '{target_metric}'. Available: {', '.join(QUALITY_METRICS)}")
+        self.preset = preset
+        self.max_width = max_width
+        self.max_height = max_height
+        self.grayscale_tolerance = grayscale_tolerance
+        self.target_metric = target_metric
+        self.target_value = target_value
+        self.crop_tolerance = crop_tolerance
+
+    @property
+    def settings(self) -> str:
+        return (f"webp;{WEBP_PRESETS[self.preset]};min_saving={self.min_saving};"
+                f"max_size={self.max_width}x{self.max_height};grayscale={self.grayscale_tolerance};"
+                f"pillow={PIL.__version__}"
+                + (f";target={self.target_metric}>={self.target_value};range={ADAPTIVE_QUALITY_RANGE}"
+                   if self.target_metric else "")
+                + (f";crop={self.crop_tolerance}" if self.crop_tolerance is not None else ""))
+
+    @property
+    def cost_per_megapixel(self) -> float:
+        searched = self.target_metric is not None and not WEBP_PRESETS[self.preset].get("lossless")
+        return _WEBP_COSTS[self.preset] * (_QUALITY_SEARCH_PASSES if searched else 1)
+
+    def encode(self, data: bytes) -> TransformOutput:
+        """
+        :return: The webp data, with a "grayscale" stat if the page was grey, "quality_searches"/"quality_sum"
+            stats if its quality was searched and "cropped"/"cropped_pixels" stats if its borders were cropped
+        """
+        converted, grayscale, quality, cropped_pixels = _encode_webp(
+            BytesIO(data), self.preset, self.max_width, self.max_height, self.grayscale_tolerance,
+            self.target_metric, self.target_value, self.crop_tolerance)
+        stats = {"grayscale": 1} if grayscale else {}
+        if quality is not None:
+            stats.update(quality_searches=1, quality_sum=quality)
+        if cropped_pixels:
+            stats.update(cropped=1, cropped_pixels=cropped_pixels)
+        return TransformOutput(converted, stats)
+
+
+@register_encoder
+class JpegEncoder(ImageEncoder):
+    """
+    Re-encodes JPEGs as optimised progressive JPEGs. With quality "keep" the quantisation tables and subsampling
+    of the page are reused, so the image is not degraded any further. Only the orientation of the exif is kept
+    """
+    name = "jpeg"
+    source_formats = (".jpeg", ".jpg")
+    cost_per_megapixel = 0.04
+
+    def __init__(self, min_saving: float = 0.0, quality: int | str = "keep"):
+        super().__init__(min_saving)
+        self.quality = quality
+
+    def encode(self, data: bytes) -> bytes | None:
+        with Image.open(BytesIO(data)) as image:
+            if image.format != "JPEG":
+                return None
+            converted_image = BytesIO()
+            image.save(converted_image, format="JPEG", quality=self.quality, optimize=True, progressive=True,
+                       icc_profile=image.info.get("icc_profile"), exif=orientation_exif(image))
+        return converted_image.getvalue()
+
+
+@register_encoder
+class PngEncoder(ImageEncoder):
+    """
+    Recompresses PNGs at the highest zlib level. Pages with 256 colours or less are stored with a palette.
+    Lossless: the pixels don't change. Only the orientation of the exif is kept
+    """
+    name = "png"
+    source_formats = (".png",)
+    cost_per_megapixel = 1.1
+
+    def encode(self, data: bytes) -> bytes | None:
+        with Image.open(BytesIO(data)) as image:
+            if image.format != "PNG":
+                return None
+            icc_profile = image.info.get("icc_profile")
+            exif = orientation_exif(image)
+            if image.mode == "RGB":
+                colours = image.getcolors(256)
+                if colours is not None:
+                    palette = Image.new("P", (1, 1))
+                    palette.putpalette([channel for _, colour in colours for channel in colour])
+                    # Every colour is in the palette, so every pixel is mapped to its own colour
+                    image = image.quantize(palette=palette, dither=Image.NONE)
+            converted_image = BytesIO()
+            image.save(converted_image, format="PNG", optimize=True, compress_level=9, icc_profile=icc_profile,
+                       exif=exif)
+        return converted_image.getvalue()
+
+
+@register_encoder
+class StripMetadataEncoder(ImageEncoder):
+    """
+    Only removes the metadata of the pages, see CommonLib.ImageMetadata. The image data is not decoded,
+    so the pixels stay bit-exact. The removed bytes are counted in the "metadata_bytes" stat
+    """
+    name = "strip"
+    cost_per_megapixel = 0.001
+    cacheable = False
+
+    def __init__(self, min_saving: float = 0.0, keep_icc: bool = True):
+        super().__init__(min_saving)
+        self.keep_icc = keep_icc
+
+    def encode(self, data: bytes) -> TransformOutput | None:
+        try:
+            stripped = strip_metadata(data, self.keep_icc)
+        except UnsupportedImage as e:
+            logger.debug(f"[{self.name}] Page kept as it is: {e}")
+            return None
+        return TransformOutput(stripped, {"metadata_bytes": len(data) - len(stripped)})
+
+
+@dataclass
+class EncoderEstimate:
+    encoder: ImageEncoder
+    pages: int = 0
+    original_size: int = 0
+    output_size: int = 0
+    megapixels: float = 0.0
+
+    @property
+    def saving(self) -> float:
+        """
+        Fraction of the size of the pages the encoder saves
+        """
+        return 1 - self.output_size / self.original_size if self.original_size else 0.0
+
+    @property
+    def cost(self) -> float:
+        return self.encoder.estimate_cost(int(self.megapixels * 1_000_000))
+
+
+def estimate_encoders(pages: list[bytes], encoders: Iterable[ImageEncoder]) -> list[EncoderEstimate]:
+    """
+    Encodes a sample of pages with every encoder. Pages an encoder can't make smaller count at their original size
+    """
+    estimates = []
+    for encoder in encoders:
+        estimate = EncoderEstimate(encoder)
+        for page in pages:
+            with Image.open(BytesIO(page)) as image:
+                estimate.megapixels += image.width * image.height / 1_000_000
+            output = encoder(BytesIO(page))
+            estimate.pages += 1
+            estimate.original_size += len(page)
+            estimate.output_size += len(page) if output is None else len(output.data)
+        estimates.append(estimate)
+    return estimates
+
+
+def cheapest_encoder(pages: list[bytes], encoders: Iterable[ImageEncoder],
+                     min_saving: float = 0.0) -> ImageEncoder | None:
+    """
+    Picks, with a sample of the pages of a library, the encoder with the lowest cost that saves at least min_saving
+
+    :return: None if no encoder saves enough
+    """
+    estimates = [estimate for estimate in estimate_encoders(pages, encoders)
+                 if estimate.saving > 0 and estimate.saving >= min_saving]
+    return min(estimates, key=lambda estimate: estimate.cost).encoder if estimates else None
+
+
+def encoder_step(encoder: ImageEncoder, source_formats: tuple[str, ...] = None, cache_path: str = None,
+                 cache_max_bytes: int = DEFAULT_CACHE_BYTES) -> PlanStep:
+    """
+    Pages the encoder can process are encoded with it, everything else is kept as it is.
+    Cover backups (OldCover_name.ext.bak) are encoded too and keep their backup name.
+    Pages already in the format the encoder writes are skipped.
+
+    :param source_formats: Extensions of the pages to encode. Defaults to the ones the encoder supports
+    :param cache_path: Page cache file (see CommonLib.PageCache). Pages already encoded with the same settings
+        are taken from it. None to disable the cache. Ignored for encoders that aren't cacheable
+    :param cache_max_bytes: Size of the page cache
+    """
+    source_formats = encoder.source_formats if source_formats is None else source_formats
+    transform = encoder
+    if cache_path is not None and encoder.cacheable:
+        transform = CachedTransform(encoder, encoder.settings, cache_path, cache_max_bytes)
+
+    def step(entries: list[PlannedEntry]) -> list[PlannedEntry]:
+        for entry in entries:
+            if encoder.extension and entry.name.lower().endswith(encoder.extension):
+                continue
+            prefix, name, suffix = "", entry.name, ""
+            backup = re.match(r"^(OldCover_)(.*)(\.bak)$", entry.name)
+            if backup:
+                prefix, name, suffix = backup.groups()
+            file_format = re.findall(r"(?i)\.[a-z]+$", name)
+            if not file_format:  # File doesn't have an extension, it is a folder. skip it
+                continue
+            if file_format[0] in source_formats:
+                entry.transforms.append(transform)
+                entry.fallback_name = entry.fallback_name or entry.name
+                entry.name = prefix + encoder.output_name(name) + suffix
+                entry.compress_type = zipfile.ZIP_STORED
+        return entries
+
+    return step
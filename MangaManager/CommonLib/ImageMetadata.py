@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import logging
+import struct
+import zlib
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOI = b"\xff\xd8"
+
+_APP0, _APP1, _APP2, _APP14, _APP15 = 0xE0, 0xE1, 0xE2, 0xEE, 0xEF
+_COM, _SOS = 0xFE, 0xDA
+# Markers without a length field
+_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+# Text, time and exif chunks. Nothing the image is rendered with, except the exif orientation
+_PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"tIME", b"eXIf"}
+_EXIF_HEADER = b"Exif\0\0"
+_ORIENTATION_TAG = 0x0112
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def _orientation(data: bytes) -> int | None:
+    """
+    Pages rotated through the exif orientation would be displayed rotated without it
+
+    :return: None if the exif can't be read
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            return image.getexif().get(_ORIENTATION_TAG, 1)
+    except Exception:
+        return None
+
+
+def _png_orientation(payload: bytes) -> int | None:
+    """
+    Same as _orientation for the payload of a PNG eXIf chunk, read without decoding the image
+    """
+    try:
+        exif = Image.Exif()
+        exif.load(payload)
+        return exif.get(_ORIENTATION_TAG, 1)
+    except Exception:
+        return None
+
+
+def _orientation_exif(orientation: int) -> bytes:
+    """
+    An exif that only holds the orientation, without the "Exif" header
+    """
+    exif = Image.Exif()
+    exif[_ORIENTATION_TAG] = orientation
+    payload = exif.tobytes()
+    return payload[len(_EXIF_HEADER):] if payload.startswith(_EXIF_HEADER) else payload
+
+
+def _orientation_segment(orientation: int) -> bytes:
+    """
+    An APP1 segment with an exif that only holds the orientation. Replaces exif blocks (and their thumbnails)
+    that can't be removed because they rotate the page
+    """
+    payload = _EXIF_HEADER + _orientation_exif(orientation)
+    return struct.pack(">BBH", 0xFF, _APP1, len(payload) + 2) + payload
+
+
+def _orientation_chunk(orientation: int) -> bytes:
+    """
+    The PNG counterpart of _orientation_segment: an eXIf chunk that only holds the orientation
+    """
+    payload = _orientation_exif(orientation)
+    return struct.pack(">I4s", len(payload), b"eXIf") + payload + struct.pack(">I", zlib.crc32(b"eXIf" + payload))
+
+
+def orientation_exif(image: Image.Image) -> bytes:
+    """
+    An exif that only holds the orientation of the image, for pages that are re-encoded.
+    Without it, rotated pages would be displayed sideways
+
+    :return: Empty if the image is not rotated
+    """
+    orientation = image.getexif().get(_ORIENTATION_TAG, 1)
+    return _EXIF_HEADER + _orientation_exif(orientation) if orientation != 1 else b""
+
+
+def strip_jpeg_metadata(data: bytes, keep_icc: bool = True) -> bytes:
+    """
+    Removes the exif (with its thumbnail), XMP, IPTC and comment segments of a JPEG without decoding it.
+    The JFIF and Adobe segments, the tables and the compressed image data are copied byte for byte.
+    If the exif rotates the image, it is replaced by one that only holds the orientation.
+
+    :param keep_icc: Keep the ICC profile (APP2) the colours are displayed with
+    """
+    if not data.startswith(JPEG_SOI):
+        raise UnsupportedImage("Not a JPEG file")
+    exif_seen = False
+    output = [JPEG_SOI]
+    position = 2
+    while position < len(data):
+        if data[position] != 0xFF:
+            raise UnsupportedImage(f"Expected a marker at {position}")
+        marker = data[position + 1]
+        if marker == 0xFF:  # Fill byte
+            position += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            output.append(data[position:position + 2])
+            position += 2
+            continue
+        if position + 4 > len(data):
+            raise UnsupportedImage("Truncated JPEG segment")
+        length = struct.unpack(">H", data[position + 2:position + 4])[0]
+        end = position + 2 + length
+        if marker == _SOS:
+            # The compressed image data follows until the end of the file
+            output.append(data[position:])
+            break
+        segment = data[position:end]
+        keep = True
+        if marker == _COM:
+            keep = False
+        elif _APP1 <= marker <= _APP15 and marker != _APP14:
+            if marker == _APP2 and segment[4:16] == b"ICC_PROFILE\0":
+                keep = keep_icc
+            elif marker == _APP1 and segment[4:10] == b"Exif\0\0":
+                keep = False
+                if not exif_seen:
+                    exif_seen = True
+                    orientation = _orientation(data)
+                    if orientation is None:
+                        keep = True
+                    elif orientation != 1:
+                        output.append(_orientation_segment(orientation))
+            else:
+                keep = False
+        if keep:
+            output.append(segment)
+        position = end
+    return b"".join(output)
+
+
+def strip_png_metadata(data: bytes, keep_icc: bool = True) -> bytes:
+    """
+    Removes the text, time and exif chunks of a PNG. Every other chunk is copied byte for byte.
+    If the exif rotates the image, it is replaced by one that only holds the orientation.
+
+    :param keep_icc: Keep the ICC profile (iCCP chunk) the colours are displayed with
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise UnsupportedImage("Not a PNG file")
+    dropped = _PNG_METADATA_CHUNKS if keep_icc else _PNG_METADATA_CHUNKS | {b"iCCP"}
+    output = [PNG_SIGNATURE]
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        if position + 8 > len(data):
+            raise UnsupportedImage("Truncated PNG chunk")
+        length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+        end = position + 12 + length
+        if chunk_type == b"eXIf":
+            orientation = _png_orientation(data[position + 8:end - 4])
+            if orientation is None:
+                output.append(data[position:end])
+            elif orientation != 1:
+                output.append(_orientation_chunk(orientation))
+        elif chunk_type not in dropped:
+            output.append(data[position:end])
+        position = end
+        if chunk_type == b"IEND":
+            break
+    return b"".join(output)
+
+
+def strip_metadata(data: bytes, keep_icc: bool = True) -> bytes:
+    """
+    Removes the metadata of a JPEG or PNG image, leaving the image data untouched
+
+    :raises UnsupportedImage: For other formats
+    """
+    if data.startswith(JPEG_SOI):
+        return strip_jpeg_metadata(data, keep_icc)
+    if data.startswith(PNG_SIGNATURE):
+        return strip_png_metadata(data, keep_icc)
+    raise UnsupportedImage("Only JPEG and PNG images are supported")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+
+if __name__ == '__main__':
+    import pathlib
+    import sys
+
+    sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from CommonLib.ZipCentralDirectory import read_central_directory, read_entry
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    total_files INTEGER NOT NULL,
+    page_count INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    comicinfo_xml BLOB,
+    fields TEXT NOT NULL,
+    indexed_at REAL NOT NULL
+)
+"""
+# Bumped when the schema changes. The index only holds what can be read again from the archives, so an index made
+# with another schema is emptied
+_SCHEMA_VERSION = 2
+
+
+def get_default_index_path() -> str:
+    """
+    The index lives in the user cache folder. MANGAMANAGER_INDEX overrides it.
+    """
+    if os.environ.get("MANGAMANAGER_INDEX"):
+        return os.environ["MANGAMANAGER_INDEX"]
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "MangaManager", "library_index.sqlite3")
+
+
+def parse_comicinfo_fields(comicinfo_xml: bytes | None) -> dict[str, str]:
+    """
+    Flattens the simple fields of a ComicInfo.xml into a dictionary. Pages and malformed files are ignored.
+    """
+    if not comicinfo_xml:
+        return {}
+    try:
+        root = ET.fromstring(comicinfo_xml)
+    except ET.ParseError:
+        return {}
+    return {child.tag: child.text.strip() for child in root if child.text and child.text.strip()}
+
+
+@dataclass
+class IndexedArchive:
+    path: str
+    size: int
+    mtime_ns: int
+    total_files: int
+    page_count: int
+    total_size: int
+    comicinfo_xml: bytes | None
+    fields: dict[str, str] = field(default_factory=dict)
+
+
+def scan_archive(path: str) -> IndexedArchive:
+    """
+    Reads the central directory and ComicInfo.xml of the archive. Does not touch the index database,
+    so it can run in worker processes.
+    """
+    path = os.path.abspath(path)
+    with open(path, 'rb') as fp:
+        stat = os.fstat(fp.fileno())
+        summary = read_central_directory(path, ("ComicInfo.xml",), fp)
+        comicinfo_xml = None
+        if "ComicInfo.xml" in summary.entries:
+            comicinfo_xml = read_entry(fp, summary.entries["ComicInfo.xml"])
+    return IndexedArchive(path, stat.st_size, stat.st_mtime_ns, summary.total_files, summary.page_count,
+                          summary.total_size, comicinfo_xml, parse_comicinfo_fields(comicinfo_xml))
+
+
+class LibraryIndex:
+    """
+    Persistent index of the archives in the library, keyed by path, size and mtime.
+
+    Archives are only opened when they are not in the index or when they changed since they were indexed.
+    """
+
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or get_default_index_path()
+        if self.index_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.index_path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS archives")
+            self._connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self._connection.execute(_SCHEMA)
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, path: str) -> IndexedArchive | None:
+        """
+        Returns the indexed data if the archive did not change since it was indexed. None otherwise
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._connection.execute(
+            "SELECT size, mtime_ns, total_files, page_count, total_size, comicinfo_xml, fields "
+            "FROM archives WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return IndexedArchive(path, row[0], row[1], row[2], row[3], row[4], row[5], json.loads(row[6]))
+
+    def read(self, path: str) -> IndexedArchive:
+        """
+        Returns the index data for the archive. The archive is read and indexed if it's missing or outdated.
+        """
+        indexed = self.get(path)
+        if indexed is not None:
+            self.hits += 1
+            return indexed
+        self.misses += 1
+        logger.debug(f"[LibraryIndex] Indexing '{path}'")
+        return self.store(path)
+
+    def store(self, path: str) -> IndexedArchive:
+        """
+        Reads the central directory and ComicInfo.xml of the archive and saves them in the index
+        """
+        return self.put(scan_archive(path))
+
+    def put(self, indexed: IndexedArchive) -> IndexedArchive:
+        """
+        Saves an archive scanned elsewhere (i.e. in a worker process) in the index
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (indexed.path, indexed.size, indexed.mtime_ns, indexed.total_files, indexed.page_count,
+             indexed.total_size, indexed.comicinfo_xml, json.dumps(indexed.fields), time.time()))
+        self._connection.commit()
+        return indexed
+
+    def invalidate(self, path: str):
+        self._connection.execute("DELETE FROM archives WHERE path = ?", (os.path.abspath(path),))
+        self._connection.commit()
+
+    def prune(self) -> int:
+        """
+        Removes the archives that no longer exist on disk
+
+        :return: Number of removed archives
+        """
+        missing = [(path,) for (path,) in self._connection.execute("SELECT path FROM archives")
+                   if not os.path.exists(path)]
+        self._connection.executemany("DELETE FROM archives WHERE path = ?", missing)
+        self._connection.commit()
+        return len(missing)
+
+
+def open_library_index(index_path: str = None) -> LibraryIndex | None:
+    """
+    Opens the library index. If it can't be opened (read only home, corrupted file) tools work without it.
+    """
+    try:
+        return LibraryIndex(index_path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Library index could not be opened. Archives will be read every time: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Builds or refreshes the library index")
+    parser.add_argument("-r", help="Select recursive files", action="store_true", dest="recursive")
+    parser.add_argument("--index", help="Path to the index file", default=None, metavar="<path>")
+    parser.add_argument("path", metavar="<path>", help="The path where the files are.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - LibraryIndex - %(levelname)s - %(message)s')
+
+    glob_method = pathlib.Path(args.path).rglob if args.recursive else pathlib.Path(args.path).glob
+    library_index = LibraryIndex(args.index)
+    start_time = time.time()
+    for cbz_path in glob_method("*.cbz"):
+        try:
+            library_index.read(str(cbz_path))
+        except Exception as e:
+            logger.error(f"Failed to index '{cbz_path}': {e}")
+    logger.info(f"Indexed {library_index.hits + library_index.misses} files in {time.time() - start_time:.1f}s. "
+                f"{library_index.misses} were read, {library_index.hits} were up to date. "
+                f"{library_index.prune()} missing files removed from the index")
+    library_index.close()
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from io import BytesIO
+from typing import IO, Callable
+
+from CommonLib.ZipRewriter import TransformOutput
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Every process checks the size of the cache once every this many new pages
+_EVICT_EVERY = 64
+# Pages used again are only marked as used if they weren't for this many seconds. Reading a page stays a read,
+# instead of a write every process would wait on. The eviction order is as coarse
+_TOUCH_AFTER = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    data BLOB,
+    stats TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+_LAST_USED_INDEX = "CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)"
+
+
+def get_default_cache_path() -> str:
+    """
+    The cache lives in the user cache folder. MANGAMANAGER_PAGE_CACHE overrides it.
+    """
+    if os.environ.get("MANGAMANAGER_PAGE_CACHE"):
+        return os.environ["MANGAMANAGER_PAGE_CACHE"]
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "MangaManager", "page_cache.sqlite3")
+
+
+def page_key(data: bytes, settings: str) -> str:
+    """
+    The same source bytes encoded with the same settings always give the same output
+    """
+    return hashlib.blake2b(settings.encode() + b"\0" + data, digest_size=20).hexdigest()
+
+
+class PageCache:
+    """
+    Persistent cache of encoded pages, keyed by the hash of the source page and the encoder settings.
+
+    Once the stored pages exceed max_bytes, the least recently used ones are removed.
+    Several processes can use the same cache file at once.
+    """
+
+    def __init__(self, cache_path: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_path = cache_path or get_default_cache_path()
+        self.max_bytes = max_bytes
+        if self.cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.cache_path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(_SCHEMA)
+        self._connection.execute(_LAST_USED_INDEX)
+        self._connection.commit()
+        self._puts = 0
+
+    def close(self):
+        self._connection.close()
+
+    def get(self, key: str) -> TransformOutput | None:
+        """
+        :return: The cached output. Its data is None if the encoder chose to keep the original. None if not cached
+        """
+        row = self._connection.execute("SELECT data, stats, last_used FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[2] < now - _TOUCH_AFTER:
+            self._connection.execute("UPDATE pages SET last_used = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+        return TransformOutput(row[0], json.loads(row[1]))
+
+    def put(self, key: str, output: TransformOutput):
+        size = len(output.data) if output.data is not None else 0
+        self._connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                 (key, output.data, json.dumps(output.stats), size, time.time()))
+        self._connection.commit()
+        self._puts += 1
+        if self._puts % _EVICT_EVERY == 0:
+            self.evict()
+
+    def total_size(self) -> int:
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used pages until the cache fits in max_bytes
+
+        :return: Number of removed pages
+        """
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM pages ORDER BY last_used"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        self._connection.executemany("DELETE FROM pages WHERE key = ?", keys)
+        self._connection.commit()
+        logger.debug(f"[PageCache] Evicted {len(keys)} pages")
+        return len(keys)
+
+
+_local = threading.local()
+
+
+def _get_process_cache(cache_path: str, max_bytes: int) -> PageCache | None:
+    """
+    sqlite connections can't be shared between threads or inherited by forked processes,
+    so every thread of every process opens its own
+    """
+    caches = _local.__dict__.setdefault("caches", {})
+    key = (os.getpid(), cache_path)
+    if key not in caches:
+        try:
+            caches[key] = PageCache(cache_path, max_bytes)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Page cache could not be opened. Pages will be encoded every time: {e}")
+            caches[key] = None
+    return caches[key]
+
+
+class CachedTransform:
+    """
+    Wraps a transform so pages already encoded with the same settings are taken from the cache.
+    Picklable as long as function is, so it can run in a process pool.
+
+    Adds "cache_hits" or "cache_misses" to the stats of the output.
+    """
+
+    def __init__(self, function: Callable[[IO[bytes]], bytes | TransformOutput | None], settings: str,
+                 cache_path: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param settings: Describes everything, other than the source bytes, the output depends on
+        """
+        self.function = function
+        self.settings = settings
+        self.cache_path = cache_path or get_default_cache_path()
+        self.max_bytes = max_bytes
+
+    def __call__(self, open_file) -> TransformOutput:
+        data = open_file.read()
+        key = page_key(data, self.settings)
+        cache = _get_process_cache(self.cache_path, self.max_bytes)
+        cached = None
+        if cache is not None:
+            try:
+                cached = cache.get(key)
+            except sqlite3.Error as e:
+                logger.warning(f"Page could not be read from the cache: {e}")
+        if cached is not None:
+            return TransformOutput(cached.data, {**cached.stats, "cache_hits": 1})
+        output = self.function(BytesIO(data))
+        if not isinstance(output, TransformOutput):
+            output = TransformOutput(output)
+        if cache is not None:
+            try:
+                cache.put(key, output)
+            except sqlite3.Error as e:
+                logger.warning(f"Page could not be saved in the cache: {e}")
+        return TransformOutput(output.data, {**output.stats, "cache_misses": 1})
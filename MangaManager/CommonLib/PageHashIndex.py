@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Iterable
+
+from PIL import Image
+
+if __name__ == '__main__':
+    import pathlib
+    import sys
+
+    sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from CommonLib.ArchiveJobPlanner import JobPlanner, PlannedEntry, PlanStep
+from CommonLib.ImageAnalysis import HASH_SIDE, ahash, dhash, hamming_distance, is_blank
+from CommonLib.ZipCentralDirectory import image_extensions
+
+logger = logging.getLogger(__name__)
+
+# Pages whose dHashes differ in this many bits at most are the same page (re-encoded, resized, slightly edited)
+DEFAULT_MAX_DISTANCE = 3
+# A page in this many archives of the same folder is a filler page (credits, recruitment ads...)
+DEFAULT_MIN_SERIES_ARCHIVES = 3
+# Archives sharing this fraction of their pages are the same release uploaded twice
+DEFAULT_REUPLOAD_RATIO = 0.8
+# JPEGs are decoded straight at a reduced scale, at least this big. Enough for the hashes and the blank detection
+_DECODE_SIZE = 256
+# dHashes are split in this many bands to find similar pages. Two hashes within DEFAULT_MAX_DISTANCE bits
+# have at least one band in common
+_BANDS = 4
+_BAND_BITS = HASH_SIDE * HASH_SIDE // _BANDS
+# Band values shared by more pages are not compared pair by pair, their pages are only grouped when their dHashes
+# are equal. Bands of flat areas (white backgrounds) are the same in most of the pages of a library
+_MAX_BAND_PAGES = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hashed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    archive TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fallback_name TEXT NOT NULL,
+    dhash INTEGER NOT NULL,
+    ahash INTEGER NOT NULL,
+    blank INTEGER NOT NULL,
+    band0 INTEGER NOT NULL,
+    band1 INTEGER NOT NULL,
+    band2 INTEGER NOT NULL,
+    band3 INTEGER NOT NULL,
+    PRIMARY KEY (archive, name)
+);
+""" + "".join(f"CREATE INDEX IF NOT EXISTS pages_band{band} ON pages (band{band});\n" for band in range(_BANDS))
+
+
+def get_default_hash_index_path() -> str:
+    """
+    The index lives in the user cache folder. MANGAMANAGER_PAGE_HASHES overrides it.
+    """
+    if os.environ.get("MANGAMANAGER_PAGE_HASHES"):
+        return os.environ["MANGAMANAGER_PAGE_HASHES"]
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "MangaManager", "page_hashes.sqlite3")
+
+
+def is_page(name: str) -> bool:
+    return name.lower().encode().endswith(image_extensions) and not name.startswith("OldCover_")
+
+
+@dataclass
+class PageHash:
+    dhash: int
+    ahash: int
+    blank: bool
+
+
+def hash_page(data: bytes) -> PageHash:
+    """
+    :raises Exception: If the page is not an image Pillow can read
+    """
+    with Image.open(BytesIO(data)) as image:
+        image.draft("L", (_DECODE_SIZE, _DECODE_SIZE))  # Only JPEGs have a draft mode
+        grey = image.convert("L")
+    return PageHash(dhash(grey), ahash(grey), is_blank(grey))
+
+
+def hash_archive(path: str) -> dict[str, PageHash]:
+    """
+    Hashes every page of the archive. Does not touch the index database, so it can run in worker processes.
+    Pages that can't be read are left out
+    """
+    hashes = {}
+    with zipfile.ZipFile(path, 'r') as zin:
+        for name in zin.namelist():
+            if not is_page(name):
+                continue
+            try:
+                hashes[name] = hash_page(zin.read(name))
+            except Exception as e:
+                logger.debug(f"[PageHashIndex] '{name}' of '{path}' could not be hashed: {e}")
+    return hashes
+
+
+def _to_signed(value: int) -> int:
+    """
+    sqlite integers are signed 64 bit
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+def _bands(value: int) -> list[int]:
+    mask = (1 << _BAND_BITS) - 1
+    return [(value >> (band * _BAND_BITS)) & mask for band in range(_BANDS)]
+
+
+_INSERT_PAGE = "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _page_row(path: str, name: str, page_hash: PageHash, fallback_name: str = None) -> tuple:
+    return (path, name, fallback_name or name, _to_signed(page_hash.dhash), _to_signed(page_hash.ahash),
+            page_hash.blank, *_bands(page_hash.dhash))
+
+
+class PageHashIndex:
+    """
+    Persistent index of the perceptual hashes of the pages in the library, to find blank, duplicated and repeated
+    pages. Archives are keyed by path, size and mtime, and only hashed again when they change.
+
+    Pages can be hashed from any thread, and from worker processes while their archive is rewritten (see hash_step).
+    """
+
+    def __init__(self, index_path: str = None):
+        self.index_path = index_path or get_default_hash_index_path()
+        if self.index_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def is_current(self, path: str) -> bool:
+        """
+        Whether the archive was hashed as it is on disk now
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns FROM archives WHERE path = ?", (path,)).fetchone()
+        stat = os.stat(path)
+        return row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns)
+
+    def put_page(self, path: str, name: str, page_hash: PageHash, fallback_name: str = None):
+        """
+        :param fallback_name: Name the page gets if the rewrite it is hashed in keeps it as it was
+        """
+        with self._lock:
+            self._connection.execute(_INSERT_PAGE, _page_row(os.path.abspath(path), name, page_hash, fallback_name))
+            self._connection.commit()
+
+    def store(self, path: str, hashes: dict[str, PageHash]):
+        """
+        Replaces the pages of the archive with the ones hashed elsewhere (i.e. in a worker process)
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._connection.execute("DELETE FROM pages WHERE archive = ?", (path,))
+            self._connection.executemany(_INSERT_PAGE, (_page_row(path, name, page_hash)
+                                                        for name, page_hash in hashes.items()))
+            self._connection.commit()
+        self._record(path)
+
+    def sync_archive(self, path: str) -> int:
+        """
+        Brings the pages of the archive in line with its content once it has been rewritten. Pages hashed during the
+        rewrite get the name they were written under, pages that are no longer in it are removed and pages that were
+        not hashed yet are read and hashed.
+
+        :return: Number of pages read
+        """
+        path = os.path.abspath(path)
+        with zipfile.ZipFile(path, 'r') as zin:
+            names = [name for name in zin.namelist() if is_page(name)]
+            page_names = set(names)
+            with self._lock:
+                rows = self._connection.execute("SELECT name, fallback_name FROM pages WHERE archive = ?",
+                                                (path,)).fetchall()
+                hashed = set()
+                for name, fallback_name in rows:
+                    if name in page_names:
+                        hashed.add(name)
+                    elif fallback_name in page_names and fallback_name not in hashed:
+                        # The rewrite kept the page as it was
+                        self._connection.execute("UPDATE OR REPLACE pages SET name = fallback_name "
+                                                 "WHERE archive = ? AND name = ?", (path, name))
+                        hashed.add(fallback_name)
+                    else:
+                        self._connection.execute("DELETE FROM pages WHERE archive = ? AND name = ?", (path, name))
+                self._connection.execute("UPDATE pages SET fallback_name = name WHERE archive = ?", (path,))
+                self._connection.commit()
+            missing = [name for name in names if name not in hashed]
+            for name in missing:
+                try:
+                    self.put_page(path, name, hash_page(zin.read(name)))
+                except Exception as e:
+                    logger.debug(f"[PageHashIndex] '{name}' of '{path}' could not be hashed: {e}")
+        self._record(path)
+        return len(missing)
+
+    def _record(self, path: str):
+        stat = os.stat(path)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)",
+                                     (path, stat.st_size, stat.st_mtime_ns, time.time()))
+            self._connection.commit()
+
+    def update(self, paths: Iterable[str], max_workers: int = None) -> int:
+        """
+        Hashes the archives that are not in the index or changed since they were hashed, in a process pool
+
+        :return: Number of archives hashed
+        """
+        pending = [os.path.abspath(path) for path in paths if not self.is_current(path)]
+        if not pending:
+            return 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for path, hashes in zip(pending, executor.map(hash_archive, pending)):
+                self.store(path, hashes)
+        return len(pending)
+
+    def prune(self) -> int:
+        """
+        Removes the archives that no longer exist on disk
+
+        :return: Number of removed archives
+        """
+        with self._lock:
+            missing = [(path,) for (path,) in self._connection.execute("SELECT path FROM archives")
+                       if not os.path.exists(path)]
+            self._connection.executemany("DELETE FROM archives WHERE path = ?", missing)
+            self._connection.executemany("DELETE FROM pages WHERE archive = ?", missing)
+            self._connection.commit()
+        return len(missing)
+
+    def report(self, max_distance: int = DEFAULT_MAX_DISTANCE, min_series_archives: int = DEFAULT_MIN_SERIES_ARCHIVES,
+               reupload_ratio: float = DEFAULT_REUPLOAD_RATIO) -> DuplicateReport:
+        """
+        Finds the blank pages, the pages duplicated in an archive, the pages repeated in the archives of a folder
+        (series) and the archives uploaded twice.
+
+        Similar pages are found through the dHash bands they share, so the library is never compared page by page.
+        Bands of flat areas and bands shared by more than _MAX_BAND_PAGES pages are skipped, pages that only share
+        those are only found if their dHashes are equal.
+
+        :param max_distance: Pages whose dHashes differ in more bits are different pages. Similar pages are only
+            guaranteed to be found up to _BANDS - 1 bits
+        :param min_series_archives: Number of archives of a folder a page has to be in to be a filler page
+        :param reupload_ratio: Fraction of their pages two archives have to share to be the same release
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT rowid, archive, name, dhash, blank FROM pages").fetchall()
+            pairs = set()
+            for band in range(_BANDS):
+                pairs.update(self._connection.execute(
+                    f"SELECT a.rowid, b.rowid FROM pages a JOIN pages b ON a.band{band} = b.band{band} "
+                    f"AND a.rowid < b.rowid WHERE NOT a.blank AND NOT b.blank AND a.band{band} NOT IN (0, ?) "
+                    f"AND a.band{band} NOT IN (SELECT band{band} FROM pages WHERE NOT blank "
+                    f"GROUP BY band{band} HAVING COUNT(*) > ?)", ((1 << _BAND_BITS) - 1, _MAX_BAND_PAGES)))
+        pages = {rowid: (archive, name) for rowid, archive, name, _, _ in rows}
+        hashes = {rowid: _to_unsigned(value) for rowid, _, _, value, _ in rows}
+        report = DuplicateReport(blank=sorted(pages[rowid] for rowid, *_, blank in rows if blank))
+        page_counts = defaultdict(int)
+        for _, archive, *_, blank in rows:
+            if not blank:
+                page_counts[archive] += 1
+
+        groups = _DisjointSet()
+        same_hash = {}
+        for rowid, *_, blank in rows:
+            if not blank:
+                groups.union(rowid, same_hash.setdefault(hashes[rowid], rowid))
+        for first, second in pairs:
+            if hamming_distance(hashes[first], hashes[second]) <= max_distance:
+                groups.union(first, second)
+        similar = [sorted(pages[rowid] for rowid in group) for group in groups.groups()]
+
+        # Pages of both archives that have a similar page in the other one
+        shared = defaultdict(int)
+        for group in similar:
+            group_counts = defaultdict(int)
+            for archive, _ in group:
+                group_counts[archive] += 1
+            archives = sorted(group_counts)
+            for i, first in enumerate(archives):
+                for second in archives[i + 1:]:
+                    shared[first, second] += min(group_counts[first], group_counts[second])
+        releases = _DisjointSet()
+        for (first, second), count in shared.items():
+            ratio = count / min(page_counts[first], page_counts[second])
+            if ratio >= reupload_ratio:
+                report.reuploads.append((first, second, ratio))
+                releases.union(first, second)
+        report.reuploads.sort()
+
+        for group in similar:
+            by_archive = defaultdict(list)
+            for archive, name in group:
+                by_archive[archive].append(name)
+            report.in_archive.extend([(archive, name) for name in names] for archive, names in by_archive.items()
+                                     if len(names) > 1)
+            by_folder = defaultdict(set)
+            for archive in by_archive:
+                by_folder[os.path.dirname(archive)].add(releases.find(archive))
+            repeated = [(archive, name) for archive, name in group
+                        if len(by_folder[os.path.dirname(archive)]) >= min_series_archives]
+            if repeated:
+                report.series_repeats.append(repeated)
+        report.in_archive.sort()
+        report.series_repeats.sort()
+        return report
+
+
+class _DisjointSet:
+    def __init__(self):
+        self._parents = {}
+
+    def find(self, item):
+        self._parents.setdefault(item, item)
+        while self._parents[item] != item:
+            self._parents[item] = self._parents[self._parents[item]]
+            item = self._parents[item]
+        return item
+
+    def union(self, first, second):
+        self._parents[self.find(first)] = self.find(second)
+
+    def groups(self) -> list[list]:
+        groups = defaultdict(list)
+        for item in self._parents:
+            groups[self.find(item)].append(item)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+@dataclass
+class DuplicateReport:
+    """
+    Pages are listed as (archive path, page name)
+    """
+    #: Pages with a single colour
+    blank: list[tuple[str, str]] = field(default_factory=list)
+    #: Groups of similar pages of the same archive
+    in_archive: list[list[tuple[str, str]]] = field(default_factory=list)
+    #: Groups of similar pages found in several archives of the same folder. The archives of a release uploaded
+    #: twice count once
+    series_repeats: list[list[tuple[str, str]]] = field(default_factory=list)
+    #: Archives sharing most of their pages, with the fraction of the pages of the smallest one they share
+    reuploads: list[tuple[str, str, float]] = field(default_factory=list)
+
+    def filler_pages(self) -> dict[str, set[str]]:
+        """
+        The pages that can be dropped: blank pages, every copy but the first of the pages duplicated in an archive
+        and the pages repeated across a series
+
+        :return: The names of the pages to drop, by archive
+        """
+        filler = defaultdict(set)
+        for archive, name in self.blank:
+            filler[archive].add(name)
+        for group in self.in_archive:
+            for archive, name in group[1:]:
+                filler[archive].add(name)
+        for group in self.series_repeats:
+            for archive, name in group:
+                filler[archive].add(name)
+        return dict(filler)
+
+    def summary(self) -> str:
+        return (f"{len(self.blank)} blank pages, "
+                f"{sum(map(len, self.in_archive))} pages duplicated in their archive ({len(self.in_archive)} groups), "
+                f"{sum(map(len, self.series_repeats))} pages repeated across a series "
+                f"({len(self.series_repeats)} groups), "
+                f"{len(self.reuploads)} releases uploaded twice - "
+                f"{sum(len(names) for names in self.filler_pages().values())} filler pages")
+
+    def details(self) -> str:
+        lines = [f"Blank: {os.path.basename(archive)}/{name}" for archive, name in self.blank]
+        lines += ["Duplicated: " + ", ".join(f"{os.path.basename(archive)}/{name}" for archive, name in group)
+                  for group in self.in_archive]
+        lines += ["Repeated: " + ", ".join(f"{os.path.basename(archive)}/{name}" for archive, name in group)
+                  for group in self.series_repeats]
+        lines += [f"Uploaded twice: {first} - {second} ({ratio:.0%} of the pages)"
+                  for first, second, ratio in self.reuploads]
+        return "\n".join(lines)
+
+
+_local = threading.local()
+
+
+def _get_process_index(index_path: str) -> PageHashIndex | None:
+    """
+    sqlite connections can't be inherited by forked processes, so every thread of every process opens its own
+    """
+    indexes = _local.__dict__.setdefault("indexes", {})
+    key = (os.getpid(), index_path)
+    if key not in indexes:
+        try:
+            indexes[key] = PageHashIndex(index_path)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Page hash index could not be opened. Pages will be hashed after the rewrite: {e}")
+            indexes[key] = None
+    return indexes[key]
+
+
+class PageHasher:
+    """
+    Transform that hashes the page it gets into the index and leaves it as it is.
+    Picklable, so it runs in the process pool next to the encoder, on the data it is sent anyway.
+    """
+
+    def __init__(self, index_path: str, path: str, name: str, fallback_name: str):
+        """
+        :param path: The archive the page is in
+        :param name: Name the page is written under
+        :param fallback_name: Name the page is written under if the other transforms leave it as it was
+        """
+        self.index_path = index_path
+        self.path = path
+        self.name = name
+        self.fallback_name = fallback_name
+
+    def __call__(self, open_file) -> None:
+        try:
+            page_hash = hash_page(open_file.read())
+        except Exception as e:
+            logger.debug(f"[PageHashIndex] '{self.name}' of '{self.path}' could not be hashed: {e}")
+            return None
+        index = _get_process_index(self.index_path)
+        if index is not None:
+            try:
+                index.put_page(self.path, self.name, page_hash, self.fallback_name)
+            except sqlite3.Error as e:
+                logger.warning(f"Page hash could not be saved in the index: {e}")
+        return None
+
+
+def hash_step(index_path: str, path: str) -> PlanStep:
+    """
+    Pages read and transformed by the previous steps (i.e. converted to webp) are hashed while they are,
+    the hashes of the rest are added once the archive is rewritten by PageHashIndex.sync_archive.
+    Must be the last step of the archive, so the names the pages are written under are known.
+
+    :param path: The archive the job rewrites
+    """
+    def step(entries: list[PlannedEntry]) -> list[PlannedEntry]:
+        for entry in entries:
+            if entry.source is not None and entry.transforms and is_page(entry.source.filename):
+                entry.transforms.insert(0, PageHasher(index_path, os.path.abspath(path), entry.name,
+                                                      entry.fallback_name or entry.name))
+        return entries
+
+    return step
+
+
+def drop_pages_step(names: Iterable[str]) -> PlanStep:
+    """
+    Removes the pages from the archive, i.e. the filler pages of a DuplicateReport
+    """
+    names = set(names)
+
+    def step(entries: list[PlannedEntry]) -> list[PlannedEntry]:
+        return [entry for entry in entries if entry.name not in names]
+
+    return step
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Finds blank, duplicated and repeated pages in the library")
+    parser.add_argument("-r", help="Select recursive files", action="store_true", dest="recursive")
+    parser.add_argument("--index", help="Path to the index file", default=None, metavar="<path>")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE, dest="max_distance",
+                        help="Pages whose hashes differ in more bits are different pages. "
+                             f"Default: {DEFAULT_MAX_DISTANCE}")
+    parser.add_argument("--min-series-archives", type=int, default=DEFAULT_MIN_SERIES_ARCHIVES,
+                        dest="min_series_archives",
+                        help="Number of archives of a folder a page has to be in to be a filler page. "
+                             f"Default: {DEFAULT_MIN_SERIES_ARCHIVES}")
+    parser.add_argument("--drop-filler", action="store_true", dest="drop_filler",
+                        help="Remove the blank, duplicated and repeated pages from the archives")
+    parser.add_argument("path", metavar="<path>", help="The path where the files are.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - PageHashIndex - %(levelname)s - %(message)s')
+
+    glob_method = pathlib.Path(args.path).rglob if args.recursive else pathlib.Path(args.path).glob
+    page_index = PageHashIndex(args.index)
+    start_time = time.time()
+    hashed = page_index.update(str(cbz_path) for cbz_path in glob_method("*.cbz"))
+    logger.info(f"Hashed {hashed} files in {time.time() - start_time:.1f}s. "
+                f"{page_index.prune()} missing files removed from the index")
+    duplicate_report = page_index.report(args.max_distance, args.min_series_archives)
+    print(duplicate_report.details())
+    print(duplicate_report.summary())
+    if args.drop_filler and duplicate_report.filler_pages():
+        input("\n\n\nPress enter to drop the filler pages")
+        planner = JobPlanner()
+        for archive_path, page_names in duplicate_report.filler_pages().items():
+            planner.add_step(archive_path, drop_pages_step(page_names))
+            planner.job(archive_path).on_done(functools.partial(page_index.sync_archive, archive_path))
+        _, errors = planner.run()
+        for job, e in errors:
+            logger.error(f"Error dropping the filler pages of '{job.path}': {e}", exc_info=e)
+    page_index.close()
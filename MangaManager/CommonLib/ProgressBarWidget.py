@@ -1,4 +1,6 @@
 import logging
+import queue
+import threading
 import time
 import tkinter as tk
 from tkinter import ttk
@@ -9,6 +11,10 @@ logger = logging.getLogger(__name__)
 
 
 class ProgressBar:
+    """
+    increaseCount and increaseError can be called from any thread. Counts are queued and applied,
+    and the widget redrawn, only when updatePB runs in the main thread.
+    """
     def __init__(self, UI_isInitialized: bool, pb_root: tk.Frame, total: int):
 
         self.UI_isInitialized = UI_isInitialized
@@ -18,6 +24,8 @@ class ProgressBar:
         self.start_time = time.time()
         self.processed_counter = 0
         self.processed_errors = 0
+        self.processed_unchanged = 0
+        self._pending_updates = queue.Queue()
         if not UI_isInitialized:
             return
 
@@ -61,15 +69,42 @@ class ProgressBar:
             f"Estimated time: {get_estimated_time(self.start_time, self.processed_counter, total)}")
 
     def increaseCount(self):
-        self.processed_counter += 1
-        self.updatePB()
+        self._pending_updates.put((1, 0, 0))
+        self._update_if_main_thread()
 
     def increaseError(self):
-        self.processed_counter += 1
-        self.processed_errors += 1
-        self.updatePB()
+        self._pending_updates.put((1, 1, 0))
+        self._update_if_main_thread()
+
+    def increaseUnchanged(self):
+        """
+        Marks a processed file as left untouched. Counted on top of increaseCount, not instead of it
+        """
+        self._pending_updates.put((0, 0, 1))
+        self._update_if_main_thread()
+
+    def _update_if_main_thread(self):
+        if threading.current_thread() is threading.main_thread():
+            self.updatePB()
+
+    def _apply_pending_updates(self):
+        while True:
+            try:
+                processed, errors, unchanged = self._pending_updates.get_nowait()
+            except queue.Empty:
+                return
+            self.processed_counter += processed
+            self.processed_errors += errors
+            self.processed_unchanged += unchanged
 
     def updatePB(self):
+        """
+        Tkinter widgets can't be touched from worker threads, calls from them are ignored.
+        When the whole batch runs in a worker thread, the main thread has to call it (i.e. polling with after())
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self._apply_pending_updates()
         if self.UI_isInitialized:
             self.pb_root.update()
             percentage = ((self.processed_counter + self.processed_errors) / self.total) * 100
@@ -77,6 +112,7 @@ class ProgressBar:
                                  text='{:g} %'.format(round(percentage, 2)))  # update label
             self.pb['value'] = percentage
         self.label_progress_text.set(
-            f"Processed: {(self.processed_counter + self.processed_errors)}/{self.total} files - {self.processed_errors} errors\n"
+            f"Processed: {(self.processed_counter + self.processed_errors)}/{self.total} files - {self.processed_errors} errors"
+            f"{f' - {self.processed_unchanged} unchanged' if self.processed_unchanged else ''}\n"
             f"Elapsed time  : {get_elapsed_time(self.start_time)}\n"
             f"Estimated time: {get_estimated_time(self.start_time, self.processed_counter, self.total)}")
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from typing import Iterable
+
+from CommonLib.ZipCentralDirectory import central_directory_hash
+from CommonLib.ZipRewriter import TEMP_PREFIX
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = ".MangaManager-journal.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    output_hash TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    finished_at REAL NOT NULL
+)
+"""
+
+
+def get_journal_path(folder: str) -> str:
+    """
+    The journal is kept in the library folder, so it survives as long as the library does (i.e. container restarts)
+    """
+    return os.path.join(folder, JOURNAL_NAME)
+
+
+class RunJournal:
+    """
+    Records the archives a bulk run has finished, so an interrupted run can be resumed.
+
+    An archive is finished if it still has the size, mtime and central directory it had when it was recorded
+    and the run uses the same settings. Archives are recorded as they finish, from any thread.
+    """
+
+    def __init__(self, journal_path: str, settings: str = "", resume: bool = False):
+        """
+        :param settings: Describes the conversion. Archives finished with other settings are done again
+        :param resume: Keep the archives recorded by the previous run. Otherwise the journal starts empty
+        """
+        self.journal_path = journal_path
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(_SCHEMA)
+        if not resume:
+            self._connection.execute("DELETE FROM archives")
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def is_done(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._connection.execute("SELECT size, mtime_ns, output_hash, settings FROM archives WHERE path = ?",
+                                           (path,)).fetchone()
+        if row is None or row[3] != self.settings:
+            return False
+        try:
+            stat = os.stat(path)
+            return (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns) and row[2] == central_directory_hash(path)
+        except (OSError, zipfile.BadZipFile):
+            return False
+
+    def pending(self, paths: Iterable[str]) -> list[str]:
+        """
+        :return: The paths that were not finished yet, in the same order
+        """
+        return [path for path in paths if not self.is_done(path)]
+
+    def record(self, path: str):
+        """
+        Marks the archive as finished, as it is on disk now
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        output_hash = central_directory_hash(path)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)",
+                                     (path, stat.st_size, stat.st_mtime_ns, output_hash, self.settings, time.time()))
+            self._connection.commit()
+
+
+def cleanup_orphaned_temp_files(folders: Iterable[str]) -> list[str]:
+    """
+    Removes the temp files left in the folders by rewrites that were interrupted (killed process, container restart).
+    Only files named with TEMP_PREFIX are removed, other files of the folders are never touched.
+
+    Must not run while other rewrites are in progress in the folders.
+
+    :return: The removed files
+    """
+    removed = []
+    for folder in set(os.path.abspath(folder) for folder in folders):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if not name.startswith(TEMP_PREFIX) or not os.path.isfile(path):
+                continue
+            os.remove(path)
+            logger.info(f"Removed orphaned temp file '{path}'")
+            removed.append(path)
+    return removed
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import logging
+import os
+import pathlib
+import tempfile
+
+from CommonLib.ZipRewriter import TEMP_PREFIX
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SUFFIX = ".ComicInfo.xml"
+
+
+def get_sidecar_path(cbz_path: str) -> str:
+    """
+    The sidecar of 'Volume 01.cbz' is 'Volume 01.cbz.ComicInfo.xml', next to the archive
+    """
+    return f"{cbz_path}{SIDECAR_SUFFIX}"
+
+
+def get_archive_path(sidecar_path: str) -> str:
+    return sidecar_path[:-len(SIDECAR_SUFFIX)]
+
+
+def read_sidecar(cbz_path: str) -> bytes | None:
+    """
+    :return: The pending ComicInfo.xml of the archive. None if there's no sidecar
+    """
+    try:
+        with open(get_sidecar_path(cbz_path), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_sidecar(cbz_path: str, comicinfo_xml: bytes):
+    """
+    Writes the ComicInfo.xml next to the archive. The archive itself is not touched.
+    The sidecar is written to a tempfile first, so a half written sidecar is never left behind.
+    """
+    sidecar_path = get_sidecar_path(cbz_path)
+    tmpfd, tmpname = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(os.path.abspath(sidecar_path)))
+    try:
+        with os.fdopen(tmpfd, 'wb') as f:
+            f.write(comicinfo_xml)
+        os.replace(tmpname, sidecar_path)
+    except Exception:
+        os.remove(tmpname)
+        raise
+    logger.debug(f"[Sidecar] Saved '{sidecar_path}'")
+
+
+def remove_sidecar(cbz_path: str) -> bool:
+    """
+    :return: True if there was a sidecar to remove
+    """
+    try:
+        os.remove(get_sidecar_path(cbz_path))
+    except FileNotFoundError:
+        return False
+    logger.debug(f"[Sidecar] Removed '{get_sidecar_path(cbz_path)}'")
+    return True
+
+
+def find_pending_sidecars(path: str, recursive: bool = False) -> list[str]:
+    """
+    Finds the archives that have a pending sidecar
+
+    :param path: A folder or an archive
+    :param recursive: Look into subfolders too
+    :return: The path of the archives, not the sidecars. Sidecars whose archive is missing are skipped
+    """
+    if os.path.isfile(path):
+        return [path] if os.path.exists(get_sidecar_path(path)) else []
+    glob_method = pathlib.Path(path).rglob if recursive else pathlib.Path(path).glob
+    archives = []
+    for sidecar_path in sorted(glob_method(f"*{SIDECAR_SUFFIX}")):
+        cbz_path = get_archive_path(str(sidecar_path))
+        if os.path.isfile(cbz_path):
+            archives.append(cbz_path)
+        else:
+            logger.warning(f"[Sidecar] Archive for '{sidecar_path}' not found. Skipping")
+    return archives
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import logging
 import os
+import random
 import re
-import tempfile
 import time
+import threading
 import zipfile
+from dataclasses import dataclass
 from io import BytesIO
 
 from PIL import Image
@@ -15,8 +19,28 @@ from PIL import Image
 logger = logging.getLogger(__name__)
 
 supportedFormats = (".png", ".jpeg", ".jpg")
+# --encoder value that picks the encoder on a sample of the pages
+AUTO_ENCODER = "auto"
+# Milliseconds between progress bar redraws while the UI waits for the conversion thread
+_POLL_INTERVAL_MS = 100
+
 if __name__ == '__main__':
     import argparse
+    import pathlib
+    import sys
+
+    sys.path.append(str(pathlib.Path(__file__).parent.parent))  # CommonLib is needed when launched as a script
+    from CommonLib.ArchiveJobPlanner import PlanStep
+    from CommonLib.BatchProcessor import DEFAULT_WORKERS
+    from CommonLib.ImageAnalysis import DEFAULT_CROP_TOLERANCE, DEFAULT_GRAYSCALE_TOLERANCE
+    from CommonLib.ImageEncoders import DEFAULT_PRESET, ENCODERS, WEBP_PRESETS, \
+        ImageEncoder, StripMetadataEncoder, WebpEncoder, cheapest_encoder, convertToWebp, encoder_step, \
+        estimate_encoders, get_encoder
+    from CommonLib.PageCache import DEFAULT_MAX_BYTES as DEFAULT_CACHE_BYTES, get_default_cache_path
+    from CommonLib.PageHashIndex import PageHashIndex, get_default_hash_index_path
+    from CommonLib.RunJournal import JOURNAL_NAME, RunJournal, cleanup_orphaned_temp_files, get_journal_path
+    from CommonLib.ConversionScheduler import DEFAULT_MAX_INFLIGHT_BYTES, DEFAULT_PAGE_WORKERS, MB, \
+        ConversionReport, ConversionScheduler
 
 
     def is_dir_path(path):
@@ -66,10 +90,15 @@ if __name__ == '__main__':
 
 else:
     from CommonLib.HelperFunctions import get_estimated_time, get_elapsed_time
+    from CommonLib.ArchiveJobPlanner import PlanStep
+    from CommonLib.ConversionScheduler import ConversionScheduler
+    from CommonLib.ImageEncoders import DEFAULT_PRESET, WEBP_PRESETS, WebpEncoder, cheapest_encoder, convertToWebp, \
+        encoder_step
+    from CommonLib.PageCache import DEFAULT_MAX_BYTES as DEFAULT_CACHE_BYTES
+    from CommonLib.ProgressBarWidget import ProgressBar
     import tkinter as tk
 
     from tkinter import filedialog
-    from tkinter.ttk import Style, Progressbar
 
 current_time = time.time()
 
@@ -114,15 +143,103 @@ def getNewWebpFormatName(currentName: str) -> str:
         return file_name + ".webp"
 
 
-def convertToWebp(open_zipped_file) -> bytes:
-    # TODO: Bulletproof image passed not image
-    image = Image.open(open_zipped_file)
-    # print(image.size, image.mode, len(image.getdata()))
-    converted_image = BytesIO()
-    image.save(converted_image, format="webp")
-    image.close()
-    logger.debug("Successfully converted image to webp")
-    return converted_image.getvalue()
+def webp_step(supported_formats=supportedFormats, min_saving: float = 0.0, preset: str = DEFAULT_PRESET,
+              max_width: int = None, max_height: int = None,
+              grayscale_tolerance: int = None, cache_path: str = None,
+              cache_max_bytes: int = DEFAULT_CACHE_BYTES, target_metric: str = None,
+              target_value: float = None, crop_tolerance: int = None) -> PlanStep:
+    """
+    Supported images are converted to webp, everything else is kept as it is. See CommonLib.ImageEncoders.WebpEncoder
+    and CommonLib.ImageEncoders.encoder_step
+    """
+    encoder = WebpEncoder(min_saving, preset, max_width, max_height, grayscale_tolerance, target_metric, target_value,
+                          crop_tolerance)
+    return encoder_step(encoder, supported_formats, cache_path, cache_max_bytes)
+
+
+@dataclass
+class PresetBenchmark:
+    preset: str
+    pages: int = 0
+    original_size: int = 0
+    output_size: int = 0
+    encode_time: float = 0.0
+    decode_time: float = 0.0
+
+    def __str__(self):
+        ratio = self.output_size / self.original_size * 100 if self.original_size else 0
+        return (f"{self.preset:<10} {self.encode_time:>9.2f}s {self.output_size / 1024:>12.1f} KB "
+                f"{ratio:>7.1f}% {self.decode_time:>9.2f}s")
+
+
+def sample_pages(paths: list[str], sample_size: int, supported_formats=supportedFormats,
+                 seed: int = None) -> list[bytes]:
+    """
+    Picks random pages from the archives
+
+    :param sample_size: Number of pages to pick
+    :param seed: Makes the sample reproducible
+    """
+    candidates = []
+    for path in paths:
+        try:
+            with zipfile.ZipFile(path, 'r') as zin:
+                candidates.extend((path, name) for name in zin.namelist()
+                                  if os.path.splitext(name)[1].lower() in supported_formats)
+        except zipfile.BadZipfile as e:
+            logger.warning(f"Skipping '{path}' for the sample: {e}")
+    pages = []
+    for path, name in random.Random(seed).sample(candidates, min(sample_size, len(candidates))):
+        with zipfile.ZipFile(path, 'r') as zin:
+            pages.append(zin.read(name))
+    return pages
+
+
+# Pages the encoders are tried on by --encoder auto. Few, only the order of the costs matters
+AUTO_SAMPLE_SIZE = 20
+# Saving the encoder picked by --encoder auto must reach on the sample. Any metadata would be enough otherwise
+AUTO_MIN_SAVING = 0.1
+
+
+def pick_encoder(paths: list[str], encoders: list[ImageEncoder], sample_size: int = AUTO_SAMPLE_SIZE,
+                 min_saving: float = AUTO_MIN_SAVING, seed: int = 0) -> ImageEncoder:
+    """
+    Picks the encoder with the lowest cost that saves at least min_saving on a random sample of the pages.
+    See CommonLib.ImageEncoders.cheapest_encoder
+
+    :param encoders: The candidates. The first one is picked if none saves enough
+    :param seed: The same archives get the same sample, so a resumed run picks the encoder its journal was made with
+    """
+    source_formats = tuple({extension for encoder in encoders for extension in encoder.source_formats})
+    pages = sample_pages(paths, sample_size, source_formats, seed)
+    encoder = cheapest_encoder(pages, encoders, min_saving) or encoders[0]
+    logger.info(f"Picked the {encoder.name} encoder with {len(pages)} sample pages")
+    return encoder
+
+
+def benchmark_presets(pages: list[bytes], presets: list[str] = None) -> list[PresetBenchmark]:
+    """
+    Encodes the pages with every preset and measures the encode time, output size and time to decode the output
+
+    :param presets: Names of the presets to measure. Defaults to all of them
+    """
+    results = []
+    for preset in presets or WEBP_PRESETS:
+        result = PresetBenchmark(preset)
+        for page in pages:
+            start_time = time.perf_counter()
+            converted = convertToWebp(BytesIO(page), preset)
+            result.encode_time += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            with Image.open(BytesIO(converted)) as image:
+                image.load()
+            result.decode_time += time.perf_counter() - start_time
+            result.pages += 1
+            result.original_size += len(page)
+            result.output_size += len(converted)
+        logger.info(f"[Benchmark] {result}")
+        results.append(result)
+    return results
 
 
 from threading import Timer
@@ -130,72 +247,150 @@ from threading import Timer
 if __name__ == '__main__':
 
     class AppCLI:
-        def __init__(self, pathList: list, overrideSupportedFormat=supportedFormats):
-            ...
+        def __init__(self, pathList: list, overrideSupportedFormat=supportedFormats,
+                     scheduler: ConversionScheduler = None, min_saving: float = 0.0, preset: str = DEFAULT_PRESET,
+                     max_width: int = None, max_height: int = None,
+                     grayscale_tolerance: int = None, cache_path: str = None,
+                     cache_max_bytes: int = DEFAULT_CACHE_BYTES, journal_path: str = None, resume: bool = False,
+                     target_metric: str = None, target_value: float = None, encoder: str = WebpEncoder.name,
+                     keep_icc: bool = True, crop_tolerance: int = None, page_index_path: str = None):
+            """
+            :param scheduler: Runs the conversion of every archive. Defaults to one using every core
+            :param min_saving: Fraction of its size a page must save to be converted
+            :param preset: One of WEBP_PRESETS
+            :param max_width: Pages wider than this are downscaled
+            :param max_height: Pages taller than this are downscaled
+            :param grayscale_tolerance: See CommonLib.ImageAnalysis.is_grayscale. None to keep every page in colour
+            :param cache_path: Page cache file. None to encode every page
+            :param cache_max_bytes: Size of the page cache
+            :param journal_path: Finished archives are recorded in this file. None to run without journal
+            :param resume: Skip the archives the journal lists as finished and remove the temp files left behind
+                by the interrupted run
+            :param target_metric: "ssim" or "psnr" to search the quality of every page. None to use the preset's
+            :param target_value: Lowest score of target_metric a converted page can have
+            :param encoder: Name of the encoder in CommonLib.ImageEncoders.ENCODERS. The webp options above
+                only apply to webp
+            :param keep_icc: Keep the ICC profiles of the pages when stripping their metadata (strip encoder)
+            :param crop_tolerance: Crop the uniform borders of the pages before converting them to webp.
+                See CommonLib.ImageAnalysis.content_box. None to keep the whole pages
+            :param page_index_path: Hash the pages into this index while they are converted and report the blank,
+                duplicated and repeated pages. See CommonLib.PageHashIndex. None to skip it
+            """
+            self.scheduler = scheduler or ConversionScheduler()
+            self.min_saving = min_saving
+            self.preset = preset
+            self.max_width = max_width
+            self.max_height = max_height
+            self.grayscale_tolerance = grayscale_tolerance
+            self.cache_path = cache_path
+            self.cache_max_bytes = cache_max_bytes
+            self.journal_path = journal_path
+            self.resume = resume
+            self.target_metric = target_metric
+            self.target_value = target_value
+            self.encoder = encoder
+            self.keep_icc = keep_icc
+            self.crop_tolerance = crop_tolerance
+            self.page_index_path = page_index_path
+            self._counter_lock = threading.Lock()
             self.pathList = [x for x in pathList if x.endswith(".cbz")]
             # print(self.pathList)
             logger.info(f"Loaded file list: \n" + "\n".join(self.pathList))
             self._supported_formats = overrideSupportedFormat
 
-        def iterate_files(self):
+        def iterate_files(self) -> ConversionReport:
             total = len(self.pathList)
             logger.debug("Starting processing of files.")
             if not total:
                 raise FileNotFoundError
-            self.iteration = 1
+            global global_iteration
+            global_iteration = 0
+            encoder = self.get_encoder()
+            # Formats other than the webp defaults may be selected. The other encoders know what they can process
+            source_formats = self._supported_formats if encoder.name == WebpEncoder.name else None
+            if self.resume:
+                cleanup_orphaned_temp_files(os.path.dirname(os.path.abspath(path)) for path in self.pathList)
+            journal = None
+            if self.journal_path is not None:
+                journal = RunJournal(self.journal_path, encoder.settings, resume=self.resume)
+            page_index = None
+            if self.page_index_path is not None:
+                page_index = PageHashIndex(self.page_index_path)
             rt = self.RepeatedTimer(1, total)  # it auto-starts, no need of rt.start()
             try:
                 _printProgressBar(total=total)
-                global global_iteration
-                for i, cbzFilepath in enumerate(self.pathList):
-
-                    global_iteration = i
-                    _printProgressBar(total=total)
-                    logger.debug(f"Processing '{cbzFilepath}'")
-                    self.zipFilePath = cbzFilepath
-                    time.sleep(2)
-                    tmpfd, self._tmpname = tempfile.mkstemp(dir=os.path.dirname(cbzFilepath))
-                    os.close(tmpfd)
-                    try:
-                        self._process(cbzFilepath)
-
-                        os.remove(self.zipFilePath)
-                        os.rename(self._tmpname, self.zipFilePath)
-                        # time.sleep(2)
-                        logger.debug(f"Done processing '{os.path.basename(self.pathList[i])}'")
-                    except zipfile.BadZipfile as e:
-                        logger.error(f"Error processing '{cbzFilepath}': {str(e)}", exc_info=True)
-                        os.remove(self._tmpname)
-                        continue
-                    _printProgressBar(total=total)
+                step = encoder_step(encoder, source_formats, self.cache_path, self.cache_max_bytes)
+                report = self.scheduler.run(self.pathList, [step], progress_bar=self, log_prefix="[WebpConverter]",
+                                            journal=journal, page_index=page_index)
+                duplicate_report = page_index.report() if page_index is not None else None
             finally:
+                if journal is not None:
+                    journal.close()
+                if page_index is not None:
+                    page_index.close()
                 global_iteration = total
                 rt.stop()  # better in a try/finally block to make sure the program ends!
                 _printProgressBar(total=total, last=True)
+            print(report.savings_report())
+            if report.page_qualities:
+                logger.info(f"Webp quality of every page:\n{report.quality_report()}")
+            if duplicate_report is not None:
+                print(duplicate_report.summary())
+            print(report.summary())
             logger.info("Completed processing for all selected files")
-            ...
-
-        def _process(self, file_path):
-            with zipfile.ZipFile(file_path, 'r') as zin:
-                with zipfile.ZipFile(self._tmpname, 'w') as zout:
-                    for zipped_file in zin.infolist():
-                        # logger.debug(f"Processing file {zipped_file.filename}")
-                        file_format = re.findall(r"(?i)\.[a-z]+$", zipped_file.filename)
-                        if file_format:
-                            file_format = file_format[0]
-                        else:  # File doesn't have an extension, it is a folder. skip it
-                            zout.writestr(zipped_file.filename, zin.read(zipped_file.filename))
-                            logger.debug(f"Added '{zipped_file.filename}' to new tempfile. File was not processed")
-                            continue
-                        file_name = zipped_file.filename.replace(file_format, "")
-                        if file_format in self._supported_formats:
-                            with zin.open(zipped_file) as open_zipped_file:
-                                zout.writestr(file_name + ".webp", convertToWebp(open_zipped_file))
-                                logger.debug(f"Converted '{zipped_file.filename}' to webp")
-                                # logger.debug(f"Added '{zipped_file.filename}' to new tempfile")
-                                continue
-                        zout.writestr(zipped_file.filename, zin.read(zipped_file.filename))
-                        logger.debug(f"Added '{zipped_file.filename}' to new tempfile. File was not processed")
+            return report
+
+        def get_encoder(self, name: str = None) -> ImageEncoder:
+            """
+            :param name: Name of the encoder in ENCODERS. Defaults to the selected one. With "auto" it is picked
+                on a sample of the pages (see pick_encoder), webp if none saves enough
+            """
+            name = name or self.encoder
+            if name == AUTO_ENCODER:
+                # Webp first, it is the fallback
+                candidates = [WebpEncoder.name, *(candidate for candidate in ENCODERS if candidate != WebpEncoder.name)]
+                return pick_encoder(self.pathList, [self.get_encoder(candidate) for candidate in candidates],
+                                    min_saving=max(self.min_saving, AUTO_MIN_SAVING))
+            if name == WebpEncoder.name:
+                return WebpEncoder(self.min_saving, self.preset, self.max_width, self.max_height,
+                                   self.grayscale_tolerance, self.target_metric, self.target_value,
+                                   self.crop_tolerance)
+            if name == StripMetadataEncoder.name:
+                return StripMetadataEncoder(self.min_saving, self.keep_icc)
+            return get_encoder(name, min_saving=self.min_saving)
+
+        # Progress callbacks of run_batch, called from the worker threads. The RepeatedTimer does the printing
+        def increaseCount(self):
+            global global_iteration
+            with self._counter_lock:
+                global_iteration += 1
+
+        def increaseError(self):
+            self.increaseCount()
+
+        def updatePB(self):
+            pass
+
+        def benchmark(self, sample_size: int, seed: int = None) -> list[PresetBenchmark]:
+            """
+            Measures every preset, and estimates every encoder, on a sample of the pages.
+            The archives are not modified
+            """
+            pages = sample_pages(self.pathList, sample_size, self._supported_formats, seed)
+            if not pages:
+                raise FileNotFoundError
+            print(f"Benchmarking {len(pages)} pages ({sum(len(page) for page in pages) / 1024:.1f} KB)")
+            print(f"{'Preset':<10} {'Encode':>10} {'Output size':>15} {'Ratio':>8} {'Decode':>10}")
+            results = []
+            for preset in WEBP_PRESETS:
+                results.extend(benchmark_presets(pages, [preset]))
+                print(results[-1])
+            encoders = [self.get_encoder() if name == self.encoder else get_encoder(name) for name in ENCODERS]
+            print(f"\n{'Encoder':<10} {'Output size':>15} {'Ratio':>8} {'Estimated CPU':>15}")
+            for estimate in estimate_encoders(pages, encoders):
+                print(f"{estimate.encoder.name:<10} {estimate.output_size / 1024:>12.1f} KB "
+                      f"{(1 - estimate.saving) * 100:>7.1f}% {estimate.cost:>14.2f}s")
+            return results
 
         class RepeatedTimer(object):
             def __init__(self, interval, total):
@@ -239,6 +434,65 @@ if __name__ == '__main__':
         action="store_const", dest="loglevel", const=logging.DEBUG,
         default=logging.INFO)
     parser.add_argument("-r", help="Select recursive files", action="store_true", dest="recursive")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_PAGE_WORKERS, dest="workers",
+                        help=f"Number of processes pages are converted in. Default: {DEFAULT_PAGE_WORKERS}")
+    parser.add_argument("--archive-workers", type=int, default=DEFAULT_WORKERS, dest="archive_workers",
+                        help=f"Number of archives read and written at the same time. Default: {DEFAULT_WORKERS}")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // MB,
+                        dest="max_inflight_mb",
+                        help="Maximum MB of uncompressed pages being converted at once. "
+                             f"Default: {DEFAULT_MAX_INFLIGHT_BYTES // MB}")
+    parser.add_argument("--encoder", choices=[*ENCODERS, AUTO_ENCODER], default=WebpEncoder.name, dest="encoder",
+                        help=f"How pages are encoded. {AUTO_ENCODER} picks the one with the lowest CPU cost that "
+                             f"saves {AUTO_MIN_SAVING * 100:.0f}%% (or --min-saving if higher) on "
+                             f"{AUTO_SAMPLE_SIZE} random pages. "
+                             f"Default: {WebpEncoder.name}")
+    parser.add_argument("--drop-icc", action="store_true", dest="drop_icc",
+                        help="Also remove the ICC colour profiles when stripping metadata (--encoder "
+                             f"{StripMetadataEncoder.name}). Colours may look different in colour managed readers")
+    parser.add_argument("--preset", choices=list(WEBP_PRESETS), default=DEFAULT_PRESET, dest="preset",
+                        help=f"Webp encoder settings. Default: {DEFAULT_PRESET}")
+    parser.add_argument("--benchmark", type=int, metavar="<pages>", dest="benchmark",
+                        help="Measure every preset on this many random pages of the selected files instead of "
+                             "converting them")
+    parser.add_argument("--max-width", type=int, dest="max_width",
+                        help="Pages wider than this are downscaled, keeping the aspect ratio")
+    parser.add_argument("--max-height", type=int, dest="max_height",
+                        help="Pages taller than this are downscaled, keeping the aspect ratio")
+    parser.add_argument("--grayscale", type=int, nargs="?", const=DEFAULT_GRAYSCALE_TOLERANCE,
+                        metavar="<tolerance>", dest="grayscale_tolerance",
+                        help="Encode the grey pages as grayscale. A pixel is grey if its colour channels differ by "
+                             "the tolerance at most. Every page is analysed, for a small size gain on most libraries. "
+                             f"Default: {DEFAULT_GRAYSCALE_TOLERANCE}")
+    parser.add_argument("--auto-crop", type=int, nargs="?", const=DEFAULT_CROP_TOLERANCE, metavar="<tolerance>",
+                        dest="crop_tolerance",
+                        help="Crop the uniform (i.e. white or black) borders of the pages before converting them. "
+                             "Border pixels can differ from the border colour by the tolerance (0-255). "
+                             f"Default: {DEFAULT_CROP_TOLERANCE}")
+    parser.add_argument("--hash-pages", action="store_true", dest="hash_pages",
+                        help="Hash the pages while they are converted and report the blank, duplicated and "
+                             f"repeated ones. The hashes are kept in {get_default_hash_index_path()} "
+                             "(MANGAMANAGER_PAGE_HASHES overrides it). Run CommonLib/PageHashIndex.py to list or "
+                             "drop them")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        help="Encode every page, even the ones already converted in previous runs")
+    parser.add_argument("--cache-size-mb", type=int, default=DEFAULT_CACHE_BYTES // MB, dest="cache_size_mb",
+                        help=f"Size of the page cache. Default: {DEFAULT_CACHE_BYTES // MB}. The cache file is "
+                             f"{get_default_cache_path()} (MANGAMANAGER_PAGE_CACHE overrides it)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--target-ssim", type=float, metavar="<ssim>", dest="target_ssim",
+                        help="Search the lowest quality of every page whose SSIM against the source stays above "
+                             "this (i.e. 0.98). Overrides the quality of the preset")
+    target.add_argument("--target-psnr", type=float, metavar="<dB>", dest="target_psnr",
+                        help="Search the lowest quality of every page whose PSNR against the source stays above "
+                             "this (i.e. 40). Overrides the quality of the preset")
+    parser.add_argument("--resume", action="store_true", dest="resume",
+                        help="Continue an interrupted run: skip the archives it finished and remove the temp files "
+                             "it left behind")
+    parser.add_argument("--journal", metavar="<file>", dest="journal",
+                        help=f"File where finished archives are recorded. Default: <path>/{JOURNAL_NAME}")
+    parser.add_argument("--min-saving", type=float, default=0, dest="min_saving",
+                        help="Pages are only converted if the webp is at least this percent smaller. Default: 0")
     parser.add_argument("path", metavar="<path>", help="The path where the files are.")
     args = parser.parse_args()
 
@@ -259,9 +513,24 @@ if __name__ == '__main__':
     else:
         matched_files = [str(pathlib.Path(x)) for x in pathlib.Path(args.path).glob('*.cbz')]
         print("\n".join(matched_files))
+    if args.benchmark:
+        AppCLI(matched_files, preset=args.preset, encoder=args.encoder,
+               keep_icc=not args.drop_icc).benchmark(args.benchmark)
+        sys.exit(0)
     input("\n\n\nPress enter to proceed")
 
-    app = AppCLI(matched_files)
+    app = AppCLI(matched_files, scheduler=ConversionScheduler(args.workers, args.archive_workers,
+                                                              args.max_inflight_mb * MB),
+                 min_saving=args.min_saving / 100, preset=args.preset, max_width=args.max_width,
+                 max_height=args.max_height,
+                 grayscale_tolerance=args.grayscale_tolerance,
+                 cache_path=None if args.no_cache else get_default_cache_path(),
+                 cache_max_bytes=args.cache_size_mb * MB,
+                 journal_path=args.journal or get_journal_path(args.path), resume=args.resume,
+                 target_metric="ssim" if args.target_ssim else "psnr" if args.target_psnr else None,
+                 target_value=args.target_ssim or args.target_psnr, encoder=args.encoder,
+                 keep_icc=not args.drop_icc, crop_tolerance=args.crop_tolerance,
+                 page_index_path=get_default_hash_index_path() if args.hash_pages else None)
     app.iterate_files()
     # app = WebpConverter(filenames)
 else:
@@ -278,111 +547,43 @@ else:
                 self.master = master
             self.cbzFilePathList = list[str]()
             self.overrideSupportedFormat = overrideSupportedFormat
+            self.scheduler = ConversionScheduler()
+            self.preset = tk.StringVar(self.master, value=DEFAULT_PRESET)
+            self._worker: threading.Thread | None = None
 
         def start(self):
-
-            if not self.cbzFilePathList:
+            """
+            The conversion runs in a worker thread, so the window keeps redrawing and the progress bar moves
+            """
+            if not self.cbzFilePathList or (self._worker is not None and self._worker.is_alive()):
                 return
             logger.info(f"Loaded file list: \n" + "\n".join(self.cbzFilePathList))
-            total = len(self.cbzFilePathList)
-            # _printProgressBar(0, l, prefix='Progress:', suffix='Complete', length=50)
             logger.debug("Starting processing of files.")
+            progress_bar = ProgressBar(self._initialized_UI, self._progressbar_frame if self._initialized_UI else None,
+                                       len(self.cbzFilePathList))
+            steps = [webp_step(self.overrideSupportedFormat, preset=self.preset.get())]
+            self._worker = threading.Thread(target=self._run_scheduler, daemon=True, name="WebpConverter",
+                                            args=(list(self.cbzFilePathList), steps, progress_bar))
+            self._worker.start()
+            self._poll_worker(progress_bar)
+
+        def _run_scheduler(self, paths: list[str], steps: list[PlanStep], progress_bar: ProgressBar):
+            try:
+                self.scheduler.run(paths, steps, progress_bar=progress_bar, log_prefix="[WebpConverter]")
+            except Exception:
+                logger.exception("[WebpConverter] Conversion failed")
 
-            label_progress_text = tk.StringVar()
-            start_time = time.time()
-            if self._initialized_UI:
-                pb_root = self._progressbar_frame
-
-                style = Style(pb_root)
-                style.layout('text.Horizontal.TProgressbar',
-                             [('Horizontal.Progressbar.trough',
-                               {'children': [
-                                   ('Horizontal.Progressbar.pbar', {
-                                       'side': 'left',
-                                       'sticky': 'ns'
-                                   })],
-                                   'sticky': 'nswe'}),
-                              ('Horizontal.Progressbar.label', {
-                                  'sticky': 'nswe'
-                              })])
-
-                pb = Progressbar(pb_root, length=400, style='text.Horizontal.TProgressbar',
-                                 mode="determinate")  # create progress bar
-                style.configure('text.Horizontal.TProgressbar', text='0 %', anchor='center')
-
-                pb_text = tk.Label(pb_root, textvariable=label_progress_text, anchor=tk.W)
-                logger.info("Initialized progress bar")
-                pb.grid(row=0, column=0, sticky=tk.E + tk.W)
-                pb_text.grid(row=1, column=0, sticky=tk.E)
-
-            processed_counter = 0
-            processed_errors = 0
-            label_progress_text.set(
-                f"Processed: {(processed_counter + processed_errors)}/{total} files - {processed_errors} errors\n"
-                f"Elapsed time  : {get_elapsed_time(start_time)}\n"
-                f"Estimated time: {get_estimated_time(start_time, processed_counter, total)}")
-
-            for i, cbzFilepath in enumerate(self.cbzFilePathList):
-                # print(i)
-                # print(cbzFilepath)
-                # cbzFilepath in cbzFilePathList:
-                logger.info(f"Processing '{cbzFilepath}'")
-                self.zipFilePath = cbzFilepath
-
-                tmpfd, self._tmpname = tempfile.mkstemp(dir=os.path.dirname(self.zipFilePath))
-                os.close(tmpfd)
-
-                self._supported_formats = self.overrideSupportedFormat
-                # logger.info("Processing...")
-                try:
-                    self._process()
-
-                    os.remove(self.zipFilePath)
-                    os.rename(self._tmpname, self.zipFilePath)
-                    logger.info(f"Done")
-                    # time.sleep(2)
-                    logger.info(f"Processed '{os.path.basename(self.cbzFilePathList[i])}'")
-                    processed_counter += 1
-                except zipfile.BadZipfile as e:
-                    logger.error(f"Error processing '{cbzFilepath}': {str(e)}", exc_info=True)
-                    os.remove(self._tmpname)
-                    processed_errors += 1
-                    continue
-                if self._initialized_UI:
-                    pb_root.update()
-                    percentage = ((processed_counter + processed_errors) / total) * 100
-                    style.configure('text.Horizontal.TProgressbar',
-                                    text='{:g} %'.format(round(percentage, 2)))  # update label
-                    pb['value'] = percentage
-                    label_progress_text.set(
-                        f"Processed: {(processed_counter + processed_errors)}/{total} files - {processed_errors} errors\n"
-                        f"Elapsed time: {get_elapsed_time(start_time)}\n"
-                        f"Estimated time: {get_estimated_time(start_time, processed_counter, total)}")
-                # _printProgressBar(i + 1, l, prefix=f"Progress:", suffix='Complete', length=50)
+        def _poll_worker(self, progress_bar: ProgressBar):
+            """
+            Redraws the progress bar from the main thread until the conversion thread is done
+            """
+            finished = not self._worker.is_alive()
+            progress_bar.updatePB()
+            if not finished:
+                self.master.after(_POLL_INTERVAL_MS, self._poll_worker, progress_bar)
+                return
             logger.info("Completed processing for all selected files")
 
-        def _process(self):
-            with zipfile.ZipFile(self.zipFilePath, 'r') as zin:
-                with zipfile.ZipFile(self._tmpname, 'w') as zout:
-                    for zipped_file in zin.infolist():
-                        # logger.debug(f"Processing file {zipped_file.filename}")
-                        file_format = re.findall(r"(?i)\.[a-z]+$", zipped_file.filename)
-                        if file_format:
-                            file_format = file_format[0]
-                        else:  # File doesn't have an extension, it is a folder. skip it
-                            zout.writestr(zipped_file.filename, zin.read(zipped_file.filename))
-                            logger.debug(f"Added '{zipped_file.filename}' to new tempfile. File was not processed")
-                            continue
-                        file_name = zipped_file.filename.replace(file_format, "")
-                        if file_format in self._supported_formats:
-                            with zin.open(zipped_file) as open_zipped_file:
-                                zout.writestr(file_name + ".webp", convertToWebp(open_zipped_file))
-                                logger.debug(f"Converted '{zipped_file.filename}' to webp")
-                                # logger.debug(f"Added '{zipped_file.filename}' to new tempfile")
-                                continue
-                        zout.writestr(zipped_file.filename, zin.read(zipped_file.filename))
-                        logger.debug(f"Added '{zipped_file.filename}' to new tempfile. File was not processed")
-
         def _select_files(self):
 
             self.epubsPathList = list[str]()
@@ -417,15 +618,20 @@ else:
             self.listbox_1 = tk.Listbox(self.frame_1)
             self.listbox_1.configure(activestyle='dotbox', font='{courier} 12 {}', justify='center', width='69')
             self.listbox_1.grid(column='0', row='4')
+            self.frame_preset = tk.Frame(self.frame_1)
+            tk.Label(self.frame_preset, text='Encoder preset:').grid(column='0', row='0')
+            self.optionmenu_preset = tk.OptionMenu(self.frame_preset, self.preset, *WEBP_PRESETS)
+            self.optionmenu_preset.grid(column='1', row='0')
+            self.frame_preset.grid(column='0', row='5')
             self.button_2 = tk.Button(self.frame_1)
             self.button_2.configure(text='Process')
-            self.button_2.grid(column='0', row='5')
+            self.button_2.grid(column='0', row='6')
             self.button_2.configure(command=self.start)
             self.frame_1.configure(height='200', padx='50', pady='50', width='200')
             self.frame_1.grid(column='0', row='0')
             self.frame_1.rowconfigure('2', pad='20')
             self._progressbar_frame = tk.Frame(self.frame_1)
-            self._progressbar_frame.grid(column=0, row=6)
+            self._progressbar_frame.grid(column=0, row=7)
 
             self._initialized_UI = True
 
@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+import struct
+import zipfile
+import zlib
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+image_extensions = (b".jpg", b".jpeg", b".png", b".webp", b".gif", b".bmp")
+
+_EOCD = struct.Struct("<4s4H2LH")
+_ZIP64_EOCD_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+_CENTRAL_DIR = struct.Struct("<4s4B4HL2L5H2L")
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_MAX_EOCD_SEARCH = _EOCD.size + 0xFFFF  # The archive comment can be up to 64KB long
+
+
+@dataclass
+class CentralDirectoryEntry:
+    """
+    The fields of a central directory entry needed to read its data without going through zipfile.ZipInfo
+    """
+    filename: str
+    header_offset: int
+    compress_type: int
+    compress_size: int
+    file_size: int
+    CRC: int
+
+
+@dataclass
+class ArchiveSummary:
+    """
+    What can be known about an archive by reading its central directory only.
+
+    :param total_files: Number of entries in the archive (folders included)
+    :param page_count: Number of entries that are images
+    :param total_size: Sum of the uncompressed size of all entries
+    :param entries: The entries that were looked up by name. Only those found are present
+    """
+    path: str
+    total_files: int = 0
+    page_count: int = 0
+    total_size: int = 0
+    entries: dict[str, CentralDirectoryEntry] = field(default_factory=dict)
+
+
+def _read_end_of_central_directory(fp) -> tuple[int, int, int, int]:
+    """
+    Finds the end of central directory record (zip64 aware)
+
+    :return: (number of entries, central directory size, central directory position, bytes prepended to the archive)
+    """
+    fp.seek(0, os.SEEK_END)
+    file_size = fp.tell()
+    search_size = min(file_size, _MAX_EOCD_SEARCH)
+    fp.seek(file_size - search_size)
+    tail = fp.read(search_size)
+    eocd_index = tail.rfind(zipfile.stringEndArchive)
+    if eocd_index < 0 or len(tail) - eocd_index < _EOCD.size:
+        raise zipfile.BadZipFile("File is not a zip file")
+    eocd_pos = file_size - search_size + eocd_index
+    _, _, _, _, total_entries, cd_size, cd_offset, _ = _EOCD.unpack_from(tail, eocd_index)
+
+    locator_index = eocd_index - _ZIP64_EOCD_LOCATOR.size
+    if locator_index >= 0 and tail[locator_index:locator_index + 4] == zipfile.stringEndArchive64Locator:
+        _, _, zip64_eocd_offset, _ = _ZIP64_EOCD_LOCATOR.unpack_from(tail, locator_index)
+        # The stored offset is wrong if data was prepended to the archive. The record sits right before the locator
+        zip64_eocd_pos = eocd_pos - _ZIP64_EOCD_LOCATOR.size - _ZIP64_EOCD.size
+        fp.seek(zip64_eocd_pos)
+        zip64_eocd = fp.read(_ZIP64_EOCD.size)
+        if len(zip64_eocd) == _ZIP64_EOCD.size and zip64_eocd[:4] == zipfile.stringEndArchive64:
+            _, _, _, _, _, _, _, total_entries, cd_size, cd_offset = _ZIP64_EOCD.unpack(zip64_eocd)
+            eocd_pos = zip64_eocd_pos
+        else:
+            logger.debug(f"Zip64 end of central directory not found at {zip64_eocd_offset}")
+
+    # Bytes before the start of the archive (self-extracting archives, concatenated files)
+    concat = eocd_pos - cd_size - cd_offset
+    if concat < 0:
+        raise zipfile.BadZipFile("Bad offset for central directory")
+    return total_entries, cd_size, cd_offset + concat, concat
+
+
+def _zip64_sizes(extra: bytes, file_size: int, compress_size: int, header_offset: int) -> tuple[int, int, int]:
+    """
+    Reads the values stored in the zip64 extra field. Only the fields set to 0xFFFFFFFF in the record are present.
+    """
+    i = 0
+    while i + 4 <= len(extra):
+        tp, ln = struct.unpack_from("<HH", extra, i)
+        if tp == 0x0001:
+            values = iter(struct.unpack_from(f"<{ln // 8}Q", extra, i + 4))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        i += 4 + ln
+    return file_size, compress_size, header_offset
+
+
+def read_central_directory(path: str, lookup_names: tuple[str, ...] = ("ComicInfo.xml",), fp=None) -> ArchiveSummary:
+    """
+    Reads the central directory of a zip file and returns a summary of it.
+
+    Page data is never read and no ZipInfo objects are created. Only the entries named in lookup_names
+    are kept in the summary so their data can be read afterwards with read_entry().
+
+    :param path: The path to the zip-like file
+    :param lookup_names: The exact names of the entries to look up
+    :param fp: Optional binary file object already opened on path
+    """
+    if fp is None:
+        with open(path, 'rb') as fp:
+            return read_central_directory(path, lookup_names, fp)
+
+    total_entries, cd_size, cd_position, concat = _read_end_of_central_directory(fp)
+    fp.seek(cd_position)
+    central_directory = fp.read(cd_size)
+    wanted = {name.encode("utf-8"): name for name in lookup_names}
+    summary = ArchiveSummary(path, total_files=total_entries)
+
+    pos = 0
+    cd_end = len(central_directory)
+    while pos + _CENTRAL_DIR.size <= cd_end:
+        if central_directory[pos:pos + 4] != zipfile.stringCentralDir:
+            raise zipfile.BadZipFile(f"Bad magic number for central directory in '{path}'")
+        file_size, filename_length, extra_length, comment_length = struct.unpack_from("<L3H", central_directory,
+                                                                                      pos + 24)
+        name_start = pos + _CENTRAL_DIR.size
+        name = central_directory[name_start:name_start + filename_length]
+        if name.lower().endswith(image_extensions):
+            summary.page_count += 1
+        if file_size != 0xFFFFFFFF:
+            summary.total_size += file_size
+        if name in wanted or file_size == 0xFFFFFFFF:
+            record = _CENTRAL_DIR.unpack_from(central_directory, pos)
+            extra = central_directory[name_start + filename_length:name_start + filename_length + extra_length]
+            file_size, compress_size, header_offset = _zip64_sizes(extra, record[11], record[10], record[18])
+            if record[11] == 0xFFFFFFFF:
+                summary.total_size += file_size
+            if name in wanted:
+                summary.entries[wanted[name]] = CentralDirectoryEntry(
+                    filename=wanted[name],
+                    header_offset=header_offset + concat,
+                    compress_type=record[6],
+                    compress_size=compress_size,
+                    file_size=file_size,
+                    CRC=record[9])
+        pos = name_start + filename_length + extra_length + comment_length
+    return summary
+
+
+def read_entry(fp, entry: CentralDirectoryEntry) -> bytes:
+    """
+    Seeks straight to the local header of the entry and returns its decompressed data
+
+    :param fp: Binary file object opened on the archive
+    :param entry: An entry returned in ArchiveSummary.entries
+    """
+    fp.seek(entry.header_offset)
+    header = fp.read(_LOCAL_HEADER.size)
+    if len(header) != _LOCAL_HEADER.size or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for '{entry.filename}'")
+    filename_length, extra_length = struct.unpack_from("<HH", header, 26)
+    fp.seek(filename_length + extra_length, os.SEEK_CUR)
+    compressed = fp.read(entry.compress_size)
+    if entry.compress_type == zipfile.ZIP_STORED:
+        data = compressed
+    elif entry.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(compressed, -15)
+    else:
+        # Less common methods (bzip2, lzma) are left to zipfile
+        with zipfile.ZipFile(fp) as zin:
+            return zin.read(entry.filename)
+    if zlib.crc32(data) != entry.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file '{entry.filename}'")
+    return data
+
+
+def central_directory_hash(path: str) -> str:
+    """
+    Hash of the central directory of the archive. It lists the name, CRC-32 and sizes of every entry,
+    so it identifies the content of the archive without reading all of it
+    """
+    with open(path, 'rb') as fp:
+        _, cd_size, cd_offset, _ = _read_end_of_central_directory(fp)
+        fp.seek(cd_offset)
+        return hashlib.blake2b(fp.read(cd_size), digest_size=20).hexdigest()
@@ -0,0 +1,490 @@
+from __future__ import annotations
+
+import copy
+import logging
+import os
+import pickle
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+import zlib
+from collections import Counter
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import IO, Callable, Iterable, Union
+
+from CommonLib.ByteBudget import ByteBudget
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the temp files archives and sidecars are written to before replacing the original.
+# Only files with it are removed by RunJournal.cleanup_orphaned_temp_files
+TEMP_PREFIX = ".mm-rewrite-"
+_RAW_COPY_CHUNK_SIZE = 1024 * 1024
+_LOCAL_HEADER = struct.Struct(zipfile.structFileHeader)
+# Private members of ZipFile copy_entry_raw writes through. They can change between Python versions,
+# entries are recompressed through the public API if any is missing
+_RAW_COPY_MEMBERS = ("_lock", "_writing", "_writecheck", "start_dir", "_didModify")
+
+
+class EntryOperation:
+    """
+    What happens to an entry of the source archive when it's rewritten
+    """
+
+
+@dataclass
+class Keep(EntryOperation):
+    """
+    The entry is copied as it is. Compressed data is copied, not recompressed
+    """
+
+
+@dataclass
+class Drop(EntryOperation):
+    """
+    The entry is left out of the new archive
+    """
+
+
+@dataclass
+class Rename(EntryOperation):
+    """
+    The entry is copied raw under a different name
+    """
+    new_name: str
+
+
+@dataclass
+class Replace(EntryOperation):
+    """
+    The data of the entry is replaced by new data or by the content of a file on disk
+
+    :param compress_type: Defaults to the compression of the replaced entry
+    """
+    data: bytes = None
+    path: str = None
+    new_name: str = None
+    compress_type: int = None
+
+
+@dataclass
+class Transform(EntryOperation):
+    """
+    The entry is passed to function as an open binary file and the returned bytes are written instead.
+    Only one entry is held in memory at a time.
+    If function returns None the entry is kept as it was and copied raw under fallback_name.
+    function can also return a TransformOutput.
+
+    :param compress_type: Defaults to the compression of the transformed entry
+    :param fallback_name: Name of the entry when it is kept. Defaults to its current name
+    """
+    function: Callable[[IO[bytes]], Union[bytes, None]]
+    new_name: str = None
+    compress_type: int = None
+    fallback_name: str = None
+
+
+@dataclass
+class Add(EntryOperation):
+    """
+    A new entry written at the end of the archive, from data or from a file on disk
+    """
+    name: str
+    data: bytes = None
+    path: str = None
+    compress_type: int = zipfile.ZIP_STORED
+
+
+@dataclass
+class TransformOutput:
+    """
+    Can be returned by a transform, or given as the data of Replace and Add, instead of plain bytes
+    to report how the entry was processed. Stats of every entry are added up in RewriteResult.stats
+
+    :param data: The new content. None keeps the entry as it was
+    :param stats: Counters, i.e. {"grayscale": 1}
+    """
+    data: Union[bytes, None]
+    stats: dict[str, int] = field(default_factory=dict)
+
+
+KEEP = Keep()
+DROP = Drop()
+
+RewritePlan = Union[dict[str, EntryOperation], Callable[[zipfile.ZipInfo], Union[EntryOperation, None]], None]
+
+
+@dataclass
+class RewriteResult:
+    entries_copied: int = 0
+    entries_written: int = 0
+    entries_dropped: int = 0
+    entries_kept: int = 0
+    size_before: int = 0
+    size_after: int = 0
+    stats: Counter = field(default_factory=Counter)
+    #: Stats of every transformed entry with stats, by the name it was written under
+    entry_stats: dict[str, dict[str, int]] = field(default_factory=dict)
+
+
+def _unwrap(data: Union[bytes, TransformOutput, None], result: RewriteResult) -> bytes | None:
+    if isinstance(data, TransformOutput):
+        result.stats.update(data.stats)
+        return data.data
+    return data
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    """
+    Removes the zip64 extra field (id 0x0001) so ZipInfo.FileHeader can write a fresh one if needed
+    """
+    stripped = b""
+    i = 0
+    while i + 4 <= len(extra):
+        tp, ln = struct.unpack("<HH", extra[i:i + 4])
+        if tp != 0x0001:
+            stripped += extra[i:i + 4 + ln]
+        i += 4 + ln
+    return stripped
+
+
+def _entry_data_offset(src_fp, zinfo: zipfile.ZipInfo) -> int:
+    """
+    Position of the compressed data of the entry, right after its local header
+    """
+    src_fp.seek(zinfo.header_offset)
+    header = src_fp.read(_LOCAL_HEADER.size)
+    if len(header) != _LOCAL_HEADER.size or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for '{zinfo.filename}'")
+    filename_length, extra_length = struct.unpack("<HH", header[26:30])
+    return zinfo.header_offset + _LOCAL_HEADER.size + filename_length + extra_length
+
+
+def read_entry_raw(src_fp, zinfo: zipfile.ZipInfo) -> bytes:
+    """
+    Returns the compressed data of the entry as stored in the archive
+    """
+    src_fp.seek(_entry_data_offset(src_fp, zinfo))
+    data = src_fp.read(zinfo.compress_size)
+    if len(data) != zinfo.compress_size:
+        raise zipfile.BadZipFile(f"Truncated data for '{zinfo.filename}'")
+    return data
+
+
+def transform_compressed(compressed: bytes, compress_type: int, crc: int, filename: str,
+                         function: Callable[[IO[bytes]], Union[bytes, None]]) -> bytes | None:
+    """
+    Decompresses the data of an entry and passes it to function. Meant to run in a worker process,
+    so only the compressed bytes travel to the worker and only the result travels back.
+    """
+    if compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(compressed, -15)
+    elif compress_type == zipfile.ZIP_STORED:
+        data = compressed
+    else:
+        raise zipfile.BadZipFile(f"Unsupported compression for '{filename}': {compress_type}")
+    if zlib.crc32(data) != crc:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file '{filename}'")
+    return function(BytesIO(data))
+
+
+def _is_picklable(function) -> bool:
+    try:
+        pickle.dumps(function)
+        return True
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+
+
+def _can_copy_raw(zout: zipfile.ZipFile) -> bool:
+    return all(hasattr(zout, member) for member in _RAW_COPY_MEMBERS) and hasattr(zipfile.ZipInfo, "FileHeader")
+
+
+def copy_entry_raw(src_fp, zout: zipfile.ZipFile, zinfo: zipfile.ZipInfo, arcname: str = None,
+                   zin: zipfile.ZipFile = None):
+    """
+    Copies an entry from one zip file into another without decompressing it.
+    The compressed bytes, CRC and sizes are written as they are in the source archive.
+
+    :param src_fp: A binary file object opened on the source archive
+    :param zout: The ZipFile being written to
+    :param zinfo: The ZipInfo of the entry in the source archive
+    :param arcname: Optional new name for the entry
+    :param zin: The source archive. If this Python's zipfile doesn't have the members the raw copy needs,
+        the entry is decompressed from it and compressed again instead
+    """
+    if not _can_copy_raw(zout):
+        if zin is None:
+            raise NotImplementedError("Entries can't be copied raw with this Python version")
+        new_info = _new_zipinfo(zinfo, arcname or zinfo.filename, None)
+        with zin.open(zinfo) as src, \
+                zout.open(new_info, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dst:
+            shutil.copyfileobj(src, dst, _RAW_COPY_CHUNK_SIZE)
+        return
+    data_offset = _entry_data_offset(src_fp, zinfo)
+
+    new_info = copy.copy(zinfo)
+    if arcname:
+        new_info.filename = arcname
+        new_info.orig_filename = arcname
+    # CRC and sizes are known beforehand, they go in the local header. No data descriptor needed
+    new_info.flag_bits &= ~0x08
+    new_info.extra = _strip_zip64_extra(zinfo.extra)
+    zip64 = new_info.file_size > zipfile.ZIP64_LIMIT or new_info.compress_size > zipfile.ZIP64_LIMIT
+
+    with zout._lock:
+        if zout._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        zout._writecheck(new_info)
+        zout.fp.seek(zout.start_dir)
+        new_info.header_offset = zout.fp.tell()
+        zout._didModify = True
+        zout.fp.write(new_info.FileHeader(zip64))
+        src_fp.seek(data_offset)
+        remaining = zinfo.compress_size
+        while remaining:
+            chunk = src_fp.read(min(_RAW_COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated data for '{zinfo.filename}'")
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+        zout.start_dir = zout.fp.tell()
+        zout.filelist.append(new_info)
+        zout.NameToInfo[new_info.filename] = new_info
+
+
+def _new_zipinfo(source: zipfile.ZipInfo, name: str, compress_type: int | None) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(name, date_time=source.date_time)
+    zinfo.compress_type = source.compress_type if compress_type is None else compress_type
+    zinfo.external_attr = source.external_attr
+    return zinfo
+
+
+def _write_from_path(zout: zipfile.ZipFile, zinfo: zipfile.ZipInfo, path: str):
+    with open(path, 'rb') as src, zout.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, _RAW_COPY_CHUNK_SIZE)
+
+
+def _apply_operation(zin: zipfile.ZipFile, src_fp, zout: zipfile.ZipFile, item: zipfile.ZipInfo,
+                     operation: EntryOperation, result: RewriteResult, log_prefix: str, transformed: Future = None):
+    if isinstance(operation, Keep):
+        copy_entry_raw(src_fp, zout, item, zin=zin)
+        result.entries_copied += 1
+    elif isinstance(operation, Drop):
+        logger.debug(f"{log_prefix} Dropping '{item.filename}'")
+        result.entries_dropped += 1
+    elif isinstance(operation, Rename):
+        copy_entry_raw(src_fp, zout, item, operation.new_name, zin)
+        logger.debug(f"{log_prefix} Renamed '{item.filename}' to '{operation.new_name}'")
+        result.entries_copied += 1
+    elif isinstance(operation, Replace):
+        zinfo = _new_zipinfo(item, operation.new_name or item.filename, operation.compress_type)
+        if operation.path is not None:
+            _write_from_path(zout, zinfo, operation.path)
+        else:
+            zout.writestr(zinfo, _unwrap(operation.data, result))
+        logger.debug(f"{log_prefix} Replaced '{item.filename}' as '{zinfo.filename}'")
+        result.entries_written += 1
+    elif isinstance(operation, Transform):
+        if transformed is not None:
+            data = transformed.result()
+        else:
+            with zin.open(item) as open_zipped_file:
+                data = operation.function(open_zipped_file)
+        stats = data.stats if isinstance(data, TransformOutput) else {}
+        data = _unwrap(data, result)
+        if data is None:
+            name = operation.fallback_name or item.filename
+            copy_entry_raw(src_fp, zout, item, operation.fallback_name, zin)
+            logger.debug(f"{log_prefix} Kept '{item.filename}' as it was {stats or ''}")
+            result.entries_kept += 1
+        else:
+            zinfo = _new_zipinfo(item, operation.new_name or item.filename, operation.compress_type)
+            name = zinfo.filename
+            zout.writestr(zinfo, data)
+            logger.debug(f"{log_prefix} Transformed '{item.filename}' into '{zinfo.filename}' {stats or ''}")
+            result.entries_written += 1
+        if stats:
+            result.entry_stats[name] = stats
+    else:
+        raise TypeError(f"Unsupported operation for '{item.filename}': {operation!r}")
+
+
+class _PagePipeline:
+    """
+    Streams the entries of an archive through a reader thread, the executor and the writer, linked by a bounded queue.
+
+    The reader reads the compressed data of the entries and submits their transforms to the executor, where the
+    pages are decompressed, decoded and encoded. The writer (the thread that rewrites the archive) takes the results
+    from the queue in archive order and writes them as they came back from the worker.
+    At most depth entries wait between the reader and the writer, so the memory used depends on the depth of the
+    queue, not on the size of the archive. With a budget, every submitted entry also reserves its uncompressed size
+    until it is written, which caps the bytes in flight of every archive sharing it.
+    """
+
+    def __init__(self, executor: Executor, src_path: str, operations: list[tuple[zipfile.ZipInfo, EntryOperation]],
+                 depth: int, budget: ByteBudget = None):
+        self.executor = executor
+        self.operations = operations
+        self.budget = budget
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self._charge = 0
+        self._picklable = {}
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read, args=(src_path,), daemon=True,
+                                        name=f"Reader-{os.path.basename(src_path)}")
+        self._reader.start()
+
+    def _can_submit(self, item: zipfile.ZipInfo, operation: EntryOperation) -> bool:
+        if not isinstance(operation, Transform) or item.compress_type not in (zipfile.ZIP_STORED,
+                                                                              zipfile.ZIP_DEFLATED):
+            return False
+        key = id(operation.function)
+        if key not in self._picklable:
+            self._picklable[key] = _is_picklable(operation.function)
+        return self._picklable[key]
+
+    def _read(self, src_path: str):
+        try:
+            # Own file handle, the writer reads the source too to copy the kept entries
+            with open(src_path, 'rb') as src_fp:
+                for item, operation in self.operations:
+                    if self._stop.is_set():
+                        return
+                    future, charge = None, 0
+                    if self._can_submit(item, operation):
+                        if self.budget is not None:
+                            charge = item.file_size
+                            self.budget.acquire(charge)
+                        try:
+                            compressed = read_entry_raw(src_fp, item)
+                            future = self.executor.submit(transform_compressed, compressed, item.compress_type,
+                                                          item.CRC, item.filename, operation.function)
+                        except BaseException:
+                            if charge:
+                                self.budget.release(charge)
+                            raise
+                    self.queue.put((future, charge))
+        except BaseException as e:
+            self.queue.put(e)
+
+    def next(self) -> Future | None:
+        """
+        Returns the future of the transform of the next entry, or None if the writer has to process it itself
+        """
+        queued = self.queue.get()
+        if isinstance(queued, BaseException):
+            raise queued
+        future, self._charge = queued
+        return future
+
+    def release(self):
+        """
+        Frees the budget reserved by the last entry, once it has been written
+        """
+        if self._charge:
+            self.budget.release(self._charge)
+            self._charge = 0
+
+    def _discard_queued(self):
+        while True:
+            try:
+                queued = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if not isinstance(queued, BaseException):
+                future, charge = queued
+                if future is not None:
+                    future.cancel()
+                if charge:
+                    self.budget.release(charge)
+
+    def close(self):
+        """
+        Stops the reader and frees whatever it had queued. The queue is emptied until the reader is done,
+        so it's never left blocked on a full queue
+        """
+        self._stop.set()
+        self.release()
+        while self._reader.is_alive():
+            self._discard_queued()
+            self._reader.join(0.05)
+        self._discard_queued()
+
+
+def rewrite_archive(src_path: str, plan: RewritePlan = None, additions: Iterable[Add] = (), dst_path: str = None,
+                    log_prefix: str = "[Rewrite]", executor: Executor = None,
+                    max_pending: int = None, budget: ByteBudget = None) -> RewriteResult:
+    """
+    Rewrites a zip file in a single streaming pass.
+
+    Every entry of the source gets the operation the plan returns for it. Entries without an operation are kept.
+    Kept and renamed entries are copied raw, only replaced and transformed entries are (re)compressed.
+    The new archive is written to a tempfile next to the destination which atomically replaces it once complete,
+    so the destination is never left half written. If anything fails the tempfile is removed.
+
+    :param src_path: The archive to read
+    :param plan: Either a dictionary {entry name: operation} or a function called with the ZipInfo of every entry,
+        in archive order, that returns its operation
+    :param additions: New entries appended after the source entries
+    :param dst_path: Where to write the new archive. Defaults to src_path (the archive is rewritten in place)
+    :param log_prefix: Prefix for the log messages
+    :param executor: If provided, transforms run in it (i.e. a ProcessPoolExecutor) while the archive is written.
+        The entries are read in a separate thread. Functions that can't be pickled are run in this process
+    :param max_pending: Maximum number of entries read ahead of the writer. Defaults to twice the CPU count
+    :param budget: Optional cap on the uncompressed bytes sent to the executor and not yet written.
+        Can be shared by archives rewritten at the same time
+    """
+    dst_path = dst_path or src_path
+    if plan is None:
+        get_operation = lambda item: None
+    elif isinstance(plan, dict):
+        get_operation = lambda item: plan.get(item.filename)
+    else:
+        get_operation = plan
+
+    result = RewriteResult(size_before=os.path.getsize(src_path))
+    tmpfd, tmpname = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(os.path.abspath(dst_path)))
+    os.close(tmpfd)
+    try:
+        with zipfile.ZipFile(src_path, 'r') as zin, open(src_path, 'rb') as src_fp:
+            with zipfile.ZipFile(tmpname, 'w') as zout:
+                operations = [(item, get_operation(item) or KEEP) for item in zin.infolist()]
+                pipeline = None
+                if executor is not None:
+                    pipeline = _PagePipeline(executor, src_path, operations,
+                                             max_pending or 2 * (os.cpu_count() or 1), budget)
+                try:
+                    for item, operation in operations:
+                        transformed = pipeline.next() if pipeline is not None else None
+                        _apply_operation(zin, src_fp, zout, item, operation, result, log_prefix, transformed)
+                        if pipeline is not None:
+                            pipeline.release()
+                finally:
+                    if pipeline is not None:
+                        pipeline.close()
+                for addition in additions:
+                    if addition.path is not None:
+                        zinfo = zipfile.ZipInfo.from_file(addition.path, addition.name)
+                        zinfo.compress_type = addition.compress_type
+                        _write_from_path(zout, zinfo, addition.path)
+                    else:
+                        zout.writestr(addition.name, _unwrap(addition.data, result),
+                                      compress_type=addition.compress_type)
+                    logger.debug(f"{log_prefix} Added '{addition.name}'")
+                    result.entries_written += 1
+        os.replace(tmpname, dst_path)
+    except PermissionError as e:
+        logger.error(f"{log_prefix} Permission error. Clearing temp files...", exc_info=e)
+        os.remove(tmpname)
+        raise e
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    result.size_after = os.path.getsize(dst_path)
+    return result
@@ -1,29 +1,44 @@
+import functools
 import logging
 import os
 import re
-import tempfile
 import tkinter as tk
 import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
 from tkinter import filedialog
-from tkinter.ttk import Style, Progressbar
 
-# from CommonLib import webp_converter as convert_to_webp
+from CommonLib.BatchProcessor import DEFAULT_WORKERS, run_batch
+from CommonLib.ByteBudget import ByteBudget
+from CommonLib.ConversionScheduler import DEFAULT_MAX_INFLIGHT_BYTES, DEFAULT_PAGE_WORKERS
+from CommonLib.ProgressBarWidget import ProgressBar
+from CommonLib.ImageEncoders import DEFAULT_PRESET, WebpEncoder
+from CommonLib.ZipRewriter import DROP, KEEP, EntryOperation, Rename, Transform, rewrite_archive
 
 logger = logging.getLogger(__name__)
 
 
 class App:
-    def __init__(self, master: tk.Tk, epubsPathList: list[str] = None, convert_to_webp=False, ):
+    def __init__(self, master: tk.Tk, epubsPathList: list[str] = None, convert_to_webp=False,
+                 preset: str = DEFAULT_PRESET, page_workers: int = DEFAULT_PAGE_WORKERS,
+                 archive_workers: int = DEFAULT_WORKERS, max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES):
         """
         If there are epubsPathList; start() must be called manually
 
         :param epubsPathList: The list of string paths to the epubs files to process
         :param convert_to_webp: Should the images be converted to .webp when adding
+        :param preset: Webp encoder settings, one of CommonLib.WebpConverter.WEBP_PRESETS
+        :param page_workers: Number of processes the images of every epub are converted in
+        :param archive_workers: Number of epubs processed at the same time
+        :param max_inflight_bytes: Maximum uncompressed bytes of the images being converted at once
         :param master: used for tkinter integrations
         """
         self.output_folder = ""
         self.convert_to_webp = convert_to_webp
+        self.preset = preset
+        self.page_workers = max(1, page_workers)
+        self.archive_workers = max(1, archive_workers)
+        self.max_inflight_bytes = max_inflight_bytes
         if not master:
             master = tk.Tk()
         self.master = master
@@ -39,120 +54,91 @@ class App:
         logger.info(f"Loaded file list: \n" + "\n".join(self.epubsPathList))
 
         logger.debug("Starting processing of files.")
-        total = len(self.epubsPathList)
-        # TBH I'd like to rework how this processing bar works. - Promidius
-        label_progress_text = tk.StringVar()
         if self._initialized_UI:
-            pb_root = self._progressbar_frame
-
-            style = Style(pb_root)
-            style.layout('text.Horizontal.TProgressbar',
-                         [('Horizontal.Progressbar.trough',
-                           {'children': [
-                               ('Horizontal.Progressbar.pbar', {
-                                   'side': 'left',
-                                   'sticky': 'ns'
-                               })],
-                               'sticky': 'nswe'}),
-                          ('Horizontal.Progressbar.label', {
-                              'sticky': 'nswe'
-                          })])
-
-            pb = Progressbar(pb_root, length=400, style='text.Horizontal.TProgressbar',
-                             mode="determinate")  # create progress bar
-            style.configure('text.Horizontal.TProgressbar', text='0 %', anchor='center')
-
-            pb_text = tk.Label(pb_root, textvariable=label_progress_text, anchor=tk.W)
-            logger.info("Initialized progress bar")
-            pb.grid(row=0, column=0, sticky=tk.E + tk.W)
-            pb_text.grid(row=1, column=0, sticky=tk.E)
-
-        processed_counter = 0
-        processed_errors = 0
-        # l = len(self.epubsPathList)
-        # printProgressBar(0, l, prefix='Progress:', suffix='Complete', length=50)
-
-        for i, epubPath in enumerate(self.epubsPathList):
-            try:
-                if not self.output_folder:
-                    output_path = os.path.dirname(epubPath) + "/epub2cbz"
-                    Path(output_path).mkdir(parents=True, exist_ok=True)
-                else:
-                    output_path = self.output_folder
-                logger.info(f"Processing '{epubPath}'")
-                logger.info(f"File '{output_path}' will be created")
-                zipFileName = os.path.basename(epubPath)
-                logger.debug(Path(output_path, zipFileName))
-                tmpfd, tmpname = tempfile.mkstemp(dir=output_path)
-                os.close(tmpfd)
-                self.newCbzName = (output_path + "/" + zipFileName).replace(
-                    re.findall(r"(?i).*(\.[a-z]+$)", epubPath)[0]
-                    , ".cbz")
-                if os.path.exists(self.newCbzName):
-                    os.remove(tmpname)
-                    raise FileExistsError
-                self._processFile(epubPath, tmpname)
-                os.rename(tmpname, self.newCbzName)
-                # print(" " * int(66 + len(os.path.basename(epubPath))), end="\r")
-                # print(f"Processed '{os.path.basename(epubPath)}'")
-                logger.info(f"Successfuly created '{self.newCbzName}'")
-                processed_counter += 1
-                label_progress_text.set(
-                    f"Processed: {processed_counter}/{total} - {processed_errors} errors")
-                if self._initialized_UI:
-                    try:
-                        self.listbox_1.delete(0, tk.END)
-                    except Exception as e:
-                        print(e)
-            except FileExistsError as e:
+            self.convert_to_webp = self.checkbutton_webp_val.get()
+        progress_bar = ProgressBar(self._initialized_UI, self._progressbar_frame if self._initialized_UI else None,
+                                   len(self.epubsPathList))
+        # The images of every epub are converted in the same pool, so the number of processes stays capped
+        # however many epubs are processed at the same time
+        executor = ProcessPoolExecutor(max_workers=self.page_workers) if self.convert_to_webp else None
+        budget = ByteBudget(self.max_inflight_bytes) if self.convert_to_webp else None
+        try:
+            process = functools.partial(self._processEpub, executor=executor, budget=budget)
+            _, errors = run_batch(self.epubsPathList, process, max_workers=self.archive_workers,
+                                  progress_bar=progress_bar)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        for epubPath, e in errors:
+            if isinstance(e, FileExistsError):
                 logger.error(f"Error processing file '{epubPath}'. It already exists: {str(e)}", exc_info=False)
-                processed_errors += 1
-                # os.remove(tmpname)
-            except Exception as e:
-                print(e)
-                logger.error(f"Error processing file '{epubPath}': {str(e)}",e)
-                processed_errors += 1
-                try:
-                    os.remove(tmpname)
-                except UnboundLocalError: # we just want to make sure there are no leftover files
-                    pass
-            if self._initialized_UI:
-                pb_root.update()
-                percentage = ((processed_counter + processed_errors) / total) * 100
-                style.configure('text.Horizontal.TProgressbar',
-                                text='{:g} %'.format(round(percentage, 2)))  # update label
-                pb['value'] = percentage
-                label_progress_text.set(
-                    f"Processed: {(processed_counter + processed_errors)}/{total} files - {processed_errors} errors")
-            # printProgressBar(i + 1, l, prefix=f"Progress:", suffix='Complete', length=50)
+            else:
+                logger.error(f"Error processing file '{epubPath}': {str(e)}", exc_info=e)
+        progress_bar.updatePB()
+        if self._initialized_UI:
+            self.listbox_1.delete(0, tk.END)
         logger.info("Completed processing for all selected files")
 
-    def _processFile(self, zipFilePath, tmpname):
+    def _processEpub(self, epubPath: str, executor: Executor = None, budget: ByteBudget = None):
+        """
+        Creates the cbz of the epub in the output folder. Runs in a worker thread
+        """
+        if not self.output_folder:
+            output_path = os.path.dirname(epubPath) + "/epub2cbz"
+            Path(output_path).mkdir(parents=True, exist_ok=True)
+        else:
+            output_path = self.output_folder
+        logger.info(f"Processing '{epubPath}'")
+        logger.info(f"File '{output_path}' will be created")
+        zipFileName = os.path.basename(epubPath)
+        logger.debug(Path(output_path, zipFileName))
+        newCbzName = (output_path + "/" + zipFileName).replace(re.findall(r"(?i).*(\.[a-z]+$)", epubPath)[0], ".cbz")
+        # Reserves the name. Epubs with the same name in different folders can be processed at the same time
+        os.close(os.open(newCbzName, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        try:
+            self._processFile(epubPath, newCbzName, executor, budget)
+        except BaseException:
+            os.remove(newCbzName)
+            raise
+        logger.info(f"Successfuly created '{newCbzName}'")
+
+    def _processFile(self, zipFilePath, newCbzPath, executor: Executor = None, budget: ByteBudget = None):
+        """
+        Writes the cover and the images inside the images folder of the epub to a new cbz.
+        Images are moved to the root of the cbz. Everything else is left out.
+        With convert_to_webp, images are converted to webp as they are extracted, unless the webp is bigger.
+
+        :param executor: Optional process pool the images are converted in
+        :param budget: Optional cap on the bytes of the images being converted, shared by every epub
+        """
         logger.info("Inside process")
         with zipfile.ZipFile(zipFilePath, 'r') as zin:
-            with zipfile.ZipFile(tmpname, 'w') as zout:
+            namelist = zin.namelist()
+        images_in_ImagesFolder = [v for v in namelist if "images/" in v]  # Notes all folders to not process them.
+        if not images_in_ImagesFolder:
+            raise FileNotFoundError
+        covers = [v for v in namelist if re.match(r"(?i)cover\.[a-z]+", v)]
+        encoder = WebpEncoder(preset=self.preset) if self.convert_to_webp else None
+
+        def is_convertible(name: str) -> bool:
+            return encoder is not None and os.path.splitext(name)[1].lower() in encoder.source_formats
 
-                images_in_ImagesFolder = [v for v in zin.infolist() if
-                                          "images/" in v.filename]  # Notes all folders to not process them.
-                if not images_in_ImagesFolder:
-                    raise FileNotFoundError
-                covers = [v for v in zin.namelist() if re.match(r"(?i)cover\.[a-z]+", v)]
-                if covers:
-                    if self.convert_to_webp:
-                        # zout.writestr(covers[0],  zin.read(covers[0]))
-                        raise NotImplementedError
-                        # TODO webp convert
-                        pass
-                    else:
-                        zout.writestr(covers[0], zin.read(covers[0]))
+        def plan(item: zipfile.ZipInfo) -> EntryOperation:
+            if covers and item.filename == covers[0]:
+                if is_convertible(item.filename):
+                    return Transform(encoder, encoder.output_name(item.filename), zipfile.ZIP_STORED)
+                return KEEP
+            if item.filename in images_in_ImagesFolder:
+                image_name = item.filename.split("/")[-1]
+                logger.debug(f"Processing file {item.filename}")
+                if re.match(r"(?i).*\.[a-z]+", image_name):
+                    if is_convertible(image_name):
+                        return Transform(encoder, encoder.output_name(image_name), zipfile.ZIP_STORED, image_name)
+                    return Rename(image_name)
+            return DROP
 
-                for image in images_in_ImagesFolder:
-                    image_name = image.filename.split("/")
-                    logger.debug(f"Processing file {image.filename}")
-                    if re.match(r"(?i).*\.[a-z]+", image_name[-1]):
-                        image_name = image_name[-1]
-                        zout.writestr(image_name, zin.read(image))
-                        logger.debug(f"Added '{image.filename}' to new tempfile")
+        rewrite_archive(zipFilePath, plan, dst_path=newCbzPath, log_prefix="[epub2cbz]", executor=executor,
+                        budget=budget)
 
     def _select_files(self):
 
@@ -204,6 +190,10 @@ class App:
         self.label_4 = tk.Label(self.frame_1)
         self.label_4.configure(text='Selected folder:\nfile_path/epub2cbz/')
         self.label_4.grid(column='0', row=8)
+        self.checkbutton_webp_val = tk.BooleanVar(self.master, value=self.convert_to_webp)
+        self.checkbutton_webp = tk.Checkbutton(self.frame_1, text='Convert images to webp',
+                                               variable=self.checkbutton_webp_val)
+        self.checkbutton_webp.grid(column='0', row=9)
 
         self._initialized_UI = True
 
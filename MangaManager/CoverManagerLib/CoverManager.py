@@ -3,6 +3,7 @@ import logging
 import os
 import re
 import tkinter as tk
+from collections import Counter
 from itertools import cycle
 from tkinter import filedialog
 from tkinter import messagebox as mb
@@ -10,6 +11,8 @@ from tkinter import ttk
 
 from PIL import ImageTk, Image, UnidentifiedImageError
 
+from CommonLib.ArchiveJobPlanner import JobPlanner
+from CommonLib.ImageAnalysis import DEFAULT_GRAYSCALE_TOLERANCE
 from CommonLib.ProgressBarWidget import ProgressBar
 from .cbz_handler import SetCover
 from .models import cover_process_item_info
@@ -30,6 +33,7 @@ class App:
         self.checkbox0_settings_val = tk.BooleanVar(value=True)
         self.checkbox1_settings_val = tk.BooleanVar(value=False)
         self.checkbox2_settings_val = tk.BooleanVar(value=False)
+        self.checkbox3_settings_val = tk.BooleanVar(value=False)
         self.covers_path_in_confirmation = {}
         self._initialized_UI = False
 
@@ -120,6 +124,11 @@ class App:
                                            variable=self.checkbox2_settings_val)
         self._checkbox2_settings.grid(column='0', row='3', sticky='w')
 
+        self._checkbox3_settings = tk.Checkbutton(self._settings)
+        self._checkbox3_settings.configure(text='Convert grey images to grayscale when converting them to webp',
+                                           variable=self.checkbox3_settings_val)
+        self._checkbox3_settings.grid(column='0', row='4', sticky='w')
+
         self._settings.configure(height='160', highlightbackground='black', highlightcolor='black',
                                  highlightthickness='1')
         self._settings.configure(width='200')
@@ -319,40 +328,38 @@ class App:
         self._button4_proceed.config(relief=tk.SUNKEN, text="Processing")
 
         self.disableButtons(self._frame_coversetter)
-        total = len(self._treeview1.get_children())
-        # TBH I'd like to rework how this processing bar works. - Promidius
-        progressBar = ProgressBar(self._initialized_UI, self._progressbar_frame, total)
         convert_images = self.checkbox2_settings_val.get()
+        grayscale_tolerance = DEFAULT_GRAYSCALE_TOLERANCE if self.checkbox3_settings_val.get() else None
 
+        # Every operation queued for the same file is applied in a single rewrite of the file
+        planner = JobPlanner()
+        queue_errors = 0
         for item in self.covers_path_in_confirmation:
             for file in self.covers_path_in_confirmation[item]:
-                logger.info(f"Starting processing for file: {item}")
+                logger.info(f"Queueing processing for file: {file.zipFilePath}")
                 try:
-                    SetCover(file, conver_to_webp=convert_images)
-                    # label_progress_text.set(
-                    #     f"Processed: {processed_counter}/{total} - {processed_errors} errors"
-                    #     f" - Elapsed time: {get_elapsed_time}")
-                    progressBar.increaseCount()
-                except FileExistsError as e:
-                    mb.showwarning(f"[ERROR] File already exists",
-                                   f"Trying to create:\n`{e.filename2}` but already exists\n\nException:\n{e}")
-                    progressBar.increaseError()
-                    continue
-                except PermissionError as e:
-                    mb.showerror("Can't access the file because it's being used by a different process",
-                                 f"Exception:{e}")
-                    progressBar.increaseError()
-                    continue
-                except FileNotFoundError as e:
-                    mb.showerror("Can't access the file because it's being used by a different process",
-                                 f"Exception:{e}")
-                    progressBar.increaseError()
-                    continue
+                    SetCover(file, conver_to_webp=convert_images, job=planner.job(file.zipFilePath),
+                             grayscale_tolerance=grayscale_tolerance)
                 except Exception as e:
-                    mb.showerror("Something went wrong", "Error processing. Check logs.")
-                    logger.critical("Exception Processing", e)
-                    progressBar.increaseError()
-                progressBar.updatePB()
+                    self._show_process_error(e)
+                    queue_errors += 1
+        # TBH I'd like to rework how this processing bar works. - Promidius
+        progressBar = ProgressBar(self._initialized_UI, self._progressbar_frame, len(planner.jobs) + queue_errors)
+        for _ in range(queue_errors):
+            progressBar.increaseError()
+        results, errors = planner.run(progress_bar=progressBar)
+        stats = Counter()
+        for _, result in results:
+            if result is not None:
+                stats.update(result.stats)
+                stats["pages"] += result.entries_written + result.entries_kept
+        logger.info(f"Processed {len(results)} files - {stats['pages']} images, "
+                    f"{stats['grayscale']} converted to grayscale")
+        for job, e in errors:
+            logger.error(f"Error processing file: {job.path}")
+            self._show_process_error(e)
+        if progressBar.total:
+            progressBar.updatePB()
         self.covers_path_in_confirmation = {}  # clear queue
 
         self.disableButtons(self.master)
@@ -372,6 +379,17 @@ class App:
         self.enableButtons(self._frame_coversetter)
         self._button4_proceed.config(relief=tk.RAISED, text="Proceed")
 
+    def _show_process_error(self, e: Exception):
+        if isinstance(e, FileExistsError):
+            mb.showwarning(f"[ERROR] File already exists",
+                           f"Trying to create:\n`{e.filename2}` but already exists\n\nException:\n{e}")
+        elif isinstance(e, (PermissionError, FileNotFoundError)):
+            mb.showerror("Can't access the file because it's being used by a different process",
+                         f"Exception:{e}")
+        else:
+            mb.showerror("Something went wrong", "Error processing. Check logs.")
+            logger.critical("Exception Processing", exc_info=e)
+
     def clearqueue(self):
         self.covers_path_in_confirmation = {}  # clear queue
         try:
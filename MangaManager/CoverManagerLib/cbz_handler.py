@@ -1,10 +1,9 @@
 import logging
 import os
 import re
-import tempfile
-import zipfile
 
-from CommonLib.WebpConverter import convertToWebp, getNewWebpFormatName, supportedFormats
+from CommonLib.ArchiveJobPlanner import ArchiveJob, PlannedEntry
+from CommonLib.ImageEncoders import ImageEncoder, WebpEncoder, encoder_step
 from . import errors
 from .models import cover_process_item_info
 
@@ -12,39 +11,56 @@ logger = logging.getLogger(__name__)
 
 
 class SetCover:
-    def __init__(self, process_values: cover_process_item_info, conver_to_webp=False):
+    def __init__(self, process_values: cover_process_item_info, conver_to_webp=False, job: ArchiveJob = None,
+                 encoder: ImageEncoder = None, crop_tolerance: int = None, grayscale_tolerance: int = None):
+        """
+        :param process_values: What to do with the cover of which file
+        :param conver_to_webp: Convert the images of the file to webp in the same pass
+        :param encoder: Encode the images of the file, new cover included, with this encoder in the same pass.
+            Defaults to webp if conver_to_webp is set
+        :param crop_tolerance: Crop the uniform borders of the images, new cover included, when they are converted
+            to webp. See CommonLib.ImageAnalysis.content_box
+        :param grayscale_tolerance: Encode the grey images, new cover included, as grayscale when they are converted
+            to webp. See CommonLib.ImageAnalysis.is_grayscale. None to keep every image in colour
+        :param job: If provided, the operations are queued in the job instead of being applied right away.
+            They are applied in the same rewrite as the rest of the operations of the job
+        """
         self.values = process_values
         self.conver_to_webp = conver_to_webp
+        if encoder is None and conver_to_webp:
+            encoder = WebpEncoder(grayscale_tolerance=grayscale_tolerance, crop_tolerance=crop_tolerance)
+        self.encoder = encoder
 
         v = process_values
         self.oldZipFilePath = v.zipFilePath
         # new_zipFilePath = '{}.zip'.format(re.findall(r"(?i)(.*)(?:\.[a-z]{3})$", v.zipFilePath)[0])
+        self.job = job if job is not None else ArchiveJob(v.zipFilePath)
 
-        tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(v.zipFilePath))
-        os.close(tmpfd)
-        self.temp_file = tmpname
         if v.coverRecover:
             logger.info("[SetCover] Proceeding to recover cover")
-            self._recover_cover()
-            return
-
-        logger.info("[SetCover] Proceeding to do backup")
-        self._backup_cover()
-
-        if v.coverDelete:
-            logger.info("[SetCover] Proceeding to delete cover")
-            self._delete()
-            return
-        if v.coverOverwrite:
-            logger.info("[SetCover] Proceeding to overwrite cover")
-            self._overwrite()
-            return
+            self.job.add_step(self._recover_cover)
         else:
-            logger.info("[SetCover] Proceeding to append cover")
-            self._append()
-            return
+            if not v.coverDelete and (not v.coverFilePath or not os.path.exists(v.coverFilePath)):
+                raise errors.NoCoverFile(v.coverFilePath)
+            logger.info("[SetCover] Proceeding to do backup")
+            self.job.add_step(self._backup_cover)
+
+            if v.coverDelete:
+                logger.info("[SetCover] Proceeding to delete cover")
+                self._delete()
+            elif v.coverOverwrite:
+                logger.info("[SetCover] Proceeding to overwrite cover")
+                self.job.add_step(self._overwrite)
+            else:
+                logger.info("[SetCover] Proceeding to append cover")
+                self.job.add_step(self._append)
+            if self.encoder is not None:
+                self.job.add_step(encoder_step(self.encoder))
+
+        if job is None:
+            self.job.run(log_prefix="[SetCover]")
 
-    def _backup_cover(self):
+    def _backup_cover(self, entries: list[PlannedEntry]) -> list[PlannedEntry]:
         """
         Backup will always back up all files in any situation.
 
@@ -61,267 +77,114 @@ class SetCover:
 
         """
 
-        tmpname = self.temp_file
-
-        # backup_isdone = False
-
         def is_folder(name: str, folders_list):
             if name.split("/")[0] + "/" in folders_list:
                 return True
             else:
                 return False
 
-        cover_is_000 = False
         r = r"(?i)^0*\.[a-z]+$"
-
-        with zipfile.ZipFile(self.values.zipFilePath, 'r') as zin:
-            with zipfile.ZipFile(tmpname, 'w') as zout:
-                processed_files = []
-                # old_cover_filename = [v for v in zin.namelist() if v.startswith("OldCover_")]  # Find "OldCover_ file
-                folders_list = [v for v in zin.namelist() if v.endswith("/")]  # Notes all folders to not process them.
-                # for item in zin.infolist():
-                cover_matches = [v for v in zin.namelist() if
-                                 v.startswith("00000.") or re.match(r, v) or re.match(r"(?i).*cover.*", v)]
-                if cover_matches:
-                    logger.info("[SetCover][Backup] Found 0000 file")
-                    cover_is_000 = True
-                backup_isdone = False
-                for item in zin.infolist():
-                    # Delete existing "OldCover_00.ext.bak file
-                    if item.filename.startswith("OldCover_"):
-                        continue
-                    # If it's folder we copy as it is
-                    if is_folder(item.filename, folders_list):  # We write any inner folders as is
-                        if self.conver_to_webp:
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(getNewWebpFormatName(item.filename), convertToWebp(open_zipped_file))
-                        else:
-                            zout.writestr(item.filename, zin.read(item.filename))
-                        continue
-
-                    if item.filename in cover_matches:  # This file is a potential cover
-
-                        # If cover is backed up this is not cover
-                        if backup_isdone:
-                            if item.filename in processed_files:
-                                continue
-                            # File is marked as possible cover but cover is backed up. This is not cover, adding to file
-                            if self.conver_to_webp:
-                                with zin.open(item.filename) as open_zipped_file:
-                                    zout.writestr(getNewWebpFormatName(item.filename), convertToWebp(open_zipped_file))
-                                    logger.debug(
-                                        f"[SetCover][Backup] Adding '{getNewWebpFormatName(item.filename)}' to the new tempfile")
-                            else:
-                                zout.writestr(item.filename, zin.read(item.filename))
-                                logger.debug(f"[SetCover][Backup] Adding '{item.filename}' to the new tempfile")
-                            continue
-
-                        # If there exists 0*.ext.
-                        if re.match(r, item.filename):
-                            # This file name matches r"0*.ext"
-
-                            if self.conver_to_webp:
-                                newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                                with zin.open(item.filename) as open_zipped_file:
-                                    zout.writestr(newname, convertToWebp(open_zipped_file))
-                                    logger.debug(
-                                        f"[SetCover][Backup] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                            else:
-                                newname = f"OldCover_{item.filename}.bak"
-                                zout.writestr(newname, zin.read(item.filename))
-                                logger.debug(
-                                    f"[SetCover][Backup] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                            backup_isdone = True
-                            processed_files.append(item.filename)
-                            continue
-
-                    # Find 001.ext
-                    if re.match(r"(?i)^0*1\.[a-z]+$", item.filename) and (
-                            self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
-
-                        if self.conver_to_webp:
-                            newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(newname, convertToWebp(open_zipped_file))
-                        else:
-                            newname = f"OldCover_{item.filename}.bak"
-                            zout.writestr(newname, zin.read(item.filename))
-                        logger.info(
-                            f"[SetCover][Backup][Overwrite/Delete] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                        backup_isdone = True
-                        processed_files.append(item.filename)
-                        continue
-                    # Find 002.ext
-                    elif re.match(r"(?i)^0*2\.[a-z]+$", item.filename) and (
-                            self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
-                        if self.conver_to_webp:
-                            newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(newname, convertToWebp(open_zipped_file))
-                        else:
-                            newname = f"OldCover_{item.filename}.bak"
-                            zout.writestr(newname, zin.read(item.filename))
-                        logger.info(
-                            f"[SetCover][Backup][Overwrite/Delete] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                        backup_isdone = True
-                        processed_files.append(item.filename)
-                        continue
-                    # Find 003.ext
-                    elif re.match(r"(?i)^0*3\.[a-z]+$", item.filename) and (
-                            self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
-                        if self.conver_to_webp:
-                            newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(newname, convertToWebp(open_zipped_file))
-                        else:
-                            newname = f"OldCover_{item.filename}.bak"
-                            zout.writestr(newname, zin.read(item.filename))
-                        logger.info(
-                            f"[SetCover][Backup][Overwrite/Delete] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                        backup_isdone = True
-                        processed_files.append(item.filename)
-                        continue
-                    # Find 004.ext
-                    elif re.match(r"(?i)^0*4\.[a-z]+$", item.filename) and (
-                            self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
-                        if self.conver_to_webp:
-                            newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(newname, convertToWebp(open_zipped_file))
-                        else:
-                            newname = f"OldCover_{item.filename}.bak"
-                            zout.writestr(newname, zin.read(item.filename))
-                        logger.info(
-                            f"[SetCover][Backup][Overwrite/Delete] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                        backup_isdone = True
-                        processed_files.append(item.filename)
-                        continue
-                    # Find 00.ext
-                    elif re.match(r"(?i)^0*\.[a-z]+$", item.filename) and (
-                            self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
-                        if self.conver_to_webp:
-                            newname = f"OldCover_{getNewWebpFormatName(item.filename)}.bak"
-                            with zin.open(item.filename) as open_zipped_file:
-                                zout.writestr(newname, convertToWebp(open_zipped_file))
-                        else:
-                            newname = f"OldCover_{item.filename}.bak"
-                            zout.writestr(newname, zin.read(item.filename))
-                        logger.info(
-                            f"[SetCover][Backup][Overwrite/Delete] Adding backup '{item.filename}' to the new tempfile as '{newname}'")
-                        backup_isdone = True
-                        processed_files.append(item.filename)
-                        continue
-                    # Adding file to new file.
-                    # File is not flagged as potential cover
-                    item_filename = item.filename
-                    if self.conver_to_webp and item.filename.endswith(supportedFormats):
-                        with zin.open(item.filename) as open_zipped_file:
-                            zout.writestr(getNewWebpFormatName(item.filename), convertToWebp(open_zipped_file))
-                        logger.debug(
-                            f"[SetCover][Backup] Adding '{getNewWebpFormatName(item.filename)}' back to the new tempfile")
-                    else:
-                        zout.writestr(item_filename, zin.read(item.filename))
-                        logger.debug(f"[SetCover][Backup] Adding '{item.filename}' back to the new tempfile")
+        namelist = [entry.name for entry in entries]
+        folders_list = [v for v in namelist if v.endswith("/")]  # Notes all folders to not process them.
+        cover_matches = [v for v in namelist if
+                         v.startswith("00000.") or re.match(r, v) or re.match(r"(?i).*cover.*", v)]
+        if cover_matches:
+            logger.info("[SetCover][Backup] Found 0000 file")
+        # Patterns of the files that get backed up when overwriting or deleting, in the order they were checked
+        overwrite_patterns = (r"(?i)^0*1\.[a-z]+$", r"(?i)^0*2\.[a-z]+$", r"(?i)^0*3\.[a-z]+$", r"(?i)^0*4\.[a-z]+$",
+                              r"(?i)^0*\.[a-z]+$")
+        backup_isdone = False
+        processed_files = []
+        new_entries = []
+
+        def backup(entry: PlannedEntry):
+            nonlocal backup_isdone
+            newname = f"OldCover_{entry.name}.bak"
+            logger.debug(f"[SetCover][Backup] Adding backup '{entry.name}' to the new tempfile as '{newname}'")
+            backup_isdone = True
+            processed_files.append(entry.name)
+            entry.name = newname
+
+        for entry in entries:
+            # Delete existing "OldCover_00.ext.bak file
+            if entry.name.startswith("OldCover_"):
+                continue
+            # If it's folder we copy as it is
+            if is_folder(entry.name, folders_list):  # We write any inner folders as is
+                new_entries.append(entry)
+                continue
+
+            if entry.name in cover_matches:  # This file is a potential cover
+                # If cover is backed up this is not cover
+                if backup_isdone:
+                    if entry.name not in processed_files:
+                        # File is marked as possible cover but cover is backed up. This is not cover, adding to file
+                        new_entries.append(entry)
                     continue
 
-        try:
-            os.remove(self.values.zipFilePath)
-            os.rename(tmpname, self.values.zipFilePath)
-        except PermissionError as e:
-            logger.error("[SetCover][Backup] Permission error. Clearing temp files...", exc_info=e)
-            os.remove(tmpname)
-            raise e
+                # If there exists 0*.ext.
+                if re.match(r, entry.name):
+                    # This file name matches r"0*.ext"
+                    backup(entry)
+                    new_entries.append(entry)
+                    continue
 
-        logger.info("[SetCover][Backup] Finished backup")
+            if (self.values.coverOverwrite or self.values.coverDelete) and not backup_isdone:
+                if any(re.match(pattern, entry.name) for pattern in overwrite_patterns):
+                    logger.info(f"[SetCover][Backup][Overwrite/Delete] Backing up '{entry.name}'")
+                    backup(entry)
+                    new_entries.append(entry)
+                    continue
+            # Adding file to new file.
+            # File is not flagged as potential cover
+            new_entries.append(entry)
+        return new_entries
 
     def _delete(self):
         # Dummy method to read code better.
         # Cover gets backed earlier up so file is not named the same. Hence, it's deleted
-        logger.info("[SetCover][Delete] Finished deleting")
+        logger.info("[SetCover][Delete] Cover will be deleted")
 
-    def _append(self):
+    def _append(self, entries: list[PlannedEntry]) -> list[PlannedEntry]:
         values = self.values
-        if not values.coverFilePath or not os.path.exists(values.coverFilePath):
-            raise errors.NoCoverFile(values.coverFilePath)
-
         logger.debug(f"[SetCover][Append] Cover path:{values.coverFilePath} - File path:{values.zipFilePath}")
         new_coverFileName = f"00000.{values.coverFileFormat}"
+        return entries + [PlannedEntry(new_coverFileName, path=values.coverFilePath)]
 
-        with zipfile.ZipFile(values.zipFilePath, mode='a', compression=zipfile.ZIP_STORED) as zf:
-            if self.conver_to_webp:
-                zf.writestr(getNewWebpFormatName(new_coverFileName), convertToWebp(values.coverFilePath))
-                logger.info(f"[SetCover][append] Finished appending '{getNewWebpFormatName(new_coverFileName)}")
-            else:
-                zf.write(values.coverFilePath, new_coverFileName)
-                logger.info("[SetCover][append] Finished appending")
-
-    def _overwrite(self):
+    def _overwrite(self, entries: list[PlannedEntry]) -> list[PlannedEntry]:
         values = self.values
-        if not values.coverFilePath or not os.path.exists(values.coverFilePath):
-            raise errors.NoCoverFile(values.coverFilePath)
-        # Open saved zip to get the OldCover name. We are using the same name for the new file
-        with zipfile.ZipFile(values.zipFilePath, 'r') as zin:
-            filenames_list = zin.namelist()
-        oldCover_name = [name for name in filenames_list if name.startswith("OldCover_")]
+        # The new cover uses the name of the cover that was just backed up
+        oldCover_name = [entry.name for entry in entries if entry.name.startswith("OldCover_")]
 
-        # os.system("pause")
         if oldCover_name:
             new_coverFileName = oldCover_name[0].replace("OldCover_", "").replace(".bak", "")
         else:
-            # print(filenames_list[0])
             new_coverFileName = "00000cover.txt"
         logger.debug(f"[SetCover][Overwrite] Cover path:{values.coverFilePath} - File path:{values.zipFilePath}")
-        with zipfile.ZipFile(values.zipFilePath, mode='a', compression=zipfile.ZIP_STORED) as zf:
-            # zf.writestr("debug.txt",f"{filenames_list}\n\n\n{oldCover_name}")
-            zf.write(values.coverFilePath, new_coverFileName)
-        logger.info("[SetCover][Overwrite] Finished overwriting")
+        return entries + [PlannedEntry(new_coverFileName, path=values.coverFilePath)]
 
-    def _recover_cover(self):
+    def _recover_cover(self, entries: list[PlannedEntry]) -> list[PlannedEntry]:
         """
         This renames back OldCover_nameHere.ext.bak to nameHere.ext
         if a nameHere.ext exists, it gets overwritten
         """
-
-        tmpname = self.temp_file
-
         r = r"(?i)^0*\.[a-z]{3}$"
-        with zipfile.ZipFile(self.values.zipFilePath, 'r') as zin:
-            with zipfile.ZipFile(tmpname, 'w') as zout:
-                oldCovers_matches = [v for v in zin.namelist() if
-                                     re.match(r"OldCover_.*\.bak", v)]
-                backedUp_filename = ""
-                if oldCovers_matches:
-                    logger.info("[SetCover][Backup]Found backed up image")
-                    backedUp_filename = re.findall(r"OldCover_(.*)\.bak", oldCovers_matches[0])[0]
-
-                for item in zin.infolist():
-                    if not oldCovers_matches and re.match(r, item.filename):
-                        continue
-                    else:
-                        if item.filename == backedUp_filename:
-                            # Found the current cover that was replaced. We ignore it so will be deleted
-                            logger.debug(f"[SetCover][Backup] Ignoring '{item.filename}'")
-                            continue
-
-                        if item.filename in oldCovers_matches:
-                            # Found backup image. Adding to new file with original name
-                            logger.info("Recovering cover")
-                            zout.writestr(backedUp_filename, zin.read(item.filename))
-                            logger.debug(
-                                f"[SetCover][Backup] Added '{item.filename}' to the new tempfile as '{backedUp_filename}'")
-                            continue
-
-                    # Adding file to new file.
-                    item_filename = item.filename
-                    zout.writestr(item_filename, zin.read(item.filename))
-                    logger.debug(f"[SetCover][Backup] Added '{item.filename}' back to the new tempfile")
-                    continue
-
-        try:
-            os.remove(self.values.zipFilePath)
-            os.rename(tmpname, self.values.zipFilePath)
-        except PermissionError as e:
-            logger.error("[SetCover][Backup] Permission error. Clearing temp files...", exc_info=e)
-            os.remove(tmpname)
-            raise e
-        logger.info("[SetCover][Backup] Recovery completed")
+        oldCovers_matches = [entry.name for entry in entries if re.match(r"OldCover_.*\.bak", entry.name)]
+        backedUp_filename = ""
+        if oldCovers_matches:
+            logger.info("[SetCover][Backup]Found backed up image")
+            backedUp_filename = re.findall(r"OldCover_(.*)\.bak", oldCovers_matches[0])[0]
+
+        new_entries = []
+        for entry in entries:
+            if not oldCovers_matches and re.match(r, entry.name):
+                continue
+            if entry.name == backedUp_filename:
+                # Found the current cover that was replaced. We ignore it so will be deleted
+                continue
+            if entry.name in oldCovers_matches:
+                # Found backup image. Adding to new file with original name
+                logger.info("Recovering cover")
+                entry.name = backedUp_filename
+            new_entries.append(entry)
+        return new_entries
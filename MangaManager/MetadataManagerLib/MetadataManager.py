@@ -6,7 +6,16 @@ if __name__ == '__main__':
     import os.path
     import pathlib
     import sys
+
+    sys.path.append(str(pathlib.Path(__file__).parent.parent))  # CommonLib is needed when launched as a script
     import cbz_handler
+    from CommonLib.ArchiveJobPlanner import JobPlanner
+    from CommonLib.BatchProcessor import DEFAULT_WORKERS, run_batch
+    from CommonLib.LibraryIndex import open_library_index
+    from CommonLib.SidecarMetadata import find_pending_sidecars, read_sidecar
+    from CommonLib.WebpConverter import webp_step
+    from CoverManagerLib.cbz_handler import SetCover
+    from CoverManagerLib.models import cover_process_item_info
     from ComicInfo import ComicInfo
     from errors import NoFilesSelected, NoComicInfoLoaded
     from models import LoadedComicInfo
@@ -24,6 +33,7 @@ else:
     import os
     import pathlib
     import tkinter as tk
+    from concurrent.futures import Future, ProcessPoolExecutor, wait
     from tkinter import filedialog
     from tkinter import messagebox as mb
     from tkinter import ttk
@@ -31,10 +41,14 @@ else:
 
     from lxml.etree import XMLSyntaxError
     from CommonLib.ScrolledFrame import ScrolledFrame
+    from CommonLib.BatchProcessor import DEFAULT_WORKERS, run_batch
+    from CommonLib.LibraryIndex import open_library_index
     from CommonLib.ProgressBarWidget import ProgressBar
+    from CommonLib.SidecarMetadata import read_sidecar
     from . import ComicInfo
     from . import models
-    from .cbz_handler import ReadComicInfo, WriteComicInfo
+    from .cbz_handler import ReadComicInfo, WriteComicInfo, embed_sidecar, init_comicinfo_worker, \
+        read_comicinfo_worker
     from .errors import *
     from .models import LoadedComicInfo
 
@@ -44,6 +58,8 @@ else:
     #   - Add successfully loaded window/message somewhere
 
     launch_path = ""
+    # Below this number of files, spawning worker processes costs more than reading the files
+    PARALLEL_LOAD_THRESHOLD = 4
 
     ScriptDir = os.path.dirname(__file__)
     PROJECT_PATH = pathlib.Path(__file__).parent
@@ -203,6 +219,11 @@ class App:
         self.warning_metadataNotFound = disable_metadata_notFound_warning
         self.selected_filenames = []
         self.loadedComicInfo_list = list[LoadedComicInfo]()
+        self.library_index = open_library_index()
+        self.load_workers = os.cpu_count()
+        self.save_workers = DEFAULT_WORKERS
+        # Save to sidecar files next to the archives. They are merged into the archives later by embedSidecars
+        self.sidecar_mode = False
 
         self.entry_Title_val = tk.StringVar(value='', name="title")
         self.entry_Series_val = tk.StringVar(value='', name="Series")
@@ -418,6 +439,16 @@ class App:
         self._button_5.configure(text='Clear', command=self._clearUI, width='10')
         self._button_5.grid(column='2', row='0', sticky='ew')
 
+        self._sidecar_mode_val = tk.BooleanVar(value=self.sidecar_mode)
+        self._checkbutton_sidecar = tk.Checkbutton(self._frame_3)
+        self._checkbutton_sidecar.configure(text='Save to sidecar files', variable=self._sidecar_mode_val,
+                                            command=self._toggle_sidecar_mode)
+        self._checkbutton_sidecar.grid(column='0', row='2', sticky='w')
+
+        self._button_6 = tk.Button(self._frame_3)
+        self._button_6.configure(text='Embed sidecars', command=self.embedSidecars, justify='center')
+        self._button_6.grid(column='1', columnspan='3', row='2', sticky='e')
+
         self._frame_3.configure(height='200', width='200')
         self._frame_3.pack(side='top')
         self._frame_3.columnconfigure('0', weight='1')
@@ -968,9 +999,9 @@ class App:
         try:
             if not self.selected_filenames:
                 if cli_selected_files:
-                    for file in cli_selected_files:
+                    for file, comicinfo_future in self._read_comicinfo_files(cli_selected_files):
                         try:
-                            loaded_ComIinf = self.load_comicinfo_xml(file)
+                            loaded_ComIinf = self.load_comicinfo_xml(file, comicinfo_future)
                         except XMLSyntaxError:
                             # This is already logged. Exception is raised again so it excepts on CLI mode
                             continue
@@ -986,8 +1017,8 @@ class App:
                     raise Exception("No files selected")
             else:
                 logger.debug("Selected files UI:\n    " + "\n    ".join(self.selected_filenames))
-                for file_path in self.selected_filenames:
-                    loaded_ComIinf = self.load_comicinfo_xml(file_path)
+                for file_path, comicinfo_future in self._read_comicinfo_files(self.selected_filenames):
+                    loaded_ComIinf = self.load_comicinfo_xml(file_path, comicinfo_future)
 
                     if loaded_ComIinf:
                         self.loadedComicInfo_list.append(loaded_ComIinf)
@@ -997,6 +1028,50 @@ class App:
         except CancelComicInfoLoad:
             self.loadedComicInfo_list = []
 
+    def _read_comicinfo_files(self, file_paths: list[str]):
+        """
+        Reads and parses the ComicInfo.xml of every file in a process pool.
+        Archives that did not change since they were indexed are not opened, their ComicInfo.xml is only parsed.
+
+        :return: Yields (file path, Future) in the same order as file_paths.
+            The Future is None if the file should be read in this thread.
+        """
+        if len(file_paths) < PARALLEL_LOAD_THRESHOLD or self.load_workers == 1:
+            for file_path in file_paths:
+                yield file_path, None
+            return
+
+        executor = ProcessPoolExecutor(max_workers=self.load_workers, initializer=init_comicinfo_worker)
+        try:
+            futures = []
+            for file_path in file_paths:
+                indexed = self.library_index.get(file_path) if self.library_index is not None else None
+                sidecar = read_sidecar(file_path)
+                if sidecar is not None:
+                    # The pending sidecar is what the archive will hold once embedded
+                    futures.append(executor.submit(read_comicinfo_worker, file_path, sidecar))
+                elif indexed is None:
+                    futures.append(executor.submit(read_comicinfo_worker, file_path))
+                elif indexed.comicinfo_xml is None:
+                    # Indexed and there's no ComicInfo.xml in the archive. Nothing to parse
+                    future = Future()
+                    future.set_result((None, None))
+                    futures.append(future)
+                else:
+                    futures.append(executor.submit(read_comicinfo_worker, file_path, indexed.comicinfo_xml))
+            yield from zip(file_paths, futures)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _wait_comicinfo_future(self, comicinfo_future: Future):
+        """
+        Waits for a worker to finish reading a file. The window keeps redrawing meanwhile.
+        """
+        while self._initialized_UI and not comicinfo_future.done():
+            self.master.update_idletasks()
+            wait([comicinfo_future], timeout=0.05)
+        return comicinfo_future.result()
+
     def _parseUI_toComicInfo(self):
         """
         Modifies every ComicInfo loaded with values from the UI
@@ -1073,59 +1148,79 @@ class App:
     def _saveComicInfo(self):
         progressBar = ProgressBar(self._initialized_UI, self._progressBarFrame if self._initialized_UI else None,
                                   total=len(self.loadedComicInfo_list))
-        for loadedComicObj in self.loadedComicInfo_list:
+
+        def _save(loadedComicObj: LoadedComicInfo):
             logger.info(f"[Processing] Starting processing to save data to file {loadedComicObj.path}")
+            writer = WriteComicInfo(loadedComicObj)
+            if not (writer.to_sidecar() if self.sidecar_mode else writer.to_file()):
+                progressBar.increaseUnchanged()
+
+        # Files are written concurrently. Errors are reported once every file was processed
+        _, errors = run_batch(self.loadedComicInfo_list, _save, max_workers=self.save_workers,
+                              progress_bar=progressBar)
+        for loadedComicObj, e in errors:
+            self._show_save_error(loadedComicObj, e)
+        progressBar.updatePB()
+
+    def _show_save_error(self, loadedComicObj: LoadedComicInfo, e: Exception):
+        """
+        Shows the error raised while saving a file. The exception is raised again if the UI is not initialized
+        or if it's not one of the expected file access errors.
+        """
+        if isinstance(e, FileExistsError):
+            if self._initialized_UI:
+                mb.showwarning(f"[ERROR] File already exists",
+                               f"Trying to create:\n`{str(e.filename2)}` but already exists\n\nException:\n{e}")
 
-            try:
-                WriteComicInfo(loadedComicObj).to_file()
-                progressBar.increaseCount()
-            except FileExistsError as e:
-                if self._initialized_UI:
-                    mb.showwarning(f"[ERROR] File already exists",
-                                   f"Trying to create:\n`{str(e.filename2)}` but already exists\n\nException:\n{e}")
-
-                logger.error("[ERROR] File already exists\n"
-                             f"Trying to create:\n`{str(e.filename2)}` but already exists\nException:\n{e}")
-                progressBar.increaseError()
-                if not self._initialized_UI:
-                    raise e
-                else:
-                    continue
-            except PermissionError as e:
-                if self._initialized_UI:
-                    mb.showerror("[ERROR] Permission Error",
-                                 "Can't access the file because it's being used by a different process\n\n"
-                                 f"Exception:\n{e}")
-
-                logger.error("[ERROR] Permission Error"
-                             "Can't access the file because it's being used by a different process\n"
-                             f"Exception:\n{str(e)}")
-                progressBar.increaseError()
-                if not self._initialized_UI:
-                    raise e
-                else:
-                    continue
-            except FileNotFoundError as e:
-                if self._initialized_UI:
-                    mb.showerror("[ERROR] File Not Found",
-                                 "Can't access the file because it's being used by a different process\n\n"
-                                 f"Exception:\n{str(e)}")
-
-                logger.error("[ERROR] File Not Found\n"
-                             "Can't access the file because it's being used by a different process\n"
+            logger.error("[ERROR] File already exists\n"
+                         f"Trying to create:\n`{str(e.filename2)}` but already exists\nException:\n{e}")
+        elif isinstance(e, PermissionError):
+            if self._initialized_UI:
+                mb.showerror("[ERROR] Permission Error",
+                             "Can't access the file because it's being used by a different process\n\n"
+                             f"Exception:\n{e}")
+
+            logger.error("[ERROR] Permission Error"
+                         "Can't access the file because it's being used by a different process\n"
+                         f"Exception:\n{str(e)}")
+        elif isinstance(e, FileNotFoundError):
+            if self._initialized_UI:
+                mb.showerror("[ERROR] File Not Found",
+                             "Can't access the file because it's being used by a different process\n\n"
                              f"Exception:\n{str(e)}")
-                progressBar.increaseError()
-                if not self._initialized_UI:
-                    raise e
-                else:
-                    continue
-            except Exception as e:
-                if self._initialized_UI:
-                    mb.showerror("Something went wrong", "Error processing. Check logs.")
-                logger.critical("Exception Processing", e)
-                progressBar.increaseError()
-                raise e
-            progressBar.updatePB()
+
+            logger.error("[ERROR] File Not Found\n"
+                         "Can't access the file because it's being used by a different process\n"
+                         f"Exception:\n{str(e)}")
+        else:
+            if self._initialized_UI:
+                mb.showerror("Something went wrong", "Error processing. Check logs.")
+            logger.critical(f"Exception Processing '{loadedComicObj.path}'", exc_info=e)
+            raise e
+        if not self._initialized_UI:
+            raise e
+
+    def _toggle_sidecar_mode(self):
+        self.sidecar_mode = self._sidecar_mode_val.get()
+
+    def embedSidecars(self):
+        """
+        Merges the pending sidecars of the loaded files into the archives. One rewrite per archive
+        """
+        paths = [loadedComicObj.path for loadedComicObj in self.loadedComicInfo_list
+                 if read_sidecar(loadedComicObj.path) is not None]
+        progressBar = ProgressBar(self._initialized_UI, self._progressBarFrame if self._initialized_UI else None,
+                                  total=len(paths))
+
+        def _embed(path: str):
+            logger.info(f"[Processing] Embedding sidecar into {path}")
+            if not embed_sidecar(path):
+                progressBar.increaseUnchanged()
+
+        _, errors = run_batch(paths, _embed, max_workers=self.save_workers, progress_bar=progressBar)
+        for path, e in errors:
+            self._show_save_error(LoadedComicInfo(path, None), e)
+        progressBar.updatePB()
 
     def deleteComicInfo(self):
         """
@@ -1158,7 +1253,7 @@ class App:
                 widget['values'] = []
         self.loadedComicInfo_list = []
 
-    def load_comicinfo_xml(self, cbz_path) -> LoadedComicInfo:
+    def load_comicinfo_xml(self, cbz_path, comicinfo_future: Future = None) -> LoadedComicInfo:
         """
         Accepts a path string
         Returns a LoadedComicInfo with the ComicInfo class generated from the data contained inside ComicInfo file
@@ -1166,13 +1261,21 @@ class App:
 
         :param self: parent self
         :param string cbz_path: the path to the zip-like file
+        :param comicinfo_future: The result of read_comicinfo_worker if the file was read in a worker process
         :return: LoadedComicInfo: LoadedComicInfo
         """
         logger.info(f"loading file: '{cbz_path}'")
         # Load ComicInfo.xml to Class
         try:
             # raise CorruptedComicInfo(cbz_path)
-            comicinfo = ReadComicInfo(cbz_path).to_ComicInfo(print_xml=False)
+            if comicinfo_future is None:
+                comicinfo = ReadComicInfo(cbz_path, library_index=self.library_index).to_ComicInfo(print_xml=False)
+            else:
+                indexed, comicinfo = self._wait_comicinfo_future(comicinfo_future)
+                if indexed is not None and self.library_index is not None:
+                    self.library_index.put(indexed)
+                if comicinfo is None:
+                    raise NoMetadataFileFound(cbz_path)
         except NoMetadataFileFound:
             logger.warning(f"Metadata file 'ComicInfo.xml' not found inside {cbz_path}\n"
                            f"One will be created when saving changes to file.\n"
@@ -1280,7 +1383,9 @@ class AppCli:
 
         self.origin_path = None
         self.parse_args()
-        self.loadedComicInfo_List, self.origin_LoadedcInfo = self.loadFiles()
+        self.library_index = open_library_index() if not self.args.no_index else None
+        if not self.args.embed:
+            self.loadedComicInfo_List, self.origin_LoadedcInfo = self.loadFiles()
 
     def parse_args(self):
         """
@@ -1300,6 +1405,20 @@ class AppCli:
                             metavar="<path>", nargs="+")
         parser.add_argument("--keepNumeration", action="store_true",
                             help="Should the modified file keep the numbering (volume and number)")
+        parser.add_argument("--no-index", action="store_true", dest="no_index",
+                            help="Read every file instead of using the library index")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, metavar="<n>",
+                            help="Number of files saved at the same time")
+        parser.add_argument("--sidecar", action="store_true",
+                            help="Save to sidecar files next to the archives instead of rewriting them")
+        parser.add_argument("--cover", type=is_dir_path, metavar="<path>",
+                            help="Append this image as cover of the modified files, in the same pass as the metadata")
+        parser.add_argument("--webp", action="store_true",
+                            help="Convert the images of the modified files to webp, in the same pass as the metadata")
+        parser.add_argument("--embed", metavar="<path>", nargs="+",
+                            help="Merge the pending sidecars of the given files or folders into the archives")
+        parser.add_argument("-r", action="store_true", dest="recursive",
+                            help="Look for pending sidecars in subfolders too (--embed)")
         self.args = parser.parse_args()
         from glob import glob
         if self.args.copyfrom:
@@ -1323,13 +1442,15 @@ class AppCli:
         copyFrom_LoadedComicInfo = None
         for file_path in self.selected_files:
             logger.debug(f"Loading '{os.path.basename(file_path)}'")
-            comicInfo: ComicInfo = cbz_handler.ReadComicInfo(file_path, ignore_empty_metadata=True).to_ComicInfo()
+            comicInfo: ComicInfo = cbz_handler.ReadComicInfo(file_path, ignore_empty_metadata=True,
+                                                             library_index=self.library_index).to_ComicInfo()
             loadedComicinfo = LoadedComicInfo(file_path, comicInfo=comicInfo)
             loadedComicInfo_List.append(loadedComicinfo)
             logger.debug(f"Loaded  {os.path.basename(file_path)}")
         if self.args.copyfrom:
             logger.debug(f"Loading source ComicInfo: '{os.path.basename(self.args.copyfrom)}'")
-            comicInfo = cbz_handler.ReadComicInfo(self.origin_path, ignore_empty_metadata=False).to_ComicInfo()
+            comicInfo = cbz_handler.ReadComicInfo(self.origin_path, ignore_empty_metadata=False,
+                                                  library_index=self.library_index).to_ComicInfo()
             comicInfo.set_Number("")
             comicInfo.set_Volume(-1)
             copyFrom_LoadedComicInfo = LoadedComicInfo(self.origin_path, comicInfo)
@@ -1339,9 +1460,42 @@ class AppCli:
     def saveFiles(self):
         if not self.loadedComicInfo_List:
             raise NoComicInfoLoaded()
+
+        # Metadata, cover and webp conversion of a file are all applied in a single rewrite of the file
+        planner = JobPlanner()
+        unchanged = 0
         for loadedComicInfo in self.loadedComicInfo_List:
-            cbz_handler.WriteComicInfo(loadedComicInfo).to_file()
-            logger.debug(f"Saved {os.path.basename(loadedComicInfo.path)}")
+            writer = cbz_handler.WriteComicInfo(loadedComicInfo)
+            if self.args.sidecar:
+                changed = writer.to_sidecar()
+            else:
+                changed = writer.add_to_job(planner.job(loadedComicInfo.path))
+            if not changed:
+                unchanged += 1
+            if self.args.cover:
+                SetCover(cover_process_item_info(loadedComicInfo.path, self.args.cover,
+                                                 cover_format=os.path.splitext(self.args.cover)[1][1:]),
+                         job=planner.job(loadedComicInfo.path))
+            if self.args.webp:
+                planner.add_step(loadedComicInfo.path, webp_step())
+
+        results, errors = planner.run(max_workers=self.args.workers)
+        rewritten = sum(1 for _, result in results if result is not None)
+        logger.info(f"Rewrote {rewritten} files. {unchanged} files with unchanged metadata, {len(errors)} errors")
+        for job, e in errors:
+            logger.error(f"Failed to save '{job.path}': {e}")
+        if errors:
+            raise errors[0][1]
+
+    def embedSidecars(self):
+        paths = [cbz_path for path in self.args.embed for cbz_path in find_pending_sidecars(path, self.args.recursive)]
+        results, errors = run_batch(paths, cbz_handler.embed_sidecar, max_workers=self.args.workers)
+        for path, e in errors:
+            logger.error(f"Failed to embed sidecar into '{path}': {e}")
+        unchanged = sum(1 for _, changed in results if not changed)
+        logger.info(f"Embedded {len(results) - unchanged} sidecars. {unchanged} unchanged, {len(errors)} errors")
+        if errors:
+            raise errors[0][1]
 
     def copyCInfo(self, ):
         if not self.loadedComicInfo_List:
@@ -1371,5 +1525,8 @@ if __name__ == '__main__':
     # </Logger>
 
     app = AppCli()
-    app.copyCInfo()
-    app.saveFiles()
+    if app.args.embed:
+        app.embedSidecars()
+    else:
+        app.copyCInfo()
+        app.saveFiles()
@@ -1,10 +1,15 @@
 import io
 import os
-import tempfile
 import zipfile
+import zlib
 
 from lxml.etree import XMLSyntaxError
 
+from CommonLib.LibraryIndex import IndexedArchive, LibraryIndex, scan_archive
+from CommonLib.SidecarMetadata import read_sidecar, remove_sidecar, write_sidecar
+from CommonLib.ZipCentralDirectory import read_central_directory, read_entry
+from CommonLib.ArchiveJobPlanner import ArchiveJob, PlannedEntry, PlanStep
+
 if __name__.startswith("MetadataManagerLib") or __name__ == 'MangaManager.MetadataManagerLib.cbz_handler':
     from .errors import NoMetadataFileFound, CorruptedComicInfo
     from .models import *
@@ -26,24 +31,48 @@ def is_folder(name: str, folders_list):
 
 
 class ReadComicInfo:
-    def __init__(self, cbz_path: str, comicinfo_xml: str = None, ignore_empty_metadata=False):
+    def __init__(self, cbz_path: str, comicinfo_xml: str = None, ignore_empty_metadata=False,
+                 library_index: LibraryIndex = None, use_sidecar=True):
+        """
+        Only the central directory of the archive and the ComicInfo.xml entry are read. Pages are never touched.
+
+        :param cbz_path: The path to the zip-like file
+        :param comicinfo_xml: If provided, the archive is not read and this string is used instead
+        :param ignore_empty_metadata: Do not raise NoMetadataFileFound if ComicInfo.xml is missing
+        :param library_index: If provided, the archive is only read if it changed since it was indexed
+        :param use_sidecar: A pending sidecar ComicInfo.xml takes precedence over the one inside the archive
+        """
         self.cbz_path = cbz_path
         self.xmlString = ""
         self.ignore_empty_metadata = ignore_empty_metadata
         self.total_files = 0
-        comicinfo_xml_exists = False
-        if not comicinfo_xml:
-            with zipfile.ZipFile(self.cbz_path, 'r') as zin:
-                self.total_files = len(zin.infolist())
-                for file in zin.infolist():
-                    if file.filename == "ComicInfo.xml":
-                        comicinfo_xml_exists = True
-                        with zin.open(file) as infile:
-                            self.xmlString = infile.read()
-                if not comicinfo_xml_exists and not ignore_empty_metadata:
+        self.page_count = 0
+        self.total_size = 0
+        sidecar = read_sidecar(self.cbz_path) if use_sidecar and not comicinfo_xml else None
+        if not comicinfo_xml and library_index is not None:
+            indexed = library_index.read(self.cbz_path)
+            self.total_files = indexed.total_files
+            self.page_count = indexed.page_count
+            self.total_size = indexed.total_size
+            if indexed.comicinfo_xml is not None:
+                self.xmlString = indexed.comicinfo_xml
+            elif not ignore_empty_metadata and sidecar is None:
+                raise NoMetadataFileFound(self.cbz_path)
+        elif not comicinfo_xml:
+            with open(self.cbz_path, 'rb') as fp:
+                summary = read_central_directory(self.cbz_path, ("ComicInfo.xml",), fp)
+                self.total_files = summary.total_files
+                self.page_count = summary.page_count
+                self.total_size = summary.total_size
+                if "ComicInfo.xml" in summary.entries:
+                    self.xmlString = read_entry(fp, summary.entries["ComicInfo.xml"])
+                elif not ignore_empty_metadata and sidecar is None:
                     raise NoMetadataFileFound(self.cbz_path)
         else:
             self.xmlString = comicinfo_xml
+        if sidecar is not None:
+            logger.debug(f"ReadComicInfo: Using pending sidecar of '{self.cbz_path}'")
+            self.xmlString = sidecar
         logger.debug("ReadComicInfo: Reading XML done")
 
     def to_ComicInfo(self, print_xml: bool=False) -> ComicInfo:
@@ -74,6 +103,70 @@ class ReadComicInfo:
         return self.xmlString.decode('utf-8')
 
 
+def init_comicinfo_worker():
+    """
+    Initializer for the processes that read ComicInfo.
+    Parsed objects are sent back to the main process and lxml nodes can't be pickled, so they are not kept.
+    """
+    ComicInfo.SaveElementTreeNode = False
+
+
+def read_comicinfo_worker(cbz_path: str, comicinfo_xml: bytes = None) -> tuple[IndexedArchive, ComicInfo.ComicInfo]:
+    """
+    Reads and parses the ComicInfo.xml of an archive. Meant to run in a worker process.
+
+    :param cbz_path: The path to the zip-like file
+    :param comicinfo_xml: ComicInfo.xml content already known (i.e. from the library index or a sidecar).
+        The archive is not opened
+    :return: The scanned archive (None if comicinfo_xml was provided) and the parsed ComicInfo
+        (None if the archive has no ComicInfo.xml)
+    """
+    indexed = None
+    if comicinfo_xml is None:
+        indexed = scan_archive(cbz_path)
+        comicinfo_xml = read_sidecar(cbz_path) or indexed.comicinfo_xml
+    if comicinfo_xml is None:
+        return indexed, None
+    return indexed, ReadComicInfo(cbz_path, comicinfo_xml).to_ComicInfo(print_xml=False)
+
+
+def comicinfo_step(new_comicinfo: bytes = None) -> PlanStep:
+    """
+    ComicInfo.xml is renamed to Old_ComicInfo.xml.bak, replacing the previous backup.
+    The new ComicInfo.xml is added at the end, if provided.
+    """
+
+    def step(entries: list[PlannedEntry]) -> list[PlannedEntry]:
+        new_entries = []
+        for entry in entries:
+            if entry.name == "Old_ComicInfo.xml.bak":
+                # Delete old backup
+                continue
+            if entry.name == "ComicInfo.xml":
+                entry.name = "Old_ComicInfo.xml.bak"
+                logger.debug("[Backup] Backup for ComicInfo.xml created")
+            new_entries.append(entry)
+        if new_comicinfo is not None:
+            new_entries.append(PlannedEntry("ComicInfo.xml", data=new_comicinfo, compress_type=zipfile.ZIP_STORED))
+        return new_entries
+
+    return step
+
+
+def restore_comicinfo_step(entries: list[PlannedEntry]) -> list[PlannedEntry]:
+    """
+    ComicInfo.xml is removed and Old_ComicInfo.xml.bak is renamed back to ComicInfo.xml
+    """
+    new_entries = []
+    for entry in entries:
+        if entry.name == "ComicInfo.xml":
+            continue
+        if entry.name == "Old_ComicInfo.xml.bak":
+            entry.name = "ComicInfo.xml"
+        new_entries.append(entry)
+    return new_entries
+
+
 class WriteComicInfo:
     def __init__(self, loadedComicInfo: LoadedComicInfo):
         self._zipFilePath = loadedComicInfo.path
@@ -90,92 +183,102 @@ class WriteComicInfo:
             logger.info(f"Attribute error :{str(e)}")
             # raise e
 
-    def _backup(self):
-        """
-                Processing order
-                1. Create temp file to write in it
-                2. Reads file provided in path in LoadedComicInfo
-                3. Backup any file named ComicInfo.xml -> writes in temp file
-                4. Write to the file new ComicInfo.xml -> writes in temp file
-                5. Write to the file all files -> writes in temp file
-                6. Deletes file provided
-                7. Renames tempfile to the same name that was deleted previously
-                """
-        tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self._zipFilePath))
-        os.close(tmpfd)
-        backup_isdone = False
-        with zipfile.ZipFile(self._zipFilePath, 'r') as zin:
-            with zipfile.ZipFile(tmpname, 'w') as zout:
-                for item in zin.infolist():
-                    logger.debug(f"[Backup] Iterating: {item.filename}")
-                    if item.filename == "ComicInfo.xml":
-                        # Backup ComicInfo.xml
-                        zout.writestr(f"Old_{item.filename}.bak", zin.read(item.filename))
-                        logger.debug("[Backup] Backup for ComicInfo.xml created")
-                    elif item.filename == "Old_ComicInfo.xml.bak":
-                        # Delete old backup
-                        # zout.writestr(f"Old_{item.filename}.bak", zin.read(item.filename))
-                        continue
-                    else:
-                        # Write the rest of the files as they are
-                        zout.writestr(item.filename, zin.read(item.filename))
-                        logger.debug(f"[Backup] Adding {item.filename} back to the new tempfile")
+    def _backup(self, new_comicinfo: str = None):
+        """
+        Rewrites the file in a single pass:
+            - ComicInfo.xml is renamed to Old_ComicInfo.xml.bak
+            - The previous Old_ComicInfo.xml.bak is removed
+            - The rest of the files are copied as they are
+            - The new ComicInfo.xml is added at the end, if provided
+
+        :param new_comicinfo: The new ComicInfo.xml content. If not provided the file ends up without ComicInfo.xml
+        """
+        ArchiveJob(self._zipFilePath, [comicinfo_step(None if new_comicinfo is None else new_comicinfo.encode("utf-8"))]
+                   ).run(log_prefix="[Backup]")
         logger.debug("[Backup] Backup successful")
-        try:
-            os.remove(self._zipFilePath)
-            os.rename(tmpname, self._zipFilePath)
-        except PermissionError as e:
-            logger.error("[Backup] Permission error. Clearing temp files...", exc_info=e)
-            os.remove(tmpname)
-            raise e
-
-    def to_file(self):
-        self._backup()
-        with zipfile.ZipFile(self._zipFilePath, mode='a', compression=zipfile.ZIP_STORED) as zf:
-            # We finally append our new ComicInfo file
-            zf.writestr("ComicInfo.xml", self._export_io)
-            logger.debug("[Write] New ComicInfo.xml added to the file")
+
+    def add_to_job(self, job: ArchiveJob) -> bool:
+        """
+        Queues the new ComicInfo.xml in a job, so it's written in the same rewrite as the other pending operations
+
+        :return: False if the file already has the same ComicInfo.xml. Nothing is queued in that case
+        """
+        if self.is_unchanged():
+            logger.info(f"[Write] ComicInfo.xml is unchanged. Skipping '{self._zipFilePath}'")
+            return False
+        job.add_step(comicinfo_step(self._export_io.encode("utf-8")))
+        # The archive will hold the latest metadata. A pending sidecar would shadow it
+        job.on_done(lambda: remove_sidecar(self._zipFilePath))
+        return True
+
+    def is_unchanged(self) -> bool:
+        """
+        Checks if the ComicInfo.xml stored in the file is byte-identical to the exported one.
+        Size and CRC32 are compared first from the central directory. The stored file is only read if both match.
+        """
+        new_comicinfo = self._export_io.encode("utf-8")
+        with open(self._zipFilePath, 'rb') as fp:
+            summary = read_central_directory(self._zipFilePath, ("ComicInfo.xml",), fp)
+            entry = summary.entries.get("ComicInfo.xml")
+            if entry is None or entry.file_size != len(new_comicinfo) or entry.CRC != zlib.crc32(new_comicinfo):
+                return False
+            return read_entry(fp, entry) == new_comicinfo
+
+    def to_file(self) -> bool:
+        """
+        Writes the new ComicInfo.xml to the file. The file is not rewritten if its ComicInfo.xml is already the same
+
+        :return: False if the file was left unchanged
+        """
+        if self.is_unchanged():
+            logger.info(f"[Write] ComicInfo.xml is unchanged. Skipping '{self._zipFilePath}'")
+            remove_sidecar(self._zipFilePath)
+            return False
+        self._backup(self._export_io)
+        # The archive now holds the latest metadata. A pending sidecar would shadow it
+        remove_sidecar(self._zipFilePath)
+        return True
+
+    def to_sidecar(self) -> bool:
+        """
+        Writes the new ComicInfo.xml next to the archive instead of rewriting it.
+        The archive is updated later on by embed_sidecar.
+
+        :return: False if the archive already holds the same ComicInfo.xml. No sidecar is written in that case
+        """
+        if self.is_unchanged():
+            logger.info(f"[Sidecar] ComicInfo.xml is unchanged. Skipping '{self._zipFilePath}'")
+            remove_sidecar(self._zipFilePath)
+            return False
+        write_sidecar(self._zipFilePath, self._export_io.encode("utf-8"))
+        return True
 
     def to_str(self) -> str:
         return self._export_io
 
     def delete(self):
         self._backup()
+        remove_sidecar(self._zipFilePath)
         logger.debug("[Delete] File backed up with a different name, hence removed")
 
     def restore(self):
         """
-                Processing order
-                1. Create temp file to write in it
-                2. Reads file provided in path in LoadedComicInfo
-                3. Deletes any file named ComicInfo.xml
-                4. Rename OldComicInfo.xml.bj to ComicInfo.xml -> writes in temp file
-                5. Writes the rest of files -> writes in temp file
-                6. Deletes file provided
-                7. Renames tempfile to the same name that was deleted previously
-                """
-        tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self._zipFilePath))
-        os.close(tmpfd)
-        backup_isdone = False
-        with zipfile.ZipFile(self._zipFilePath, 'r') as zin:
-            with zipfile.ZipFile(tmpname, 'w') as zout:
-                for item in zin.infolist():
-                    logger.debug(f"[Restore Backup] Iterating: {item.filename}")
-                    if item.filename == "ComicInfo.xml":
-                        # Skip this file we want to overwrite it to restore the backup
-                        continue
-                    elif item.filename == "Old_ComicInfo.xml.bak":
-                        zout.writestr(item.filename.replace("Old_", "").replace(".bak", ""), zin.read(item.filename))
-                        continue
-                    else:
-                        # Write the rest of the files as they are
-                        zout.writestr(item.filename, zin.read(item.filename))
-                        logger.debug(f"[Restore Backup] Adding {item.filename} back to the new tempfile")
+        Rewrites the file in a single pass: ComicInfo.xml is removed and Old_ComicInfo.xml.bak is renamed back
+        to ComicInfo.xml
+        """
+        ArchiveJob(self._zipFilePath, [restore_comicinfo_step]).run(log_prefix="[Restore Backup]")
         logger.debug("[Restore Backup] Backup successful")
-        try:
-            os.remove(self._zipFilePath)
-            os.rename(tmpname, self._zipFilePath)
-        except PermissionError as e:
-            logger.error("[Restore Backup] Permission error. Clearing temp files...", exc_info=e)
-            os.remove(tmpname)
-            raise e
+        remove_sidecar(self._zipFilePath)
+
+
+def embed_sidecar(cbz_path: str) -> bool:
+    """
+    Merges the pending sidecar ComicInfo.xml into the archive and removes the sidecar
+
+    :return: False if the archive was left unchanged
+    """
+    sidecar = read_sidecar(cbz_path)
+    if sidecar is None:
+        return False
+    comicinfo = ReadComicInfo(cbz_path, sidecar).to_ComicInfo(print_xml=False)
+    return WriteComicInfo(LoadedComicInfo(cbz_path, comicinfo)).to_file()
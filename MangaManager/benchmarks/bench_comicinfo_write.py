@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark for WriteComicInfo.to_file on a large synthetic cbz.
+
+Compares the previous implementation (every page decompressed and compressed again) against the current one
+(compressed page data copied as it is).
+
+Usage: python bench_comicinfo_write.py [--pages 300] [--page-size 1048576]
+"""
+import argparse
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from MetadataManagerLib import ComicInfo  # noqa: E402
+from MetadataManagerLib.cbz_handler import WriteComicInfo  # noqa: E402
+from MetadataManagerLib.models import LoadedComicInfo  # noqa: E402
+
+
+def create_synthetic_cbz(path: str, pages: int, page_size: int):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for i in range(pages):
+            # Random data does not compress, much like jpeg/png pages
+            zf.writestr(f"{str(i).zfill(4)}.jpg", os.urandom(page_size))
+
+
+def legacy_to_file(loadedComicInfo: LoadedComicInfo):
+    """The rewrite as it was done before: every entry goes through zin.read() and zout.writestr()"""
+    writer = WriteComicInfo(loadedComicInfo)
+    path = loadedComicInfo.path
+    tmpfd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(tmpfd)
+    with zipfile.ZipFile(path, 'r') as zin:
+        with zipfile.ZipFile(tmpname, 'w') as zout:
+            for item in zin.infolist():
+                if item.filename == "ComicInfo.xml":
+                    zout.writestr(f"Old_{item.filename}.bak", zin.read(item.filename))
+                elif item.filename == "Old_ComicInfo.xml.bak":
+                    continue
+                else:
+                    zout.writestr(item.filename, zin.read(item.filename))
+    os.remove(path)
+    os.rename(tmpname, path)
+    with zipfile.ZipFile(path, mode='a', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("ComicInfo.xml", writer.to_str())
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300, help="Number of pages in the synthetic cbz")
+    parser.add_argument("--page-size", type=int, default=1024 * 1024, help="Size in bytes of every page")
+    parser.add_argument("--dir", default=None, help="Directory where the synthetic cbz is created")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        source_path = os.path.join(tmpdir, "synthetic.cbz")
+        create_synthetic_cbz(source_path, args.pages, args.page_size)
+        print(f"Synthetic cbz: {args.pages} pages, {os.path.getsize(source_path) / 1024 ** 2:.1f} MB")
+
+        comicinfo = ComicInfo.ComicInfo()
+        comicinfo.set_Series("Benchmark")
+
+        # Both implementations start from an identical copy of the source archive
+        legacy_path = shutil.copy(source_path, os.path.join(tmpdir, "legacy.cbz"))
+        legacy = timed(legacy_to_file, LoadedComicInfo(legacy_path, comicinfo))
+        print(f"Recompressing rewrite: {legacy:.2f}s")
+        current_path = shutil.copy(source_path, os.path.join(tmpdir, "current.cbz"))
+        current = timed(WriteComicInfo(LoadedComicInfo(current_path, comicinfo)).to_file)
+        print(f"Raw copy rewrite     : {current:.2f}s")
+        print(f"Speedup: {legacy / current:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,892 @@
+import io
+import os
+import random
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+import math
+import unittest
+import zipfile
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, PngImagePlugin
+
+from MangaManager.CommonLib.ArchiveJobPlanner import JobPlanner, PlannedEntry
+from MangaManager.CommonLib.BatchProcessor import run_batch
+from MangaManager.CommonLib.ByteBudget import ByteBudget
+from MangaManager.CommonLib.ConversionScheduler import ConversionScheduler
+from MangaManager.CommonLib.ImageAnalysis import DEFAULT_GRAYSCALE_TOLERANCE, ahash, content_box, crop_borders, dhash, \
+    hamming_distance, is_blank, is_grayscale, luma_plane, psnr, ssim, to_grayscale
+from MangaManager.CommonLib.ImageEncoders import ADAPTIVE_QUALITY_RANGE, ENCODERS, JpegEncoder, PngEncoder, \
+    StripMetadataEncoder, WebpEncoder, cheapest_encoder, convertToWebp, crop_to_content, encoder_step, get_encoder, \
+    search_quality
+from MangaManager.CommonLib.ImageMetadata import strip_metadata
+from MangaManager.CommonLib.LibraryIndex import LibraryIndex
+from MangaManager.CommonLib.PageCache import _TOUCH_AFTER, CachedTransform, PageCache
+from MangaManager.CommonLib.PageHashIndex import PageHash, PageHashIndex, drop_pages_step
+from MangaManager.CommonLib.RunJournal import RunJournal, cleanup_orphaned_temp_files
+from MangaManager.CommonLib.WebpConverter import WEBP_PRESETS, benchmark_presets, pick_encoder, sample_pages, \
+    webp_step
+from MangaManager.CommonLib.ZipRewriter import DROP, TEMP_PREFIX, Add, Rename, Replace, Transform, TransformOutput, \
+    rewrite_archive
+
+
+def reverse_data(open_zipped_file) -> bytes:
+    return open_zipped_file.read()[::-1]
+
+
+def reject_data(open_zipped_file) -> bytes:
+    raise ValueError("Not an image")
+
+
+def create_test_cbz(path: str, pages: int = 5, comicinfo_xml: str = None, compression=zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, "w", compression=compression) as zf:
+        for i in range(pages):
+            image = Image.new('RGB', size=(20, 20), color=(255, 73, 95))
+            imgByteArr = io.BytesIO()
+            image.save(imgByteArr, format="JPEG")
+            zf.writestr(f"{str(i).zfill(3)}.jpg", imgByteArr.getvalue())
+        if comicinfo_xml:
+            zf.writestr("ComicInfo.xml", comicinfo_xml)
+
+
+def drawn_page(seed: int, size=(400, 600)) -> Image.Image:
+    """
+    A page with random panels, different for every seed
+    """
+    generator = random.Random(seed)
+    image = Image.new('RGB', size=size, color=(255, 255, 255))
+    for _ in range(12):
+        left, upper = generator.randrange(size[0] - 40), generator.randrange(size[1] - 40)
+        image.paste(generator.randrange(200), (left, upper, left + generator.randrange(20, 200),
+                                               upper + generator.randrange(20, 300)))
+    return image
+
+
+def jpeg_bytes(image: Image.Image, quality: int = 90) -> bytes:
+    page = io.BytesIO()
+    image.save(page, format="JPEG", quality=quality)
+    return page.getvalue()
+
+
+class TestsLibraryIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, f"Test_index_{random.randint(1, 6000)}.cbz")
+        create_test_cbz(self.test_file_name, comicinfo_xml="<ComicInfo><Series>Indexed</Series></ComicInfo>")
+        self.library_index = LibraryIndex(os.path.join(self.temp_folder, "index.sqlite3"))
+
+    def tearDown(self) -> None:
+        self.library_index.close()
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_archive_is_read_once(self):
+        indexed = self.library_index.read(self.test_file_name)
+        self.assertEqual(5, indexed.page_count)
+        self.assertEqual("Indexed", indexed.fields["Series"])
+
+        self.library_index.read(self.test_file_name)
+        self.assertEqual((1, 1), (self.library_index.hits, self.library_index.misses))
+
+    def test_modified_archive_is_read_again(self):
+        self.library_index.read(self.test_file_name)
+        time.sleep(0.01)
+        create_test_cbz(self.test_file_name, pages=2)
+        indexed = self.library_index.read(self.test_file_name)
+        self.assertEqual(2, self.library_index.misses)
+        self.assertEqual(2, indexed.page_count)
+        self.assertIsNone(indexed.comicinfo_xml)
+
+    def test_index_with_another_schema_is_emptied(self):
+        index_path = os.path.join(self.temp_folder, "old_index.sqlite3")
+        connection = sqlite3.connect(index_path)
+        connection.execute("CREATE TABLE archives (path TEXT PRIMARY KEY, layout TEXT NOT NULL)")
+        connection.execute("INSERT INTO archives VALUES ('old.cbz', '[]')")
+        connection.commit()
+        connection.close()
+        library_index = LibraryIndex(index_path)
+        try:
+            self.assertEqual(5, library_index.read(self.test_file_name).page_count)
+            self.assertEqual(0, library_index.prune())
+        finally:
+            library_index.close()
+
+    def test_prune(self):
+        self.library_index.read(self.test_file_name)
+        os.remove(self.test_file_name)
+        self.assertEqual(1, self.library_index.prune())
+
+
+class TestsBatchProcessor(unittest.TestCase):
+    def test_results_and_errors_are_collected(self):
+        def process(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            return item * 2
+
+        results, errors = run_batch(range(10), process, max_workers=3)
+        self.assertEqual(sorted((item, item * 2) for item in range(10) if item % 3), sorted(results))
+        self.assertEqual([0, 3, 6, 9], sorted(item for item, _ in errors))
+        self.assertTrue(all(isinstance(e, ValueError) for _, e in errors))
+
+
+class TestsZipRewriter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, "Test_rewrite.cbz")
+        create_test_cbz(self.test_file_name, comicinfo_xml="<ComicInfo/>", compression=zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.original_infos = {info.filename: info for info in zin.infolist()}
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_operations(self):
+        result = rewrite_archive(self.test_file_name, {
+            "000.jpg": Rename("cover.jpg"),
+            "001.jpg": DROP,
+            "002.jpg": Replace(b"replaced"),
+            "003.jpg": Transform(lambda open_zipped_file: open_zipped_file.read()[::-1], "003.bin"),
+        }, [Add("new.txt", b"added")])
+
+        self.assertEqual((3, 3, 1), (result.entries_copied, result.entries_written, result.entries_dropped))
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertIsNone(zin.testzip())
+            self.assertEqual(["cover.jpg", "002.jpg", "003.bin", "004.jpg", "ComicInfo.xml", "new.txt"], zin.namelist())
+            for name, original_name in (("cover.jpg", "000.jpg"), ("004.jpg", "004.jpg")):
+                # Raw copies keep the compressed data as it was
+                self.assertEqual(self.original_infos[original_name].CRC, zin.getinfo(name).CRC)
+                self.assertEqual(self.original_infos[original_name].compress_size, zin.getinfo(name).compress_size)
+            self.assertEqual(b"replaced", zin.read("002.jpg"))
+            self.assertEqual(zipfile.ZIP_DEFLATED, zin.getinfo("002.jpg").compress_type)
+            self.assertEqual(b"added", zin.read("new.txt"))
+        self.assertEqual(["Test_rewrite.cbz"], os.listdir(self.temp_folder))
+
+    def test_raw_copy_headers(self):
+        rewrite_archive(self.test_file_name, {"000.jpg": Rename("cover.jpg"), "001.jpg": DROP})
+        with zipfile.ZipFile(self.test_file_name, "r") as zin, open(self.test_file_name, "rb") as f:
+            for info in zin.infolist():
+                f.seek(info.header_offset)
+                header = struct.unpack(zipfile.structFileHeader, f.read(struct.calcsize(zipfile.structFileHeader)))
+                self.assertEqual(zipfile.stringFileHeader, header[0])
+                # CRC and compressed size of the local header
+                original_name = "000.jpg" if info.filename == "cover.jpg" else info.filename
+                self.assertEqual(self.original_infos[original_name].CRC, header[7])
+                self.assertEqual(self.original_infos[original_name].compress_size, header[8])
+                self.assertEqual(info.filename.encode(), f.read(header[10]))
+
+    def test_copy_without_the_private_zipfile_members(self):
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            original_data = {name: zin.read(name) for name in zin.namelist()}
+        with mock.patch("MangaManager.CommonLib.ZipRewriter._can_copy_raw", return_value=False):
+            result = rewrite_archive(self.test_file_name, {"000.jpg": Rename("cover.jpg")})
+        self.assertEqual(6, result.entries_copied)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertIsNone(zin.testzip())
+            self.assertEqual(original_data["000.jpg"], zin.read("cover.jpg"))
+            self.assertEqual(original_data["004.jpg"], zin.read("004.jpg"))
+            self.assertEqual(zipfile.ZIP_DEFLATED, zin.getinfo("004.jpg").compress_type)
+
+    def test_transforms_in_process_pool_keep_order(self):
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            original_data = {name: zin.read(name) for name in zin.namelist()}
+        plan = {f"00{i}.jpg": Transform(reverse_data, f"00{i}.bin") for i in range(5)}
+        # Lambdas can't be sent to the workers, they run in this process
+        plan["ComicInfo.xml"] = Transform(lambda open_zipped_file: open_zipped_file.read().upper())
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            result = rewrite_archive(self.test_file_name, plan, executor=executor, max_pending=2)
+
+        self.assertEqual(6, result.entries_written)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertIsNone(zin.testzip())
+            self.assertEqual([f"00{i}.bin" for i in range(5)] + ["ComicInfo.xml"], zin.namelist())
+            for i in range(5):
+                self.assertEqual(original_data[f"00{i}.jpg"][::-1], zin.read(f"00{i}.bin"))
+            self.assertEqual(b"<COMICINFO/>", zin.read("ComicInfo.xml"))
+
+    def test_failed_rewrite_leaves_original(self):
+        def fail(open_zipped_file):
+            raise ValueError("Not an image")
+
+        with open(self.test_file_name, "rb") as f:
+            original_data = f.read()
+        with self.assertRaises(ValueError):
+            rewrite_archive(self.test_file_name, {"002.jpg": Transform(fail)})
+        with open(self.test_file_name, "rb") as f:
+            self.assertEqual(original_data, f.read())
+        self.assertEqual(["Test_rewrite.cbz"], os.listdir(self.temp_folder))
+
+
+    def test_failed_transform_in_process_pool_stops_the_pipeline(self):
+        with open(self.test_file_name, "rb") as f:
+            original_data = f.read()
+        plan = {f"00{i}.jpg": Transform(reverse_data) for i in range(5)}
+        plan["001.jpg"] = Transform(reject_data)
+        budget = ByteBudget(1024 * 1024)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            with self.assertRaises(ValueError):
+                rewrite_archive(self.test_file_name, plan, executor=executor, max_pending=1, budget=budget)
+        self.assertEqual(0, budget.in_use)
+        with open(self.test_file_name, "rb") as f:
+            self.assertEqual(original_data, f.read())
+        self.assertEqual(["Test_rewrite.cbz"], os.listdir(self.temp_folder))
+
+class TestsJobPlanner(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, "Test_planner.cbz")
+        create_test_cbz(self.test_file_name)
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_steps_are_applied_in_one_rewrite(self):
+        def rename_cover(entries):
+            entries[0].name = "OldCover_000.jpg.bak"
+            return entries + [PlannedEntry("00000.jpg", data=b"cover")]
+
+        def upper_case(entries):
+            for entry in entries:
+                entry.transforms.append(lambda open_file: open_file.read().upper())
+                entry.name = entry.name.replace(".jpg", ".JPG")
+            return entries
+
+        planner = JobPlanner()
+        planner.add_step(self.test_file_name, rename_cover)
+        planner.add_step(self.test_file_name, upper_case)
+        results, errors = planner.run()
+        self.assertEqual([], errors)
+        self.assertEqual(1, len(results))
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertEqual(["OldCover_000.JPG.bak", "001.JPG", "002.JPG", "003.JPG", "004.JPG", "00000.JPG"],
+                             zin.namelist())
+            self.assertEqual(b"COVER", zin.read("00000.JPG"))
+
+    def test_nothing_to_change(self):
+        modified_time = os.stat(self.test_file_name).st_mtime_ns
+        planner = JobPlanner()
+        planner.add_step(self.test_file_name, lambda entries: entries)
+        results, _ = planner.run()
+        self.assertIsNone(results[0][1])
+        self.assertEqual(modified_time, os.stat(self.test_file_name).st_mtime_ns)
+
+
+def reverse_pages_step(entries):
+    for entry in entries:
+        entry.transforms.append(reverse_data)
+        entry.name = entry.name.replace(".jpg", ".bin")
+    return entries
+
+
+class TestsConversionScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_files = [os.path.join(self.temp_folder, f"Test_{i}.cbz") for i in range(3)]
+        for path in self.test_files:
+            create_test_cbz(path, compression=zipfile.ZIP_DEFLATED)
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_budget(self):
+        budget = ByteBudget(100)
+        budget.acquire(60)
+        self.assertEqual(60, budget.in_use)
+        budget.release(60)
+        # Bigger than the whole budget, allowed when nothing else is in flight
+        budget.acquire(1000)
+        self.assertEqual(100, budget.in_use)
+        budget.release(1000)
+        self.assertEqual(0, budget.in_use)
+
+    def test_archives_share_a_tiny_budget(self):
+        with zipfile.ZipFile(self.test_files[0], "r") as zin:
+            original_data = zin.read("002.jpg")
+        scheduler = ConversionScheduler(page_workers=2, archive_workers=3, max_inflight_bytes=1)
+        report = scheduler.run(self.test_files, [reverse_pages_step])
+
+        self.assertEqual([], report.errors)
+        self.assertEqual((3, 15), (report.archives, report.pages))
+        self.assertEqual(sum(os.path.getsize(path) for path in self.test_files), report.bytes_written)
+        for path in self.test_files:
+            with zipfile.ZipFile(path, "r") as zin:
+                self.assertEqual([f"00{i}.bin" for i in range(5)], zin.namelist())
+                self.assertEqual(original_data[::-1], zin.read("002.bin"))
+
+
+class TestsWebpConverter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, "Test_webp.cbz")
+        create_test_cbz(self.test_file_name, pages=3)
+        with zipfile.ZipFile(self.test_file_name, "a") as zf:
+            zf.writestr("003.webp", b"already webp")
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_pages_are_converted_only_if_smaller(self):
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            original_data = zin.read("001.jpg")
+        # No webp can save 99.9% of a page
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name], [webp_step(min_saving=0.999)])
+        self.assertEqual((3, 3), (report.pages_kept, report.pages))
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertEqual(["000.jpg", "001.jpg", "002.jpg", "003.webp"], zin.namelist())
+            self.assertEqual(original_data, zin.read("001.jpg"))
+
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name], [webp_step()])
+        self.assertEqual(0, report.pages_kept)
+        self.assertEqual(0, report.stats["grayscale"])
+        self.assertGreater(report.bytes_saved, 0)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertEqual(["000.webp", "001.webp", "002.webp", "003.webp"], zin.namelist())
+            self.assertEqual(b"already webp", zin.read("003.webp"))
+
+    def test_grey_pages_are_counted(self):
+        grey_file_name = os.path.join(self.temp_folder, "Test_grey.cbz")
+        # Grayscale conversion is opt-in
+        for grayscale_tolerance, converted in ((None, 0), (DEFAULT_GRAYSCALE_TOLERANCE, 2)):
+            with zipfile.ZipFile(grey_file_name, "w") as zf:
+                for i in range(2):
+                    page = io.BytesIO()
+                    Image.new('RGB', size=(20, 20), color=(90, 90, 90)).save(page, format="JPEG")
+                    zf.writestr(f"00{i}.jpg", page.getvalue())
+            report = ConversionScheduler(page_workers=1).run([grey_file_name], [
+                webp_step(grayscale_tolerance=grayscale_tolerance)])
+            self.assertEqual(converted, report.stats["grayscale"])
+
+    def test_benchmark_presets(self):
+        pages = sample_pages([self.test_file_name], 2, seed=1)
+        self.assertEqual(2, len(pages))
+        results = benchmark_presets(pages)
+        self.assertEqual(list(WEBP_PRESETS), [result.preset for result in results])
+        for result in results:
+            self.assertEqual(2, result.pages)
+            self.assertEqual(sum(len(page) for page in pages), result.original_size)
+            self.assertGreater(result.output_size, 0)
+        with self.assertRaises(ValueError):
+            webp_step(preset="unknown")
+
+    def test_pick_encoder(self):
+        encoders = [WebpEncoder(), JpegEncoder(), StripMetadataEncoder()]
+        # The pages have no metadata. The jpeg encoder costs less than webp but saves less
+        self.assertEqual("jpeg", pick_encoder([self.test_file_name], encoders).name)
+        self.assertEqual("webp", pick_encoder([self.test_file_name], encoders, min_saving=0.5).name)
+        # The first encoder if none saves enough
+        self.assertIs(encoders[2], pick_encoder([self.test_file_name], encoders[2:] + encoders[:1], min_saving=0.99))
+
+    def test_oversized_pages_are_downscaled(self):
+        for image_format in ("JPEG", "PNG"):
+            page = io.BytesIO()
+            Image.new('RGB', size=(400, 600), color=(255, 73, 95)).save(page, format=image_format)
+            page.seek(0)
+            with Image.open(io.BytesIO(convertToWebp(page, max_width=300, max_height=150))) as image:
+                self.assertEqual((100, 150), image.size)
+            page.seek(0)
+            with Image.open(io.BytesIO(convertToWebp(page, max_height=1000))) as image:
+                self.assertEqual((400, 600), image.size)
+
+
+    def test_adaptive_quality_reaches_the_target(self):
+        random_state = random.Random(3)
+        noisy_page = Image.new('L', size=(200, 300))
+        noisy_page.putdata([random_state.randrange(256) for _ in range(200 * 300)])
+        flat_page = Image.new('RGB', size=(200, 300), color=(255, 255, 255))
+        flat_page.paste((0, 0, 0), (20, 20, 180, 60))
+        qualities = {}
+        for name, page in (("noisy", noisy_page.convert("RGB")), ("flat", flat_page)):
+            data, qualities[name] = search_quality(page, "balanced", "psnr", 38)
+            self.assertTrue(ADAPTIVE_QUALITY_RANGE[0] <= qualities[name] <= ADAPTIVE_QUALITY_RANGE[1])
+            with Image.open(io.BytesIO(data)) as converted_page:
+                score = psnr(luma_plane(page), luma_plane(converted_page))
+            if qualities[name] < ADAPTIVE_QUALITY_RANGE[1]:
+                self.assertGreaterEqual(score, 38)
+        self.assertLess(qualities["flat"], qualities["noisy"])
+
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name], [
+            webp_step(target_metric="psnr", target_value=35)])
+        self.assertEqual(3, report.stats["quality_searches"])
+        self.assertIsNotNone(report.average_quality)
+        self.assertEqual(3, len(report.page_qualities))
+        for path, name, quality in report.page_qualities:
+            self.assertEqual(self.test_file_name, path)
+            self.assertTrue(name.endswith(".webp"))
+            self.assertTrue(ADAPTIVE_QUALITY_RANGE[0] <= quality <= ADAPTIVE_QUALITY_RANGE[1])
+        self.assertEqual(report.stats["quality_sum"], sum(quality for _, _, quality in report.page_qualities))
+        self.assertIn(f"/{report.page_qualities[0][1]}: quality ", report.quality_report())
+
+
+class TestsImageEncoders(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, "Test_encoders.cbz")
+        create_test_cbz(self.test_file_name, pages=2)
+        page = io.BytesIO()
+        # Few colours, fits in a palette
+        image = Image.new('RGB', size=(60, 40), color=(255, 255, 255))
+        image.paste((200, 30, 30), (10, 10, 30, 30))
+        image.save(page, format="PNG", compress_level=0)
+        self.png_page = page.getvalue()
+        with zipfile.ZipFile(self.test_file_name, "a") as zf:
+            zf.writestr("002.png", self.png_page)
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_registry(self):
+        self.assertEqual(["webp", "jpeg", "png", "strip"], list(ENCODERS))
+        self.assertEqual("webp", get_encoder("webp", preset="fast").name)
+        self.assertEqual("OldCover_001.webp", WebpEncoder().output_name("OldCover_001.jpg"))
+        self.assertEqual("001.jpg", JpegEncoder().output_name("001.jpg"))
+        self.assertLess(StripMetadataEncoder().estimate_cost(10 ** 6), WebpEncoder().estimate_cost(10 ** 6))
+        self.assertLess(WebpEncoder().estimate_cost(10 ** 6),
+                        WebpEncoder(target_metric="ssim", target_value=0.98).estimate_cost(10 ** 6))
+        with self.assertRaises(ValueError):
+            get_encoder("unknown")
+
+    def test_lossless_encoders_keep_the_pixels(self):
+        output = PngEncoder()(io.BytesIO(self.png_page))
+        self.assertLess(len(output.data), len(self.png_page))
+        with Image.open(io.BytesIO(self.png_page)) as original, Image.open(io.BytesIO(output.data)) as encoded:
+            self.assertEqual("P", encoded.mode)
+            self.assertEqual(list(original.getdata()), list(encoded.convert("RGB").getdata()))
+        # Pages encoders can't process are kept
+        self.assertIsNone(JpegEncoder()(io.BytesIO(self.png_page)))
+
+    def test_orientation_is_kept(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x010E] = "x" * 5000  # Dropped
+        image = Image.effect_noise((60, 40), 40).convert("RGB")
+        for encoder, image_format in ((JpegEncoder(), "JPEG"), (PngEncoder(), "PNG")):
+            page = io.BytesIO()
+            image.save(page, format=image_format, exif=exif, compress_level=0)
+            output = encoder(io.BytesIO(page.getvalue()))
+            with Image.open(io.BytesIO(output.data)) as encoded:
+                self.assertEqual({0x0112: 6}, dict(encoded.getexif()))
+        # Nothing is added to pages that aren't rotated
+        page = io.BytesIO()
+        image.save(page, format="PNG", compress_level=0)
+        with Image.open(io.BytesIO(PngEncoder()(io.BytesIO(page.getvalue())).data)) as encoded:
+            self.assertEqual({}, dict(encoded.getexif()))
+
+    def test_encoder_step(self):
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            original_infos = {info.filename: info for info in zin.infolist()}
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name], [encoder_step(PngEncoder())])
+        self.assertEqual(1, report.pages)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertEqual(["000.jpg", "001.jpg", "002.png"], zin.namelist())
+            self.assertEqual(original_infos["000.jpg"].CRC, zin.getinfo("000.jpg").CRC)
+            self.assertLess(zin.getinfo("002.png").file_size, original_infos["002.png"].file_size)
+
+    def test_auto_crop(self):
+        page = io.BytesIO()
+        image = Image.new('RGB', size=(400, 600), color=(255, 255, 255))
+        image.paste((0, 0, 0), (40, 50, 360, 560))
+        image.save(page, format="PNG")
+        with zipfile.ZipFile(self.test_file_name, "a") as zf:
+            zf.writestr("003.png", page.getvalue())
+        encoder = WebpEncoder(crop_tolerance=24)
+        self.assertNotEqual(WebpEncoder().settings, encoder.settings)
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name], [encoder_step(encoder)])
+        # The flat jpgs and 002.png have no borders
+        self.assertEqual(1, report.stats["cropped"])
+        self.assertIn("1 pages cropped", report.savings_report())
+        self.assertIn("1 pages cropped", report.summary())
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            with Image.open(io.BytesIO(zin.read("003.webp"))) as cropped:
+                self.assertEqual(400 * 600 - cropped.width * cropped.height, report.stats["cropped_pixels"])
+                self.assertLess(cropped.width, 340)
+
+    def test_auto_crop_keeps_the_draft_decode(self):
+        page = Image.new('RGB', size=(3000, 4000), color=(255, 255, 255))
+        page.paste((0, 0, 0), (300, 400, 2700, 3600))
+        data = jpeg_bytes(page)
+        with Image.open(io.BytesIO(data)) as image:
+            cropped, cropped_pixels = crop_to_content(data, image, 24, max_height=800)
+            # The content is 2400x3200, it was decoded at 1/4 scale instead of cropped at full size
+            self.assertLess(cropped.height, 1600)
+            self.assertGreaterEqual(cropped.height, 800)
+            self.assertAlmostEqual(3000 * 4000 - 2400 * 3200, cropped_pixels, delta=0.05 * 3000 * 4000)
+        with Image.open(io.BytesIO(data)) as image:
+            # Without a max size the content is cropped at full size
+            cropped, _ = crop_to_content(data, image, 24)
+            self.assertGreaterEqual(cropped.height, 3200)
+
+    def test_cheapest_encoder(self):
+        encoders = [WebpEncoder(), PngEncoder()]
+        self.assertEqual("webp", cheapest_encoder([self.png_page], encoders).name)
+        # Only the png saves that much
+        self.assertEqual("png", cheapest_encoder([self.png_page], encoders, min_saving=0.98).name)
+        self.assertIsNone(cheapest_encoder([self.png_page], [JpegEncoder()]))
+
+
+def jpeg_segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + (len(payload) + 2).to_bytes(2, "big") + payload
+
+
+class TestsImageMetadata(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.test_file_name = os.path.join(self.temp_folder, "Test_metadata.cbz")
+        image = Image.effect_noise((800, 1200), 40).convert("RGB")
+        page = io.BytesIO()
+        image.save(page, format="JPEG", quality=85)
+        self.bare_page = page.getvalue()
+        exif = Image.Exif()
+        exif[0x010E] = "x" * 20000  # Image description, as big as an embedded thumbnail
+        self.exif = exif
+        self.icc = jpeg_segment(0xE2, b"ICC_PROFILE\0\x01\x01" + b"\0" * 3000)
+        metadata = (jpeg_segment(0xE1, exif.tobytes())
+                    + jpeg_segment(0xE1, b"http://ns.adobe.com/xap/1.0/\0" + b"<x:xmpmeta/>" * 500)
+                    + self.icc + jpeg_segment(0xFE, b"Scanned by someone"))
+        self.page = self.bare_page[:2] + metadata + self.bare_page[2:]
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def assertSamePixels(self, first: bytes, second: bytes):
+        with Image.open(io.BytesIO(first)) as first_image, Image.open(io.BytesIO(second)) as second_image:
+            self.assertEqual(first_image.tobytes(), second_image.tobytes())
+
+    def test_strip_jpeg(self):
+        stripped = strip_metadata(self.page)
+        self.assertEqual(self.bare_page[:2] + self.icc + self.bare_page[2:], stripped)
+        self.assertSamePixels(self.page, stripped)
+        self.assertEqual(self.bare_page, strip_metadata(self.page, keep_icc=False))
+
+    def test_orientation_is_kept(self):
+        self.exif[0x0112] = 6
+        page = self.bare_page[:2] + jpeg_segment(0xE1, self.exif.tobytes()) + self.bare_page[2:]
+        stripped = strip_metadata(page)
+        self.assertLess(len(stripped), len(self.bare_page) + 100)
+        with Image.open(io.BytesIO(stripped)) as image:
+            self.assertEqual({0x0112: 6}, dict(image.getexif()))
+        self.assertSamePixels(page, stripped)
+
+    def test_strip_png(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", "x" * 5000)
+        info.add_itxt("XML:com.adobe.xmp", "<x:xmpmeta/>" * 500, zip=False)
+        page = io.BytesIO()
+        Image.new("RGB", (60, 40), (10, 20, 30)).save(page, format="PNG", pnginfo=info)
+        stripped = strip_metadata(page.getvalue())
+        self.assertLess(len(stripped), 1000)
+        self.assertSamePixels(page.getvalue(), stripped)
+        with Image.open(io.BytesIO(stripped)) as image:
+            self.assertNotIn("Comment", image.info)
+
+    def test_png_orientation_is_kept(self):
+        for orientation, exif_size in ((1, None), (6, 100)):
+            self.exif[0x0112] = orientation
+            page = io.BytesIO()
+            Image.new("RGB", (60, 40), (10, 20, 30)).save(page, format="PNG", exif=self.exif)
+            stripped = strip_metadata(page.getvalue())
+            self.assertLess(len(stripped), 1000)
+            self.assertSamePixels(page.getvalue(), stripped)
+            with Image.open(io.BytesIO(stripped)) as image:
+                image.load()
+                if exif_size is None:
+                    self.assertNotIn("exif", image.info)
+                else:
+                    self.assertLess(len(image.info["exif"]), exif_size)
+                    self.assertEqual({0x0112: orientation}, dict(image.getexif()))
+
+    def test_strip_is_faster_than_recoding(self):
+        start_time = time.perf_counter()
+        for _ in range(5):
+            strip_metadata(self.page)
+        strip_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for _ in range(5):
+            with Image.open(io.BytesIO(self.page)) as image:
+                image.save(io.BytesIO(), format="JPEG", quality=85)
+        self.assertLess(strip_time * 10, time.perf_counter() - start_time)
+
+    def test_metadata_step(self):
+        with zipfile.ZipFile(self.test_file_name, "w") as zf:
+            zf.writestr("000.jpg", self.page)
+            zf.writestr("001.jpg", self.bare_page)
+        report = ConversionScheduler(page_workers=1).run([self.test_file_name],
+                                                          [encoder_step(StripMetadataEncoder(keep_icc=False))])
+        self.assertEqual(len(self.page) - len(self.bare_page), report.metadata_bytes)
+        self.assertEqual(1, report.pages_kept)
+        self.assertIn("KB of metadata", report.savings_report())
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertEqual(["000.jpg", "001.jpg"], zin.namelist())
+            self.assertEqual(self.bare_page, zin.read("000.jpg"))
+
+
+class TestsPageHashIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.series_folder = os.path.join(self.temp_folder, "Series")
+        self.other_folder = os.path.join(self.temp_folder, "Other")
+        os.mkdir(self.series_folder)
+        os.mkdir(self.other_folder)
+        self.page_index = PageHashIndex(os.path.join(self.temp_folder, "page_hashes.sqlite3"))
+        credits_page = jpeg_bytes(drawn_page(100))
+        self.chapters = []
+        for chapter in range(3):
+            path = os.path.join(self.series_folder, f"Chapter {chapter}.cbz")
+            with zipfile.ZipFile(path, "w") as zf:
+                for page in range(3):
+                    zf.writestr(f"{page:03}.jpg", jpeg_bytes(drawn_page(chapter * 10 + page)))
+                zf.writestr("099.jpg", credits_page)
+            self.chapters.append(path)
+        with zipfile.ZipFile(self.chapters[0], "a") as zf:
+            zf.writestr("003.jpg", jpeg_bytes(Image.new('RGB', size=(400, 600), color=(250, 250, 250))))
+            zf.writestr("004.jpg", jpeg_bytes(drawn_page(1), quality=60))
+        # The first chapter uploaded again somewhere else, re-encoded
+        self.reupload = os.path.join(self.other_folder, "Chapter 0 (v2).cbz")
+        with zipfile.ZipFile(self.chapters[0], "r") as zin, zipfile.ZipFile(self.reupload, "w") as zout:
+            for name in zin.namelist():
+                with Image.open(io.BytesIO(zin.read(name))) as image:
+                    zout.writestr(name, jpeg_bytes(image, quality=70))
+
+    def tearDown(self) -> None:
+        self.page_index.close()
+        shutil.rmtree(self.temp_folder)
+
+    def test_flat_and_crowded_bands_are_not_compared(self):
+        flat = os.path.join(self.other_folder, "Flat.cbz")
+        # Three bands of flat areas (0) in common, the hashes are one bit apart but never compared
+        self.page_index.put_page(flat, "000.jpg", PageHash(1 << 48, 0, False))
+        self.page_index.put_page(flat, "001.jpg", PageHash(3 << 48, 0, False))
+        # Pages with the same hash are still found
+        self.page_index.put_page(flat, "002.jpg", PageHash(5 << 48, 0, False))
+        self.page_index.put_page(flat, "003.jpg", PageHash(5 << 48, 0, False))
+        crowded = 7 | 0x11 << 16 | 0x22 << 32
+        for name, last_band in (("004.jpg", 0x30), ("005.jpg", 0x31), ("006.jpg", 0xFC0F)):
+            self.page_index.put_page(flat, name, PageHash(crowded | last_band << 48, 0, False))
+        flat = os.path.abspath(flat)
+        self.assertEqual([[(flat, "002.jpg"), (flat, "003.jpg")], [(flat, "004.jpg"), (flat, "005.jpg")]],
+                         self.page_index.report().in_archive)
+        # 004 to 006 share their first bands, more pages than the limit joined pair by pair
+        with mock.patch("MangaManager.CommonLib.PageHashIndex._MAX_BAND_PAGES", 2):
+            self.assertEqual([[(flat, "002.jpg"), (flat, "003.jpg")]], self.page_index.report().in_archive)
+
+    def test_report(self):
+        paths = self.chapters + [self.reupload]
+        self.assertEqual(4, self.page_index.update(paths, max_workers=1))
+        self.assertEqual(0, self.page_index.update(paths, max_workers=1))
+        report = self.page_index.report()
+        chapter = os.path.abspath(self.chapters[0])
+        reupload = os.path.abspath(self.reupload)
+        # Sorted by path, the reupload goes first
+        self.assertEqual([(reupload, "003.jpg"), (chapter, "003.jpg")], report.blank)
+        self.assertEqual([[(reupload, "001.jpg"), (reupload, "004.jpg")], [(chapter, "001.jpg"), (chapter, "004.jpg")]],
+                         report.in_archive)
+        self.assertEqual([(reupload, chapter)], [(first, second) for first, second, _ in report.reuploads])
+        # The reupload doesn't count as a chapter of the series
+        self.assertEqual(1, len(report.series_repeats))
+        self.assertEqual(3, len([name for _, name in report.series_repeats[0] if name == "099.jpg"]))
+        self.assertEqual({"003.jpg", "004.jpg", "099.jpg"}, report.filler_pages()[chapter])
+        self.assertEqual({"003.jpg", "004.jpg"}, report.filler_pages()[reupload])
+        self.assertIn("4 pages duplicated in their archive (2 groups), "
+                      f"{len(report.series_repeats[0])} pages repeated across a series (1 groups)", report.summary())
+
+        scheduler = ConversionScheduler(page_workers=1)
+        scheduler.run([chapter], [drop_pages_step(report.filler_pages()[chapter])], page_index=self.page_index)
+        self.assertTrue(self.page_index.is_current(chapter))
+        report = self.page_index.report()
+        self.assertNotIn((chapter, "003.jpg"), report.blank)
+        self.assertEqual([[(reupload, "001.jpg"), (reupload, "004.jpg")]], report.in_archive)
+
+    def test_pages_are_hashed_while_converted(self):
+        with zipfile.ZipFile(self.chapters[1], "a") as zf:
+            zf.writestr("100.webp", b"not an image")
+        report = ConversionScheduler(page_workers=1).run(self.chapters[1:], [webp_step(cache_path=None)],
+                                                          page_index=self.page_index)
+        self.assertEqual(2, report.archives)
+        self.assertTrue(all(self.page_index.is_current(path) for path in self.chapters[1:]))
+        # Only the credits are repeated, in 2 chapters
+        report = self.page_index.report(min_series_archives=2)
+        self.assertEqual([[(os.path.abspath(path), "099.webp") for path in self.chapters[1:]]],
+                         report.series_repeats)
+
+
+class TestsPageCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_folder, "page_cache.sqlite3")
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_least_recently_used_pages_are_evicted(self):
+        cache = PageCache(self.cache_path, max_bytes=25)
+        for key in ("a", "b", "c"):
+            cache.put(key, TransformOutput(key.encode() * 10))
+            time.sleep(0.01)
+        # Pages used recently are read without writing to the cache
+        last_used = "SELECT last_used FROM pages WHERE key = 'a'"
+        first_use = cache._connection.execute(last_used).fetchone()[0]
+        cache.get("a")
+        self.assertEqual(first_use, cache._connection.execute(last_used).fetchone()[0])
+        cache._connection.execute("UPDATE pages SET last_used = last_used - ?", (2 * _TOUCH_AFTER,))
+        cache.get("a")
+        self.assertEqual(1, cache.evict())
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(b"a" * 10, cache.get("a").data)
+        self.assertEqual(20, cache.total_size())
+        cache.close()
+
+    def test_repeated_pages_are_taken_from_the_cache(self):
+        calls = []
+
+        def reverse(open_file):
+            calls.append(1)
+            return reverse_data(open_file)
+
+        transform = CachedTransform(reverse, "reverse", self.cache_path)
+        for stats in ({"cache_misses": 1}, {"cache_hits": 1}):
+            output = transform(io.BytesIO(b"abc"))
+            self.assertEqual((b"cba", stats), (output.data, output.stats))
+        self.assertEqual(1, len(calls))
+        # Other settings, other key
+        CachedTransform(reverse, "reverse v2", self.cache_path)(io.BytesIO(b"abc"))
+        self.assertEqual(2, len(calls))
+
+    def test_broken_cache_encodes_the_page(self):
+        transform = CachedTransform(reverse_data, "reverse", self.cache_path)
+        transform(io.BytesIO(b"abc"))
+        connection = sqlite3.connect(self.cache_path)
+        connection.execute("DROP TABLE pages")
+        connection.commit()
+        connection.close()
+        with self.assertLogs("MangaManager.CommonLib.PageCache", level="WARNING") as logs:
+            output = transform(io.BytesIO(b"abc"))
+        self.assertEqual((b"cba", {"cache_misses": 1}), (output.data, output.stats))
+        self.assertIn("could not be read from the cache", logs.output[0])
+
+
+class TestsRunJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_folder = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.temp_folder, "journal.sqlite3")
+        self.test_files = [os.path.join(self.temp_folder, f"Test_{i}.cbz") for i in range(3)]
+        for path in self.test_files:
+            create_test_cbz(path)
+
+    def tearDown(self) -> None:
+        for filename in os.listdir(self.temp_folder):
+            os.remove(os.path.join(self.temp_folder, filename))
+        os.rmdir(self.temp_folder)
+
+    def test_finished_archives_are_skipped_on_resume(self):
+        scheduler = ConversionScheduler(page_workers=1, archive_workers=2)
+        journal = RunJournal(self.journal_path, "reverse")
+        self.assertEqual(3, scheduler.run(self.test_files, [reverse_pages_step], journal=journal).archives)
+        journal.close()
+
+        create_test_cbz(self.test_files[1])
+        journal = RunJournal(self.journal_path, "reverse", resume=True)
+        report = scheduler.run(self.test_files, [reverse_pages_step], journal=journal)
+        journal.close()
+        self.assertEqual((1, 2), (report.archives, report.skipped))
+        # Other settings, everything is done again
+        journal = RunJournal(self.journal_path, "reverse v2", resume=True)
+        self.assertEqual(self.test_files, journal.pending(self.test_files))
+        journal.close()
+        # Without resume the journal starts empty
+        journal = RunJournal(self.journal_path, "reverse")
+        self.assertEqual(self.test_files, journal.pending(self.test_files))
+        journal.close()
+
+    def test_orphaned_temp_files_are_removed(self):
+        orphan = os.path.join(self.temp_folder, TEMP_PREFIX + "ab_c1234")
+        create_test_cbz(orphan)
+        # Archives of the user named like tempfile names are kept
+        unrelated = os.path.join(self.temp_folder, "tmpab_c1234")
+        create_test_cbz(unrelated)
+
+        self.assertEqual([orphan], cleanup_orphaned_temp_files([self.temp_folder]))
+        self.assertTrue(os.path.exists(unrelated))
+        self.assertTrue(all(os.path.exists(path) for path in self.test_files))
+
+
+class TestsImageAnalysis(unittest.TestCase):
+    def test_grayscale_detection(self):
+        grey_page = Image.new('RGB', size=(200, 300), color=(120, 120, 120))
+        # Scans are never perfectly grey
+        grey_page.paste((124, 119, 121), (0, 0, 200, 150))
+        self.assertTrue(is_grayscale(grey_page))
+        image, converted = to_grayscale(grey_page)
+        self.assertTrue(converted)
+        self.assertEqual("L", image.mode)
+
+        colour_insert = grey_page.copy()
+        colour_insert.paste((200, 30, 30), (50, 50, 100, 100))
+        self.assertFalse(is_grayscale(colour_insert))
+        self.assertEqual((colour_insert, False), to_grayscale(colour_insert))
+        self.assertFalse(is_grayscale(grey_page, tolerance=2))
+
+    def test_quality_metrics(self):
+        plane = luma_plane(Image.new('RGB', size=(40, 30), color=(120, 60, 30)))
+        self.assertEqual((30, 40), plane.shape)
+        self.assertEqual((math.inf, 1.0), (psnr(plane, plane), ssim(plane, plane)))
+        self.assertAlmostEqual(20 * math.log10(255 / 5), psnr(plane, plane + 5))
+        noisy = plane + [[(x * 7 + y * 13) % 21 - 10 for x in range(40)] for y in range(30)]
+        self.assertLess(ssim(plane, noisy), ssim(plane, (plane + noisy) / 2))
+
+    def test_perceptual_hashes(self):
+        page = drawn_page(1)
+        # Re-encoded and resized
+        with Image.open(io.BytesIO(jpeg_bytes(page.resize((300, 450)), quality=50))) as reupload:
+            self.assertLessEqual(hamming_distance(dhash(page), dhash(reupload)), 3)
+            self.assertLessEqual(hamming_distance(ahash(page), ahash(reupload)), 3)
+        self.assertGreater(hamming_distance(dhash(page), dhash(drawn_page(2))), 10)
+        self.assertFalse(is_blank(page))
+        blank_scan = Image.new('RGB', size=(400, 600), color=(245, 243, 240))
+        blank_scan.putpixel((200, 300), (0, 0, 0))
+        self.assertTrue(is_blank(blank_scan))
+
+    def test_content_box(self):
+        page = Image.new('RGB', size=(1200, 1800), color=(250, 252, 248))
+        page.paste((20, 20, 20), (100, 150, 1100, 1700))
+        # Dust in the margin
+        page.putpixel((30, 40), (0, 0, 0))
+        page.putpixel((1190, 1000), (0, 0, 0))
+        left, upper, right, lower = content_box(page)
+        self.assertTrue(70 <= left <= 100 and 120 <= upper <= 150)
+        self.assertTrue(1100 <= right <= 1130 and 1700 <= lower <= 1730)
+        cropped, cropped_pixels = crop_borders(page)
+        self.assertEqual((right - left, lower - upper), cropped.size)
+        self.assertEqual(1200 * 1800 - cropped.width * cropped.height, cropped_pixels)
+        # Black borders
+        inverted = Image.eval(page, lambda value: 255 - value)
+        self.assertEqual((left, upper, right, lower), content_box(inverted))
+
+        self.assertIsNone(content_box(Image.new('RGB', size=(300, 400), color=(255, 255, 255))))
+        # Full bleed art
+        self.assertIsNone(content_box(Image.effect_noise((300, 400), 60).convert("RGB"), tolerance=5))
+        # Small illustration in the middle of a page. Cropping to it would change the page too much
+        small_content = Image.new('RGB', size=(1200, 1800), color=(255, 255, 255))
+        small_content.paste((0, 0, 0), (500, 700, 700, 1100))
+        self.assertIsNone(content_box(small_content))
+
+
+if __name__ == '__main__':
+    unittest.main()
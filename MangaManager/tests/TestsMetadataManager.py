@@ -1,5 +1,6 @@
 import random
 import re
+import tempfile
 import unittest
 
 from PIL import Image
@@ -51,6 +52,7 @@ comicinfo_xml = """
     <CommunityRating>34555</CommunityRating>
 </ComicInfo>"""
 # Manga Tagger
+from MangaManager.CommonLib.SidecarMetadata import find_pending_sidecars
 from MangaManager.MetadataManagerLib import MetadataManager, models
 from MangaManager.MetadataManagerLib.cbz_handler import *
 from MangaManager.VolumeManager import VolumeManager
@@ -171,6 +173,118 @@ class TestsMetadataManager(unittest.TestCase):
                 #     self.assertEqual(widget_var.get(), random_int)
 
 
+class TestsWriteComicInfo(unittest.TestCase):
+    def setUp(self) -> None:
+        self.test_file_name = f"Test_raw_{random.randint(1, 6000)}.cbz"
+        self.pages = {}
+        with zipfile.ZipFile(self.test_file_name, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for i in range(5):
+                image = Image.new('RGB', size=(20, 20), color=(255, 73, 95))
+                imgByteArr = io.BytesIO()
+                image.save(imgByteArr, format="PNG")
+                self.pages[f"{str(i).zfill(3)}.png"] = imgByteArr.getvalue()
+                zf.writestr(f"{str(i).zfill(3)}.png", imgByteArr.getvalue())
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.original_infos = {info.filename: info for info in zin.infolist()}
+
+    def tearDown(self) -> None:
+        os.remove(self.test_file_name)
+
+    def test_pages_are_copied_raw(self):
+        comicinfo = ComicInfo.ComicInfo()
+        comicinfo.set_Series("Raw copy")
+        WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_file()
+        comicinfo.set_Series("Raw copy 2")
+        WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_file()
+
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertIsNone(zin.testzip())
+            for name, data in self.pages.items():
+                info = zin.getinfo(name)
+                self.assertEqual(self.original_infos[name].compress_type, info.compress_type)
+                self.assertEqual(self.original_infos[name].compress_size, info.compress_size)
+                self.assertEqual(self.original_infos[name].CRC, info.CRC)
+                self.assertEqual(data, zin.read(name))
+            self.assertIn("Old_ComicInfo.xml.bak", zin.namelist())
+        self.assertEqual("Raw copy 2", ReadComicInfo(self.test_file_name).to_ComicInfo().get_Series())
+
+        WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).restore()
+        self.assertEqual("Raw copy", ReadComicInfo(self.test_file_name).to_ComicInfo().get_Series())
+
+    def test_unchanged_comicinfo_is_not_written(self):
+        comicinfo = ComicInfo.ComicInfo()
+        comicinfo.set_Series("Unchanged")
+        self.assertTrue(WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_file())
+        modified_time = os.stat(self.test_file_name).st_mtime_ns
+
+        self.assertFalse(WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_file())
+        self.assertEqual(modified_time, os.stat(self.test_file_name).st_mtime_ns)
+        with zipfile.ZipFile(self.test_file_name, "r") as zin:
+            self.assertNotIn("Old_ComicInfo.xml.bak", zin.namelist())
+
+        comicinfo.set_Series("Changed")
+        self.assertTrue(WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_file())
+        self.assertEqual("Changed", ReadComicInfo(self.test_file_name).to_ComicInfo().get_Series())
+
+    def test_sidecar_is_embedded_later(self):
+        comicinfo = ComicInfo.ComicInfo()
+        comicinfo.set_Series("Sidecar")
+        modified_time = os.stat(self.test_file_name).st_mtime_ns
+        self.assertTrue(WriteComicInfo(LoadedComicInfo(self.test_file_name, comicinfo)).to_sidecar())
+        self.assertEqual(modified_time, os.stat(self.test_file_name).st_mtime_ns)
+        self.assertEqual("Sidecar", ReadComicInfo(self.test_file_name).to_ComicInfo().get_Series())
+        self.assertEqual([self.test_file_name], find_pending_sidecars("."))
+
+        self.assertTrue(embed_sidecar(self.test_file_name))
+        self.assertIsNone(read_sidecar(self.test_file_name))
+        self.assertEqual("Sidecar", ReadComicInfo(self.test_file_name, use_sidecar=False).to_ComicInfo().get_Series())
+        self.assertFalse(embed_sidecar(self.test_file_name))
+
+
+class TestsReadComicInfo(unittest.TestCase):
+    def setUp(self) -> None:
+        self.test_file_name = f"Test_cd_{random.randint(1, 6000)}.cbz"
+        with zipfile.ZipFile(self.test_file_name, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("folder/", b"")
+            for i in range(7):
+                zf.writestr(f"folder/{str(i).zfill(3)}.jpg", os.urandom(1000))
+            zf.writestr("ComicInfo.xml", comicinfo_xml)
+
+    def tearDown(self) -> None:
+        os.remove(self.test_file_name)
+
+    def test_central_directory_summary(self):
+        opened_cbz = ReadComicInfo(self.test_file_name)
+        self.assertEqual(9, opened_cbz.total_files)
+        self.assertEqual(7, opened_cbz.page_count)
+        self.assertEqual(7000 + len(comicinfo_xml.encode()), opened_cbz.total_size)
+        self.assertEqual("Value", opened_cbz.to_ComicInfo().get_Series())
+
+    def test_prepended_data(self):
+        with open(self.test_file_name, "rb") as f:
+            data = f.read()
+        with open(self.test_file_name, "wb") as f:
+            f.write(b"prepended" * 100 + data)
+        self.assertEqual("Value", ReadComicInfo(self.test_file_name).to_ComicInfo().get_Title())
+
+    def test_read_in_worker_process(self):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=2, initializer=init_comicinfo_worker) as executor:
+            indexed, comicinfo = executor.submit(read_comicinfo_worker, self.test_file_name).result()
+            self.assertEqual("Value", comicinfo.get_Series())
+            self.assertEqual(7, indexed.page_count)
+            indexed, comicinfo = executor.submit(read_comicinfo_worker, self.test_file_name,
+                                                 comicinfo_xml.encode()).result()
+            self.assertIsNone(indexed)
+            self.assertEqual("Value", comicinfo.get_Title())
+
+    def test_missing_comicinfo(self):
+        with zipfile.ZipFile(self.test_file_name, "w") as zf:
+            zf.writestr("001.png", b"")
+        self.assertRaises(NoMetadataFileFound, ReadComicInfo, self.test_file_name)
+        self.assertEqual(1, ReadComicInfo(self.test_file_name, ignore_empty_metadata=True).page_count)
+
+
 def get_newFilename(files: list[str], volumeNumber) -> str:
     for cbz_path in files:
         filepath = cbz_path
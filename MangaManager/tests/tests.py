@@ -1,12 +1,20 @@
 # common
+import io
 import random
 import re
+import shutil
+import tempfile
+import time
 import tkinter as tk
 import unittest
 from zipfile import ZipFile
 
 # Epub2Cbz
+from PIL import Image
+
 from ConvertersLib.epub2cbz import epub2cbz
+from MangaManager.CommonLib import WebpConverter
+from MangaManager.CommonLib.ArchiveJobPlanner import ArchiveJob
 from MangaManager.CoverManagerLib.cbz_handler import SetCover
 from MangaManager.CoverManagerLib.models import cover_process_item_info
 # Manga Tagger
@@ -309,6 +317,29 @@ class CoversCbzControllerTester(unittest.TestCase):
         print(f"Asserting {item_count} vs {item_count2}, delta 1")
         self.assertAlmostEqual(item_count, item_count2, delta=1)  # add assertion here
 
+    def test_grey_images_are_converted_to_grayscale(self):
+        temp_folder = tempfile.mkdtemp()
+        cbz_path = os.path.join(temp_folder, "Grey.cbz")
+        cover_path = os.path.join(temp_folder, "cover.png")
+        try:
+            Image.effect_noise((60, 80), 40).convert("RGB").save(cover_path)
+            with ZipFile(cbz_path, "w") as zout:
+                for page in range(2):
+                    image_data = io.BytesIO()
+                    Image.effect_noise((60, 80), 40).convert("RGB").save(image_data, format="PNG")
+                    zout.writestr(f"{page + 1:03}.png", image_data.getvalue())
+            values_to_process = cover_process_item_info(cbz_file=cbz_path, cover_path=cover_path,
+                                                        cover_format="png")
+            job = ArchiveJob(cbz_path)
+            SetCover(values_to_process, conver_to_webp=True, job=job, grayscale_tolerance=8)
+            result = job.run()
+            # Both pages and the new cover
+            self.assertEqual(3, result.stats["grayscale"])
+            with ZipFile(cbz_path, "r") as zin:
+                self.assertIn("001.webp", zin.namelist())
+        finally:
+            shutil.rmtree(temp_folder)
+
     def test_zcount_leftover_files(self):
         final_dir_count = len(os.listdir(os.path.dirname(test_path)))
         print(f"Asserting {initial_dir_count} vs {final_dir_count}, delta 1")
@@ -443,5 +474,78 @@ class Epub2CbzTester(unittest.TestCase):
             pass
 
 
+    def test_convert_to_webp(self):
+        app = epub2cbz.App(self.root, [self.newEpubFilePath], convert_to_webp=True, page_workers=2)
+        app.output_folder = os.getcwd()
+        newCbzPath = os.path.join(os.getcwd(), "TestEpub.cbz")
+        app.start()
+        try:
+            with ZipFile(newCbzPath, 'r') as zipCbz:
+                self.assertIsNone(zipCbz.testzip())
+                self.assertEqual(self.generatedImagesNumber, len(zipCbz.namelist()))
+                # Images whose webp is bigger keep their format
+                self.assertTrue(all(name.endswith((".webp", ".jpg")) for name in zipCbz.namelist()))
+        finally:
+            os.remove(self.newEpubFilePath)
+            os.remove(newCbzPath)
+
+    def test_same_name_in_different_folders(self):
+        temp_folder = tempfile.mkdtemp()
+        epubs = []
+        for folder, pages in (("a", 2), ("b", 3)):
+            os.mkdir(os.path.join(temp_folder, folder))
+            epubs.append(os.path.join(temp_folder, folder, "Vol1.epub"))
+            with ZipFile(epubs[-1], "w") as zout:
+                for page in range(pages):
+                    zout.write(sample_cover, f"images/{page:03}.jpg")
+        processed = []
+
+        class SlowApp(epub2cbz.App):
+            def _processFile(self, zipFilePath, *args, **kwargs):
+                processed.append(zipFilePath)
+                time.sleep(0.2)  # Both epubs would be past the existence check by now
+                super()._processFile(zipFilePath, *args, **kwargs)
+
+        app = SlowApp(self.root, epubs, archive_workers=2)
+        app.output_folder = temp_folder
+        try:
+            app.start()
+            # Only one of them is written, the other is not allowed to overwrite it
+            self.assertEqual(1, len(processed))
+            with ZipFile(os.path.join(temp_folder, "Vol1.cbz"), 'r') as zipCbz:
+                self.assertIn(len(zipCbz.namelist()), (2, 3))
+            self.assertEqual(["Vol1.cbz", "a", "b"], sorted(os.listdir(temp_folder)))
+        finally:
+            os.remove(self.newEpubFilePath)
+            shutil.rmtree(temp_folder)
+
+
+class WebpConverterTester(unittest.TestCase):
+    def test_start_does_not_block_the_main_loop(self):
+        temp_folder = tempfile.mkdtemp()
+        cbz_path = os.path.join(temp_folder, "Chapter 1.cbz")
+        with ZipFile(cbz_path, "w") as zout:
+            for page in range(3):
+                image_data = io.BytesIO()
+                Image.effect_noise((60, 80), 40).convert("RGB").save(image_data, format="PNG")
+                zout.writestr(f"{page:03}.png", image_data.getvalue())
+        app = WebpConverter.App(tk.Tk())
+        app._initialized_UI = False
+        app.cbzFilePathList.append(cbz_path)
+        try:
+            with self.assertLogs(level="INFO") as logs:
+                app.start()
+                # The conversion runs in another thread, the main loop keeps running until it's done
+                self.assertTrue(app._worker.is_alive())
+                deadline = time.time() + 60
+                while not any("Completed processing" in line for line in logs.output) and time.time() < deadline:
+                    app.master.update()
+                    time.sleep(0.05)
+            with ZipFile(cbz_path, "r") as zin:
+                self.assertEqual(["000.webp", "001.webp", "002.webp"], sorted(zin.namelist()))
+        finally:
+            shutil.rmtree(temp_folder)
+
+
 if __name__ == '__main__':
     unittest.main()